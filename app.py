@@ -4,10 +4,9 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import event
 from sqlalchemy.orm import DeclarativeBase
-
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+from config import CONFIGS
 
 class Base(DeclarativeBase):
     pass
@@ -16,25 +15,41 @@ class Base(DeclarativeBase):
 db = SQLAlchemy(model_class=Base)
 login_manager = LoginManager()
 
-def create_app():
+def _configure_sqlite(engine, journal_mode):
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+        # Safe with WAL and avoids an fsync on every commit
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # SQLite leaves foreign keys unchecked unless asked, per connection
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+def create_app(config_name=None):
     app = Flask(__name__)
     
     # Configuration
-    app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
-    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///elibrary.db")
-    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-        "pool_recycle": 300,
-        "pool_pre_ping": True,
-    }
-    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-    app.config["UPLOAD_FOLDER"] = "uploads"
-    app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024  # 50MB max file size
+    app.config.from_object(CONFIGS[config_name or os.environ.get("APP_ENV", "development")])
+    logging.basicConfig(level=app.config["LOG_LEVEL"])
+    logging.getLogger().setLevel(app.config["LOG_LEVEL"])
     
-    # Proxy fix for proper URL generation
-    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+    # Proxy fix for proper URL generation; x_for gives request.remote_addr the
+    # client's address rather than the proxy's (login throttling and download
+    # logs are keyed on it)
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
     
     # Initialize extensions with app
     db.init_app(app)
+    with app.app_context():
+        if db.engine.dialect.name == "sqlite":
+            _configure_sqlite(db.engine, app.config["SQLITE_JOURNAL_MODE"])
+    from cache import cache
+    cache.init_app(app)
+    from storage import storage
+    storage.init_app(app)
+    import background
+    background.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = 'login'
     login_manager.login_message = 'Please log in to access this page.'
@@ -45,55 +60,28 @@ def create_app():
     os.makedirs(upload_dir, exist_ok=True)
     os.makedirs("uploads", exist_ok=True)
     
-    with app.app_context():
-        # Import models to ensure tables are created
-        import models
-        db.create_all()
-        
-        # Create default admin user if none exists
-        from models import User
-        from werkzeug.security import generate_password_hash
-        
-        admin = User.query.filter_by(username='admin').first()
-        if not admin:
-            admin = User(
-                username='admin',
-                email='admin@elibrary.com',
-                full_name='Administrator',
-                is_admin=True
-            )
-            admin.set_password('admin123')
-            db.session.add(admin)
-            db.session.commit()
-            logging.info("Default admin user created: admin/admin123")
-        
-        # Create default categories
-        from models import Category
-        if Category.query.count() == 0:
-            default_categories = [
-                ('Fiction', 'Novels, short stories, and other fictional works'),
-                ('Non-Fiction', 'Biographies, memoirs, and factual books'),
-                ('Science', 'Scientific research, textbooks, and journals'),
-                ('Technology', 'Computer science, programming, and tech guides'),
-                ('History', 'Historical accounts, documentaries, and archives'),
-                ('Education', 'Textbooks, learning materials, and academic resources'),
-                ('Business', 'Management, entrepreneurship, and business guides'),
-                ('Literature', 'Classic literature, poetry, and literary criticism')
-            ]
-            
-            for name, description in default_categories:
-                category = Category(name=name, description=description)
-                db.session.add(category)
-            
-            db.session.commit()
-            logging.info("Default categories created")
+    # Buffered download events; journals left by a stopped process are
+    # written out by bootstrap.init_db()
+    from events import download_recorder
+    download_recorder.init_app(app)
+    from instrumentation import instrumentation
+    instrumentation.init_app(app)
+    from identity import last_logins
+    last_logins.init_app(app)
+    from passwords import hasher, login_throttle
+    hasher.init_app(app)
+    login_throttle.init_app(app)
+    
+    # Views and CLI commands. Nothing here touches the database: schema
+    # setup and seeding are the init-db and seed commands (bootstrap.py)
+    import routes
+    import commands
+    routes.init_app(app)
+    commands.init_app(app)
     
     return app
 
-# Create app instance
-app = create_app()
-
 @login_manager.user_loader
 def load_user(user_id):
-    from models import User
-    return User.query.get(int(user_id))
+    import identity
+    return identity.load_user(int(user_id))
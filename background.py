@@ -0,0 +1,36 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Process pool for the CPU-bound background work: cover variants (covers.py)
+# and text extraction (text_extract.py) share one pool per process. Each
+# gunicorn worker has its own, so the host's BACKGROUND_CPUS are split
+# between the WEB_CONCURRENCY workers (at least one process each) and N
+# workers together do not start more processes than there are CPUs to run
+# them. Commands run outside gunicorn get the whole budget.
+#
+# Pool processes import only the task modules; like them, this module must
+# not import the application.
+
+_settings = {'cpus': os.cpu_count() or 1, 'web_workers': 1}
+_executor = None
+_executor_pid = None
+
+
+def init_app(app):
+    _settings['cpus'] = app.config.get('BACKGROUND_CPUS') or os.cpu_count() or 1
+    _settings['web_workers'] = max(1, app.config.get('WEB_CONCURRENCY', 1))
+
+
+def pool_size():
+    return max(1, _settings['cpus'] // _settings['web_workers'])
+
+
+def pool():
+    global _executor, _executor_pid
+    # A forked worker process cannot use its parent's pool
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ProcessPoolExecutor(max_workers=pool_size(),
+                                        mp_context=multiprocessing.get_context('spawn'))
+        _executor_pid = os.getpid()
+    return _executor
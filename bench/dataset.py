@@ -0,0 +1,144 @@
+import os
+import random
+import hashlib
+import logging
+import tempfile
+from datetime import datetime, timedelta
+from sqlalchemy import insert, select, update, func
+from werkzeug.security import generate_password_hash
+from app import db
+from models import User, Book, Category, Download, StoredFile, BookRecommendation
+from storage import storage, object_key
+import bootstrap
+import counters
+import stats
+import search
+
+# Synthetic library for the benchmarks. Rows are generated from a fixed
+# random seed and inserted with executemany batches; download counters,
+# daily rollups and the search index are then rebuilt the way the
+# maintenance commands do. Every book points at the same small stored file,
+# so /download/<id> can be benchmarked without gigabytes of fixtures.
+# Imported by bench/load.py once the environment is set up.
+
+SCALES = {
+    'small': {'books': 2000, 'users': 2000, 'downloads': 100000},
+    'medium': {'books': 20000, 'users': 10000, 'downloads': 1000000},
+    'full': {'books': 100000, 'users': 50000, 'downloads': 10000000},
+}
+
+BATCH_SIZE = 20000
+
+WORDS = ['river', 'night', 'garden', 'empire', 'quantum', 'history', 'silent', 'machine',
+         'ocean', 'winter', 'python', 'kingdom', 'shadow', 'economics', 'journey', 'light',
+         'algebra', 'forest', 'memory', 'stone', 'signal', 'harvest', 'orbit', 'letters']
+NAMES = ['Ada', 'Ben', 'Chen', 'Dina', 'Eli', 'Fatima', 'Goro', 'Hana', 'Ivan', 'Jun',
+         'Kofi', 'Lena', 'Mateo', 'Nia', 'Omar', 'Priya', 'Quinn', 'Rosa', 'Sami', 'Tala']
+
+BENCH_USER = 'bench'
+
+
+def _batches(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _bulk_insert(model, rows):
+    count = 0
+    for batch in _batches(rows):
+        db.session.execute(insert(model), batch)
+        db.session.commit()
+        count += len(batch)
+    return count
+
+
+def _sample_file():
+    # One stored book file shared by every synthetic book
+    content = b'%PDF-1.4\n' + b'benchmark book\n' * 4096
+    digest = hashlib.sha256(content).hexdigest()
+    handle, path = tempfile.mkstemp(dir=storage.incoming_dir(), suffix='.upload')
+    with os.fdopen(handle, 'wb') as out:
+        out.write(content)
+    storage.add(path, digest)
+    db.session.commit()
+    return digest, len(content)
+
+
+def is_seeded():
+    return db.session.execute(select(func.count(Book.id))).scalar() > 0
+
+
+def seed(books, users, downloads, random_seed=1):
+    """Fill an empty database; needs an app context."""
+    rng = random.Random(random_seed)
+    now = datetime.utcnow()
+    bootstrap.init_db()
+    bootstrap.seed()
+    admin_id = db.session.execute(select(User.id).where(User.username == 'admin')).scalar()
+    category_ids = db.session.execute(select(Category.id)).scalars().all()
+
+    # Hashing a password per user would dominate the run; they share one
+    password_hash = generate_password_hash(BENCH_USER)
+    first_user = (db.session.execute(select(func.max(User.id))).scalar() or 0) + 1
+    _bulk_insert(User, ({
+        'username': BENCH_USER if n == 0 else f'reader{n}',
+        'email': f'reader{n}@bench.example',
+        'full_name': f'{rng.choice(NAMES)} {rng.choice(NAMES)}son',
+        'password_hash': password_hash,
+        'is_admin': False,
+        'created_at': now - timedelta(minutes=rng.randrange(2 * 365 * 24 * 60)),
+    } for n in range(users)))
+    logging.info(f"Seeded {users} users")
+
+    digest, size = _sample_file()
+    first_book = (db.session.execute(select(func.max(Book.id))).scalar() or 0) + 1
+    _bulk_insert(Book, ({
+        'title': ' '.join(rng.sample(WORDS, 3)).title(),
+        'author': f'{rng.choice(NAMES)} {rng.choice(NAMES)}',
+        'description': ' '.join(rng.choices(WORDS, k=30)),
+        'filename': f'book-{n}.pdf',
+        'file_path': object_key(digest),
+        'file_size': size,
+        'file_hash': digest,
+        'uploaded_at': now - timedelta(minutes=rng.randrange(3 * 365 * 24 * 60)),
+        'uploaded_by': admin_id,
+        'category_id': rng.choice(category_ids),
+        'download_count': 0,
+    } for n in range(books)))
+    db.session.execute(update(StoredFile).where(StoredFile.digest == digest)
+                       .values(ref_count=StoredFile.ref_count + books - 1))
+    db.session.commit()
+    logging.info(f"Seeded {books} books")
+
+    # Popular books get most of the downloads
+    _bulk_insert(Download, ({
+        'user_id': first_user + rng.randrange(users),
+        'book_id': first_book + int(books * rng.random() ** 3),
+        'ip_address': f'10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}',
+        'downloaded_at': now - timedelta(seconds=rng.randrange(365 * 24 * 3600)),
+    } for _ in range(downloads)))
+    logging.info(f"Seeded {downloads} downloads")
+
+    # Uniformly random downloads make build-recommendations quadratic in
+    # every reader's history; the pages only read the table, so fill it directly
+    _bulk_insert(BookRecommendation, ({
+        'book_id': first_book + n,
+        'rank': rank,
+        'recommended_book_id': first_book + other,
+        'shared_readers': 10 - rank,
+        'score': 1.0 / (rank + 1),
+    } for n in range(books)
+      for rank, other in enumerate(rng.sample([m for m in range(min(books, 50)) if m != n], 10), 1)))
+    logging.info("Seeded recommendations")
+
+    counters.reconcile_download_counts()
+    stats.rebuild_rollups()
+    search.rebuild_index()
+    logging.info("Rebuilt counters, rollups and the search index")
+
@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+# Route benchmark: `python bench/load.py [--scale small|medium|full]`.
+#
+# Seeds a synthetic library (bench/dataset.py) into DATABASE_URL, or into
+# bench/.data/<scale>.db when it is not set, and reuses it on later runs.
+# Each scenario then sends --requests requests for one page through the WSGI
+# test client from --concurrency threads and reports throughput, p50/p99
+# latency, the most SQL statements a single request issued (cache version
+# checks left out) and the largest response. The run fails (exit status 1)
+# when a page goes over its statement budget, or, with --baseline, when its
+# p50, p99 or response size grows past --tolerance against an earlier
+# --output file.
+#
+# PostgreSQL: DATABASE_URL=postgresql://localhost/elibrary_bench python bench/load.py
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, who, path, statement budget). Paths are formatted with a random
+# book id, category id and search word per request. Anonymous catalog pages
+# come from the page cache after the warm-up. Listings read the books' "also
+# downloaded" rows in one more statement.
+SCENARIOS = [
+    ('home', None, '/', 1),
+    ('books_anonymous', None, '/books', 1),
+    ('books', 'user', '/books', 2),
+    ('books_search', 'user', '/books?query={word}', 3),
+    ('books_category', 'user', '/books?category={category_id}', 3),
+    ('admin_books', 'admin', '/admin/books', 1),
+    ('admin_users', 'admin', '/admin/users', 2),
+    ('admin_downloads', 'admin', '/admin/downloads', 1),
+    ('download', 'user', '/download/{book_id}', 1),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the catalog, admin and download pages.')
+    parser.add_argument('--scale', default='small', help='small, medium or full (100k books, 10M downloads)')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--only', action='append', help='run only these scenarios')
+    parser.add_argument('--seed-only', action='store_true', help='seed the database and stop')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--baseline', help='compare against an earlier --output file')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='allowed latency and size ratio against the baseline')
+    return parser.parse_args()
+
+
+def setup_environment(scale):
+    data_dir = os.path.join(ROOT, 'bench', '.data')
+    os.makedirs(data_dir, exist_ok=True)
+    os.environ.setdefault('APP_ENV', 'production')
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(data_dir, f'{scale}.db'))
+    os.environ.setdefault('STORAGE_LOCAL_ROOT', os.path.join(data_dir, 'objects'))
+    # Slow-request logging would swamp the report
+    os.environ.setdefault('SLOW_REQUEST_SECONDS', '0')
+    os.environ.setdefault('SLOW_REQUEST_QUERIES', '0')
+    sys.path.insert(0, ROOT)
+    os.chdir(data_dir)
+
+
+class StatementCounter:
+    """SQL statements executed by the current thread."""
+    def __init__(self):
+        self.local = threading.local()
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        # The periodic cache version checks fall on whichever request crosses
+        # their interval and are not part of any page's budget
+        if context is not None and context.execution_options.get('version_check'):
+            return
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def take(self):
+        count = getattr(self.local, 'count', 0)
+        self.local.count = 0
+        return count
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def make_client(app, user_id):
+    client = app.test_client()
+    if user_id is not None:
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+    return client
+
+
+def run_scenario(app, counter, path, user_id, params, requests, warmup, concurrency):
+    def send(client, rng):
+        url = path.format(**{name: rng.choice(values) for name, values in params.items()})
+        counter.take()
+        started = time.perf_counter()
+        response = client.get(url)
+        size = len(response.get_data())
+        response.close()
+        return time.perf_counter() - started, counter.take(), response.status_code, size
+
+    rng = random.Random(0)
+    client = make_client(app, user_id)
+    for _ in range(warmup):
+        send(client, rng)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = make_client(app, user_id)
+        return [send(client, rng) for _ in range(max(1, requests // concurrency))]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = [sample for result in pool.map(worker, range(1, concurrency + 1)) for sample in result]
+    wall = time.perf_counter() - started
+    latencies = [sample[0] for sample in samples]
+    return {
+        'requests': len(samples),
+        'rps': len(samples) / wall,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'queries': max(sample[1] for sample in samples),
+        'errors': sum(1 for sample in samples if sample[2] >= 400),
+        'kb': max(sample[3] for sample in samples) / 1024,
+    }
+
+
+def compare(name, result, baseline, tolerance):
+    problems = []
+    previous = baseline.get(name)
+    if not previous:
+        return problems
+    # Pages that grow with the data show up as bigger responses first
+    for key in ('p50_ms', 'p99_ms', 'kb'):
+        if key in previous and result[key] > previous[key] * tolerance:
+            problems.append(f"{key} {result[key]:.1f} vs {previous[key]:.1f} in the baseline")
+    if result['queries'] > previous['queries']:
+        problems.append(f"{result['queries']} queries vs {previous['queries']} in the baseline")
+    return problems
+
+
+def main():
+    args = parse_args()
+    setup_environment(args.scale)
+
+    from sqlalchemy import event, select
+    from sqlalchemy.engine import Engine
+    from main import app
+    from app import db
+    from models import User, Book, Category
+    import bootstrap
+    import dataset
+
+    with app.app_context():
+        bootstrap.init_db()
+        if not dataset.is_seeded():
+            print(f"Seeding the {args.scale} dataset into {app.config['SQLALCHEMY_DATABASE_URI']} ...")
+            started = time.perf_counter()
+            dataset.seed(**dataset.SCALES[args.scale])
+            print(f"Seeded in {time.perf_counter() - started:.0f}s")
+        if args.seed_only:
+            return
+        admin_id = db.session.execute(select(User.id).where(User.username == 'admin')).scalar()
+        user_id = db.session.execute(select(User.id).where(User.username == dataset.BENCH_USER)).scalar()
+        params = {
+            'book_id': db.session.execute(select(Book.id).order_by(Book.id).limit(5000)).scalars().all(),
+            'category_id': db.session.execute(select(Category.id)).scalars().all(),
+            'word': dataset.WORDS,
+        }
+    # No app context is held from here on: each request gets its own
+
+    counter = StatementCounter()
+    event.listen(Engine, 'before_cursor_execute', counter)
+    users = {None: None, 'user': user_id, 'admin': admin_id}
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)['results']
+
+    print(f"{'scenario':<18}{'req':>6}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'queries':>9}{'kb':>8}  result")
+    results = {}
+    failed = False
+    for name, who, path, budget in SCENARIOS:
+        if args.only and name not in args.only:
+            continue
+        result = run_scenario(app, counter, path, users[who], params,
+                              args.requests, args.warmup, args.concurrency)
+        results[name] = result
+        problems = compare(name, result, baseline, args.tolerance)
+        if result['queries'] > budget:
+            problems.append(f"{result['queries']} queries, budget is {budget}")
+        if result['errors']:
+            problems.append(f"{result['errors']} error responses")
+        failed = failed or bool(problems)
+        print(f"{name:<18}{result['requests']:>6}{result['rps']:>9.1f}{result['p50_ms']:>9.1f}"
+              f"{result['p99_ms']:>9.1f}{result['queries']:>9}{result['kb']:>8.0f}  {'; '.join(problems) or 'ok'}")
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump({'scale': args.scale, 'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0],
+                       'concurrency': args.concurrency, 'results': results}, handle, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+# Cold-start benchmark: `python bench/startup.py [--runs N] [--prepare]`.
+#
+# Each run starts a fresh interpreter that imports main (which creates the
+# app) and serves one request for / through the test client, so the numbers
+# cover everything a new worker or CLI invocation pays before its first
+# response. The database is set up once beforehand in a temporary
+# directory; --prepare also runs bootstrap.prepare() in every start, which is
+# what each start used to cost before init-db and seed were split out.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import sys, json, time
+started = time.perf_counter()
+from main import app
+imported = time.perf_counter()
+if {prepare}:
+    import bootstrap
+    bootstrap.prepare(app)
+prepared = time.perf_counter()
+status = app.test_client().get('/').status_code
+finished = time.perf_counter()
+print(json.dumps({{'status': status, 'import': imported - started,
+                  'prepare': prepared - imported, 'first_request': finished - prepared}}))
+"""
+
+SETUP = """
+from main import app
+import bootstrap
+bootstrap.prepare(app)
+"""
+
+
+def child_env(workdir):
+    env = dict(os.environ)
+    env.setdefault('APP_ENV', 'production')
+    env.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'startup.db'))
+    env['STORAGE_LOCAL_ROOT'] = os.path.join(workdir, 'objects')
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    return env
+
+
+def run_once(workdir, prepare):
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD.format(prepare=prepare)],
+                            cwd=workdir, env=child_env(workdir), check=True,
+                            capture_output=True, text=True).stdout
+    timings = json.loads(output.strip().splitlines()[-1])
+    timings['total'] = time.perf_counter() - started
+    return timings
+
+
+def report(results):
+    print(f"{'phase':<15}{'min':>10}{'median':>10}{'max':>10}   (ms)")
+    for phase in ('import', 'prepare', 'first_request', 'total'):
+        values = [r[phase] * 1000 for r in results]
+        print(f"{phase:<15}{min(values):>10.1f}{statistics.median(values):>10.1f}{max(values):>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold start to first response.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--prepare', action='store_true',
+                        help='run bootstrap.prepare() in every start')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        subprocess.run([sys.executable, '-c', SETUP], cwd=workdir, env=child_env(workdir),
+                       check=True, capture_output=True)
+        results = [run_once(workdir, args.prepare) for _ in range(args.runs)]
+
+    statuses = {r['status'] for r in results}
+    if statuses != {200}:
+        sys.exit(f'unexpected status codes: {sorted(statuses)}')
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
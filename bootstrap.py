@@ -0,0 +1,70 @@
+import logging
+from app import db
+
+# Database setup, run explicitly rather than on every app creation: the
+# init-db and seed commands, and the launchers (main.py, server.py) once per
+# start. Both steps are idempotent and need an app context.
+
+DEFAULT_CATEGORIES = [
+    ('Fiction', 'Novels, short stories, and other fictional works'),
+    ('Non-Fiction', 'Biographies, memoirs, and factual books'),
+    ('Science', 'Scientific research, textbooks, and journals'),
+    ('Technology', 'Computer science, programming, and tech guides'),
+    ('History', 'Historical accounts, documentaries, and archives'),
+    ('Education', 'Textbooks, learning materials, and academic resources'),
+    ('Business', 'Management, entrepreneurship, and business guides'),
+    ('Literature', 'Classic literature, poetry, and literary criticism')
+]
+
+def init_db():
+    """Create missing tables, apply migrations and build the search index."""
+    # Import models to ensure tables are created
+    import models
+    import migrations
+    db.create_all()
+    migrations.upgrade()
+    import retention
+    retention.ensure_partitions()
+
+    # Write out download events journaled by a process that stopped before flushing
+    from events import download_recorder
+    download_recorder.replay()
+
+    # Create the full-text search index and fill it for existing books
+    import search
+    if search.init_search_index():
+        indexed = search.rebuild_index()
+        logging.info(f"Search index created ({indexed} books indexed)")
+    # Page index for content search; `extract-book-text` fills it
+    search.init_content_index()
+
+def seed():
+    """Create the default admin user and categories when missing."""
+    from models import User, Category
+
+    admin = User.query.filter_by(username='admin').first()
+    if not admin:
+        admin = User(
+            username='admin',
+            email='admin@elibrary.com',
+            full_name='Administrator',
+            is_admin=True
+        )
+        admin.set_password('admin123')
+        db.session.add(admin)
+        db.session.commit()
+        logging.info("Default admin user created: admin/admin123")
+
+    # Create default categories
+    if Category.query.count() == 0:
+        for name, description in DEFAULT_CATEGORIES:
+            category = Category(name=name, description=description)
+            db.session.add(category)
+
+        db.session.commit()
+        logging.info("Default categories created")
+
+def prepare(app):
+    with app.app_context():
+        init_db()
+        seed()
@@ -0,0 +1,140 @@
+import time
+import pickle
+import threading
+from collections import OrderedDict
+
+# Shared cache used by the stats service and other read-mostly lookups.
+# The default backend is an in-process TTL/LRU dictionary; setting
+# CACHE_REDIS_URL switches to Redis so every worker sees the same entries.
+
+
+class MemoryCache:
+    def __init__(self, maxsize=1024, default_ttl=300):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def incr(self, key, amount=1):
+        # Only adjusts a value that is already cached; a missing key is
+        # recomputed by its reader
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            self._data[key] = (value + amount, expires)
+            return value + amount
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    def __init__(self, url, prefix='elibrary:', default_ttl=300):
+        import redis
+        self.redis = redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.default_ttl = default_ttl
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or None)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def incr(self, key, amount=1):
+        # Values are pickled, so increment with a check-and-set transaction
+        name = self.prefix + key
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(name)
+                    raw = pipe.get(name)
+                    if raw is None:
+                        pipe.unwatch()
+                        return None
+                    value = pickle.loads(raw) + amount
+                    pipe.multi()
+                    pipe.set(name, pickle.dumps(value), keepttl=True)
+                    pipe.execute()
+                    return value
+                except self.redis.WatchError:
+                    continue
+
+    def clear(self):
+        for name in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(name)
+
+
+class Cache:
+    def __init__(self, app=None):
+        self.backend = MemoryCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        ttl = app.config.get('CACHE_DEFAULT_TTL', 300)
+        if app.config.get('CACHE_REDIS_URL'):
+            self.backend = RedisCache(app.config['CACHE_REDIS_URL'], default_ttl=ttl)
+        else:
+            self.backend = MemoryCache(app.config.get('CACHE_MAX_ENTRIES', 1024), default_ttl=ttl)
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, ttl)
+
+    def delete(self, *keys):
+        self.backend.delete(*keys)
+
+    def incr(self, key, amount=1):
+        return self.backend.incr(key, amount)
+
+    def clear(self):
+        self.backend.clear()
+
+    def get_or_set(self, key, compute, ttl=None):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value, ttl)
+        return value
+
+
+cache = Cache()
@@ -0,0 +1,365 @@
+import io
+import os
+import csv
+import json
+import hashlib
+import logging
+import tempfile
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import select
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+from app import db
+from models import User, Book, Category, Download
+from forms import BOOK_EXTENSIONS, COVER_EXTENSIONS, TITLE_MAX_LENGTH, AUTHOR_MAX_LENGTH
+from storage import storage, object_key, after_commit
+import covers
+import search
+
+# Bulk catalog import and export for the flask CLI.
+#
+# Import reads a CSV or JSONL manifest, one book per row with the columns
+# title, author, description, category (name or id), file and cover (paths
+# relative to the files directory). Rows are checked against the BookForm
+# rules, book files and covers are hashed and staged by a thread pool, and
+# Book rows are inserted one batch per transaction; the staged files are put
+# in place once their batch commits and discarded if it fails. Invalid rows
+# are reported and skipped.
+#
+# Export streams books or downloads as CSV or JSONL with yield_per, so only
+# one batch of rows is in memory at a time. The iter_* generators produce the
+# same formats (and Parquet, when pyarrow is installed) as chunks for a
+# streamed HTTP response.
+
+READ_SIZE = 1024 * 1024
+
+BOOK_FIELDS = ['id', 'title', 'author', 'description', 'category', 'file', 'file_size',
+               'file_hash', 'cover', 'uploaded_at', 'uploaded_by', 'download_count']
+DOWNLOAD_FIELDS = ['id', 'downloaded_at', 'ip_address', 'user_id', 'username',
+                   'book_id', 'title', 'category']
+DOWNLOAD_PARQUET_TYPES = {
+    'id': 'int64', 'downloaded_at': 'timestamp[us]', 'ip_address': 'string',
+    'user_id': 'int64', 'username': 'string', 'book_id': 'int64',
+    'title': 'string', 'category': 'string',
+}
+
+
+def read_manifest(path):
+    """Yield (line_number, row) from a .csv or .jsonl manifest."""
+    with open(path, newline='', encoding='utf-8') as handle:
+        if path.lower().endswith(('.jsonl', '.ndjson')):
+            for number, line in enumerate(handle, 1):
+                if line.strip():
+                    yield number, json.loads(line)
+        else:
+            # Line 1 is the header
+            for number, row in enumerate(csv.DictReader(handle), 2):
+                yield number, row
+
+
+def _extension(filename):
+    return filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+
+
+class CategoryResolver:
+    def __init__(self, create_missing=False):
+        self.create_missing = create_missing
+        self.by_name = {c.name.lower(): c.id for c in Category.query.all()}
+        self.ids = set(self.by_name.values())
+
+    def resolve(self, value):
+        value = str(value or '').strip()
+        if value.isdigit() and int(value) in self.ids:
+            return int(value)
+        if value.lower() in self.by_name:
+            return self.by_name[value.lower()]
+        if self.create_missing and value:
+            category = Category(name=value)
+            db.session.add(category)
+            db.session.flush()
+            self.by_name[value.lower()] = category.id
+            self.ids.add(category.id)
+            return category.id
+        return None
+
+
+def validate_row(row, files_dir, resolver, max_size):
+    """Return (book_fields, errors) for one manifest row, using the BookForm rules."""
+    errors = []
+    title = str(row.get('title') or '').strip()
+    author = str(row.get('author') or '').strip()
+    if not title or len(title) > TITLE_MAX_LENGTH:
+        errors.append(f'title is required and at most {TITLE_MAX_LENGTH} characters')
+    if not author or len(author) > AUTHOR_MAX_LENGTH:
+        errors.append(f'author is required and at most {AUTHOR_MAX_LENGTH} characters')
+
+    category_id = resolver.resolve(row.get('category'))
+    if category_id is None:
+        errors.append(f"unknown category {row.get('category')!r}")
+
+    file_path = os.path.join(files_dir, str(row.get('file') or ''))
+    if not row.get('file') or not os.path.isfile(file_path):
+        errors.append(f"file {row.get('file')!r} not found")
+    elif _extension(file_path) not in BOOK_EXTENSIONS:
+        errors.append(f"file must be one of {', '.join(BOOK_EXTENSIONS)}")
+    elif os.path.getsize(file_path) > max_size:
+        errors.append('file is larger than the upload limit')
+
+    cover_path = None
+    if row.get('cover'):
+        cover_path = os.path.join(files_dir, str(row['cover']))
+        if not os.path.isfile(cover_path):
+            errors.append(f"cover {row['cover']!r} not found")
+        elif _extension(cover_path) not in COVER_EXTENSIONS:
+            errors.append(f"cover must be one of {', '.join(COVER_EXTENSIONS)}")
+
+    fields = {
+        'title': title,
+        'author': author,
+        'description': str(row.get('description') or ''),
+        'category_id': category_id,
+        'filename': secure_filename(os.path.basename(file_path)),
+        'file_path': file_path,
+        'cover_path': cover_path,
+    }
+    return fields, errors
+
+
+def _stage(file_path, cover_path, incoming_dir):
+    # Runs in a pool thread: hash and copy the book file next to the store,
+    # and stage the cover, without touching the database session. Both are
+    # put in place only once the batch commits
+    digest = hashlib.sha256()
+    handle, temp_path = tempfile.mkstemp(dir=incoming_dir, suffix='.upload')
+    with open(file_path, 'rb') as source, os.fdopen(handle, 'wb') as out:
+        for block in iter(lambda: source.read(READ_SIZE), b''):
+            digest.update(block)
+            out.write(block)
+    cover = None
+    if cover_path:
+        try:
+            with open(cover_path, 'rb') as source:
+                cover = covers.stage_cover(FileStorage(source, filename=os.path.basename(cover_path)))
+        except Exception:
+            os.remove(temp_path)
+            raise
+    return temp_path, digest.hexdigest(), os.path.getsize(temp_path), cover
+
+
+def _discard_staged(temp_path, digest, size, cover):
+    for path in (temp_path, cover and cover[1]):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+def _insert_batch(batch, staged, uploaded_by):
+    books = []
+    try:
+        for (number, fields), (temp_path, digest, size, cover) in zip(batch, staged):
+            storage.add(temp_path, digest)
+            if cover:
+                filename, cover_temp = cover
+                after_commit(partial(covers.place_cover, cover_temp, filename),
+                             partial(os.remove, cover_temp), f'cover {filename}')
+                cover = filename, covers.original_path(filename)
+            books.append(Book(
+                title=fields['title'],
+                author=fields['author'],
+                description=fields['description'],
+                category_id=fields['category_id'],
+                filename=fields['filename'],
+                file_path=object_key(digest),
+                file_size=size,
+                file_hash=digest,
+                cover_image=cover[0] if cover else None,
+                cover_path=cover[1] if cover else None,
+                uploaded_by=uploaded_by,
+            ))
+        db.session.add_all(books)
+        db.session.flush()
+        for book in books:
+            search.index_book(book)
+        db.session.commit()
+    except Exception:
+        # The rollback discards the files queued so far, this leaves none behind
+        db.session.rollback()
+        for item in staged[len(books):]:
+            _discard_staged(*item)
+        raise
+    return books
+
+
+def import_books(manifest, files_dir, uploaded_by, batch_size=500, workers=4,
+                 create_categories=False, dry_run=False, max_size=None):
+    """Import a manifest; returns (imported, errors) with errors as (line, message)."""
+    resolver = CategoryResolver(create_categories)
+    max_size = max_size or float('inf')
+    imported = 0
+    errors = []
+    batch = []
+
+    def flush(pool):
+        nonlocal imported
+        incoming_dir = storage.incoming_dir()
+        futures = [pool.submit(_stage, fields['file_path'], fields['cover_path'], incoming_dir)
+                   for _, fields in batch]
+        try:
+            staged = [future.result() for future in futures]
+        except Exception:
+            for future in futures:
+                if future.exception() is None:
+                    _discard_staged(*future.result())
+            raise
+        books = _insert_batch(batch, staged, uploaded_by)
+        for book in books:
+            if book.cover_image:
+                covers.process_cover(book.cover_image)
+        imported += len(books)
+        logging.info(f"Imported {imported} books")
+        batch.clear()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for number, row in read_manifest(manifest):
+            fields, row_errors = validate_row(row, files_dir, resolver, max_size)
+            if row_errors:
+                errors.extend((number, message) for message in row_errors)
+                continue
+            if dry_run:
+                imported += 1
+                continue
+            batch.append((number, fields))
+            if len(batch) >= batch_size:
+                flush(pool)
+        if batch:
+            flush(pool)
+
+    if dry_run:
+        # New categories were only needed to check the rows
+        db.session.rollback()
+    else:
+        db.session.commit()
+    return imported, errors
+
+
+def book_rows():
+    statement = (
+        select(Book.id, Book.title, Book.author, Book.description,
+               Category.name.label('category'), Book.filename.label('file'),
+               Book.file_size, Book.file_hash, Book.cover_image.label('cover'),
+               Book.uploaded_at, User.username.label('uploaded_by'), Book.download_count)
+        .join(Category, Book.category_id == Category.id)
+        .join(User, Book.uploaded_by == User.id)
+        .order_by(Book.id)
+        .execution_options(yield_per=1000, allow_table_scan=True)
+    )
+    for row in db.session.execute(statement):
+        yield row._asdict()
+
+
+def download_rows(start=None, end=None, category_id=None):
+    statement = (
+        select(Download.id, Download.downloaded_at, Download.ip_address,
+               Download.user_id, User.username, Download.book_id,
+               Book.title, Category.name.label('category'))
+        .join(User, Download.user_id == User.id)
+        .join(Book, Download.book_id == Book.id)
+        .join(Category, Book.category_id == Category.id)
+        .order_by(Download.downloaded_at, Download.id)
+        .execution_options(yield_per=1000, allow_table_scan=True)
+    )
+    if start:
+        statement = statement.where(Download.downloaded_at >= start)
+    if end:
+        statement = statement.where(Download.downloaded_at < end)
+    if category_id:
+        statement = statement.where(Book.category_id == category_id)
+    for row in db.session.execute(statement):
+        yield row._asdict()
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def write_rows(rows, handle, fields, fmt):
+    """Write dict rows to a text handle as csv or jsonl; returns the row count."""
+    count = 0
+    if fmt == 'csv':
+        writer = csv.DictWriter(handle, fieldnames=fields)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            handle.write(json.dumps(row, default=_json_default) + '\n')
+            count += 1
+    return count
+
+
+def iter_csv(rows, fields, chunk_rows=1000):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class _ChunkSink(io.RawIOBase):
+    # Write-only file for ParquetWriter whose contents are handed out as they arrive
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_parquet(rows, types, row_group_size=50000):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([(name, pa.type_for_alias(alias)) for name, alias in types.items()])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= row_group_size:
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+            batch = []
+            yield sink.drain()
+    if batch:
+        writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+    # Closing writes the footer
+    writer.close()
+    yield sink.drain()
@@ -0,0 +1,47 @@
+import time
+import threading
+from collections import namedtuple
+from flask import current_app, g
+from models import Category
+import versions
+
+# Category list shared by the forms and pages. Each worker keeps one copy
+# stamped with the 'categories' version; the stamp is re-read from the
+# database at most every CATEGORY_CACHE_CHECK_INTERVAL seconds, and within a
+# request the list is resolved once. Admin writes call invalidate(), which
+# bumps the version so the other workers reload on their next check.
+
+CachedCategory = namedtuple('CachedCategory', 'id name description created_at')
+
+VERSION_NAME = 'categories'
+
+_lock = threading.Lock()
+_state = {'version': None, 'checked_at': 0.0, 'categories': []}
+
+def _load():
+    return [CachedCategory(c.id, c.name, c.description, c.created_at)
+            for c in Category.query.order_by(Category.name).all()]
+
+def all_categories():
+    if 'categories' in g:
+        return g.categories
+    interval = current_app.config.get('CATEGORY_CACHE_CHECK_INTERVAL', 5)
+    now = time.monotonic()
+    with _lock:
+        if _state['version'] is None or now - _state['checked_at'] >= interval:
+            version = versions.get_version(VERSION_NAME)
+            if version != _state['version']:
+                _state['categories'] = _load()
+                _state['version'] = version
+            _state['checked_at'] = now
+        g.categories = _state['categories']
+    return g.categories
+
+def choices():
+    return [(c.id, c.name) for c in all_categories()]
+
+def invalidate():
+    versions.bump_version(VERSION_NAME)
+    with _lock:
+        _state['version'] = None
+    g.pop('categories', None)
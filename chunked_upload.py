@@ -0,0 +1,181 @@
+import os
+import fcntl
+import uuid
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.utils import secure_filename
+from app import db
+from models import BookUpload
+from storage import storage
+
+# Resumable book uploads. The browser announces a file's name and size, then
+# sends it in chunks with PATCH requests whose Upload-Offset header says
+# where each chunk starts (as in the tus protocol). Chunks are streamed
+# straight into a partial file beside the book store and the SHA-256 is
+# updated as they arrive; HEAD reports how many bytes are stored, so an
+# interrupted upload continues from there. Only when the last byte is in is
+# the file handed to the content-addressed store and the Book row created by
+# the caller. Completing first renames the partial file to a claimed name, so
+# of two requests completing the same upload only one goes on.
+
+READ_SIZE = 1024 * 1024
+
+# In-progress digests, keyed by upload id. A chunk handled by another worker
+# (or after a restart) rebuilds the digest from the bytes already on disk.
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def partial_path(upload_id):
+    return os.path.join(storage.incoming_dir(), f'{upload_id}.part')
+
+
+def claimed_path(upload_id):
+    return os.path.join(storage.incoming_dir(), f'{upload_id}.completing')
+
+
+def create_upload(user_id, filename, total_size, allowed_extensions, max_size):
+    filename = secure_filename(filename or '')
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if extension not in allowed_extensions:
+        raise UploadError(f"Only {', '.join(e.upper() for e in allowed_extensions)} files are allowed!")
+    if total_size is None or total_size <= 0:
+        raise UploadError('The file size must be a positive number of bytes.')
+    if total_size > max_size:
+        raise UploadError(f'File is larger than the {max_size // (1024 * 1024)}MB limit.', 413)
+
+    upload = BookUpload(id=uuid.uuid4().hex, user_id=user_id, filename=filename,
+                        total_size=total_size)
+    open(partial_path(upload.id), 'wb').close()
+    db.session.add(upload)
+    db.session.commit()
+    return upload
+
+
+def get_upload(upload_id, user_id):
+    upload = db.session.get(BookUpload, upload_id)
+    if upload is None or upload.user_id != user_id:
+        raise UploadError('Upload not found.', 404)
+    return upload
+
+
+def _hasher(upload_id, offset, handle):
+    with _hashers_lock:
+        entry = _hashers.pop(upload_id, None)
+    if entry and entry[0] == offset:
+        return entry[1]
+    hasher = hashlib.sha256()
+    handle.seek(0)
+    remaining = offset
+    while remaining:
+        block = handle.read(min(READ_SIZE, remaining))
+        if not block:
+            break
+        hasher.update(block)
+        remaining -= len(block)
+    return hasher
+
+
+def append_chunk(upload, offset, stream, length=None):
+    """Write a chunk starting at offset; returns the new offset."""
+    if offset != upload.received:
+        raise UploadError(f'Upload is at offset {upload.received}.', 409)
+    remaining = upload.total_size - offset
+    if length is not None and length > remaining:
+        raise UploadError('Chunk runs past the declared upload length.', 413)
+    remaining = remaining if length is None else length
+
+    with open(partial_path(upload.id), 'r+b') as handle:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError('Another chunk of this upload is being written.', 409)
+        # The row may have moved on while waiting for the request body
+        db.session.refresh(upload)
+        if offset != upload.received:
+            raise UploadError(f'Upload is at offset {upload.received}.', 409)
+
+        hasher = _hasher(upload.id, offset, handle)
+        handle.seek(offset)
+        written = 0
+        try:
+            while written < remaining:
+                block = stream.read(min(READ_SIZE, remaining - written))
+                if not block:
+                    break
+                handle.write(block)
+                hasher.update(block)
+                written += len(block)
+        except ClientDisconnected:
+            # Keep what arrived; the client resumes from the stored offset
+            logging.info(f"Upload {upload.id} interrupted at {offset + written} bytes")
+        handle.truncate()
+        handle.flush()
+
+    upload.received = offset + written
+    upload.updated_at = datetime.utcnow()
+    db.session.commit()
+    with _hashers_lock:
+        _hashers[upload.id] = (upload.received, hasher)
+    return upload.received
+
+
+def complete_upload(upload):
+    """Hand a fully received upload to the book store; returns (filename, key, size, sha256).
+
+    The upload row is removed in the current transaction, which the caller
+    commits together with the new Book.
+    """
+    if upload.received != upload.total_size:
+        raise UploadError(f'Upload is incomplete ({upload.received} of {upload.total_size} bytes).', 409)
+    claimed = claimed_path(upload.id)
+    try:
+        os.rename(partial_path(upload.id), claimed)
+    except FileNotFoundError:
+        raise UploadError('This upload is already being completed.', 409)
+    try:
+        with open(claimed, 'rb') as handle:
+            digest = _hasher(upload.id, upload.received, handle).hexdigest()
+        # The partial file sits beside the local store: a rename, not a copy.
+        # A rolled-back completion hands the file back to the upload
+        key = storage.add(claimed, digest, rollback_path=partial_path(upload.id))
+    except Exception:
+        if os.path.exists(claimed):
+            os.rename(claimed, partial_path(upload.id))
+        raise
+    db.session.delete(upload)
+    return upload.filename, key, upload.total_size, digest
+
+
+def cancel_upload(upload):
+    with _hashers_lock:
+        _hashers.pop(upload.id, None)
+    if os.path.exists(partial_path(upload.id)):
+        os.remove(partial_path(upload.id))
+    db.session.delete(upload)
+    db.session.commit()
+
+
+def cancel_user_uploads(user_id):
+    for upload in BookUpload.query.filter_by(user_id=user_id).all():
+        cancel_upload(upload)
+
+
+def purge_stale_uploads(max_age=timedelta(days=1)):
+    cutoff = datetime.utcnow() - max_age
+    stale = BookUpload.query.filter(BookUpload.updated_at < cutoff).all()
+    for upload in stale:
+        # Left claimed by a worker that died while completing it
+        if os.path.exists(claimed_path(upload.id)):
+            os.remove(claimed_path(upload.id))
+        cancel_upload(upload)
+    return len(stale)
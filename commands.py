@@ -0,0 +1,211 @@
+import os
+import click
+from werkzeug.datastructures import FileStorage
+from flask import current_app
+from flask.cli import AppGroup
+import search
+import counters
+import stats
+
+# Commands are collected here and added to app.cli by create_app()
+cli = AppGroup('elibrary')
+
+def init_app(app):
+    for command in cli.commands.values():
+        app.cli.add_command(command)
+
+@cli.command('init-db')
+def init_db():
+    """Create tables, apply schema migrations and build the search index."""
+    import bootstrap
+    bootstrap.init_db()
+    click.echo('Database is up to date.')
+
+@cli.command('seed')
+def seed():
+    """Create the default admin user and categories if they are missing."""
+    import bootstrap
+    bootstrap.seed()
+    click.echo('Seed data is in place.')
+
+@cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Rebuild the full-text search index from the books table."""
+    count = search.rebuild_index()
+    click.echo(f'Indexed {count} books.')
+
+@cli.command('reconcile-download-counts')
+def reconcile_download_counts():
+    """Recompute book and user download counters from the downloads table."""
+    counters.reconcile_download_counts()
+    click.echo('Download counters reconciled.')
+
+@cli.command('compact-downloads')
+@click.option('--retention-days', type=int, help='Days of download events to keep (default DOWNLOAD_RETENTION_DAYS).')
+@click.option('--archive/--no-archive', default=None, help='Keep compacted events in archive tables (default DOWNLOAD_ARCHIVE).')
+def compact_downloads(retention_days, archive):
+    """Fold old download events into daily per-user totals and remove them."""
+    import retention
+    summary = retention.compact(retention_days=retention_days, archive=archive)
+    click.echo(f"Compacted {summary['events']} download events from {summary['months']} months, "
+               f"merged {summary['merged']} older history rows.")
+
+@cli.command('rebuild-download-rollups')
+def rebuild_download_rollups():
+    """Recompute the daily per-book download rollups from the downloads table."""
+    count = stats.rebuild_rollups()
+    click.echo(f'Rebuilt {count} daily rollup rows.')
+
+@cli.command('check-query-plans')
+def check_query_plans():
+    """EXPLAIN every page's queries and fail on full scans of large tables."""
+    import query_plans
+    violations = query_plans.check_routes(current_app._get_current_object())
+    for url, table, statement in violations:
+        click.echo(f'{url}: full scan of {table}\n    {" ".join(statement.split())}\n')
+    if violations:
+        raise SystemExit(1)
+    click.echo('No full table scans found.')
+
+@cli.command('process-covers')
+def process_covers():
+    """Move legacy covers into the content-addressed store and render all variants."""
+    import covers
+    from app import db
+    from models import Book
+    futures = []
+    for book in Book.query.filter(Book.cover_image.isnot(None)).all():
+        if not covers.DIGEST_NAME_RE.match(book.cover_image):
+            path = covers.original_path(book.cover_image)
+            if not os.path.exists(path):
+                click.echo(f'Missing cover for book {book.id}: {path}')
+                continue
+            with open(path, 'rb') as source:
+                book.cover_image, book.cover_path = covers.store_cover(
+                    FileStorage(source, filename=book.cover_image))
+            db.session.commit()
+            os.remove(path)
+        futures.append(covers.process_cover(book.cover_image))
+    for future in futures:
+        future.result()
+    click.echo(f'Processed {len(futures)} covers.')
+
+@cli.command('purge-stale-uploads')
+@click.option('--hours', default=24, show_default=True, help='Age of the last received chunk.')
+def purge_stale_uploads(hours):
+    """Delete chunked uploads that have not progressed for a while."""
+    from datetime import timedelta
+    import chunked_upload
+    purged = chunked_upload.purge_stale_uploads(timedelta(hours=hours))
+    click.echo(f'Purged {purged} stale uploads.')
+
+@cli.command('migrate-book-storage')
+def migrate_book_storage():
+    """Move book files uploaded before content addressing into the book store."""
+    import hashlib
+    import tempfile
+    import transfers
+    from app import db
+    from models import Book
+    from storage import storage
+    moved = 0
+    for book in Book.query.filter(Book.file_hash.is_(None)).all():
+        old_path = book.file_path
+        path = transfers.book_file_path(book)
+        if not os.path.exists(path):
+            click.echo(f'Missing file for book {book.id}: {path}')
+            continue
+        # Copy first: several books may share the old path
+        digest = hashlib.sha256()
+        handle, temp_path = tempfile.mkstemp(dir=storage.incoming_dir(), suffix='.upload')
+        with open(path, 'rb') as source, os.fdopen(handle, 'wb') as out:
+            for block in iter(lambda: source.read(1024 * 1024), b''):
+                digest.update(block)
+                out.write(block)
+        book.file_hash = digest.hexdigest()
+        book.file_path = storage.add(temp_path, book.file_hash)
+        book.file_size = os.path.getsize(path)
+        db.session.commit()
+        if not Book.query.filter(Book.file_hash.is_(None), Book.file_path == old_path).first():
+            os.remove(path)
+        moved += 1
+    click.echo(f'Moved {moved} book files.')
+
+@cli.command('import-books')
+@click.argument('manifest', type=click.Path(exists=True, dir_okay=False))
+@click.argument('files_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('--uploader', default='admin', show_default=True, help='Username recorded as the uploader.')
+@click.option('--batch-size', default=500, show_default=True, help='Books inserted per transaction.')
+@click.option('--workers', default=4, show_default=True, help='Threads copying files into the store.')
+@click.option('--create-categories', is_flag=True, help='Create categories the manifest names but the catalog lacks.')
+@click.option('--dry-run', is_flag=True, help='Only validate the manifest.')
+def import_books(manifest, files_dir, uploader, batch_size, workers, create_categories, dry_run):
+    """Import books listed in a CSV or JSONL manifest from FILES_DIR."""
+    import catalog_io
+    import stats
+    import page_cache
+    from models import User
+    user = User.query.filter_by(username=uploader).first()
+    if user is None:
+        raise click.ClickException(f'No user named {uploader!r}')
+    imported, errors = catalog_io.import_books(
+        manifest, files_dir, user.id, batch_size=batch_size, workers=workers,
+        create_categories=create_categories, dry_run=dry_run,
+        max_size=current_app.config['BOOK_UPLOAD_MAX_SIZE'])
+    for line, message in errors:
+        click.echo(f'line {line}: {message}', err=True)
+    if imported and not dry_run:
+        stats.books_changed()
+        page_cache.invalidate()
+        if create_categories:
+            import categories
+            categories.invalidate()
+    verb = 'Validated' if dry_run else 'Imported'
+    click.echo(f'{verb} {imported} books, {len(errors)} errors.')
+    if errors:
+        raise SystemExit(1)
+
+@cli.command('export-catalog')
+@click.argument('table', type=click.Choice(['books', 'downloads']))
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']), default='jsonl', show_default=True)
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-', help='File to write (default stdout).')
+def export_catalog(table, fmt, output):
+    """Stream all books or downloads as JSONL or CSV."""
+    import catalog_io
+    if table == 'books':
+        rows, fields = catalog_io.book_rows(), catalog_io.BOOK_FIELDS
+    else:
+        rows, fields = catalog_io.download_rows(), catalog_io.DOWNLOAD_FIELDS
+    count = catalog_io.write_rows(rows, output, fields, fmt)
+    click.echo(f'Exported {count} {table}.', err=True)
+
+@cli.command('extract-book-text')
+@click.option('--retry-failed', is_flag=True, help='Also retry books whose extraction failed.')
+@click.option('--all', 'everything', is_flag=True, help='Extract every book again.')
+@click.option('--workers', default=None, type=int, help='Books extracted at once (default TEXT_EXTRACT_WORKERS).')
+def extract_book_text(retry_failed, everything, workers):
+    """Extract and index the text of books that have none yet."""
+    from sqlalchemy import select
+    import fulltext
+    from app import db
+    from models import Book, BookText
+    workers = workers or current_app.config['TEXT_EXTRACT_WORKERS']
+    query = select(Book.id).outerjoin(BookText, BookText.book_id == Book.id).order_by(Book.id)
+    if not everything:
+        statuses = ['pending', 'failed'] if retry_failed else ['pending']
+        query = query.where(BookText.book_id.is_(None) | BookText.status.in_(statuses))
+    book_ids = db.session.execute(query.execution_options(allow_table_scan=True)).scalars().all()
+    outcomes = fulltext.extract_books(book_ids, workers)
+    summary = ', '.join(f'{count} {status}' for status, count in sorted(outcomes.items())) or 'nothing to do'
+    click.echo(f'Extracted text of {len(book_ids)} books: {summary}.')
+
+@cli.command('build-recommendations')
+@click.option('--top-k', default=10, show_default=True, help='Recommendations kept per book.')
+@click.option('--max-user-books', default=500, show_default=True,
+              help='Leave out readers who downloaded more books than this.')
+@click.option('--min-shared', default=2, show_default=True, help='Readers two books must share.')
+def build_recommendations(top_k, max_user_books, min_shared):
+    """Recompute "readers also downloaded" from the downloads table."""
+    import recommendations
+    count = recommendations.build(top_k, max_user_books, min_shared)
+    click.echo(f'Recommendations built for {count} books.')
@@ -0,0 +1,127 @@
+import os
+
+# Application settings per environment, chosen with APP_ENV (development,
+# production or testing). Values come from environment variables where a
+# deployment is expected to change them.
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+def engine_options(database_uri, pool_size, max_overflow, pool_timeout=30):
+    """SQLALCHEMY_ENGINE_OPTIONS for the configured database."""
+    options = {
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+    }
+    if database_uri.startswith("sqlite"):
+        # One writer at a time: waiting on the lock beats "database is locked"
+        options["connect_args"] = {"timeout": _env_int("SQLITE_BUSY_TIMEOUT", 5000) / 1000}
+    else:
+        options.update(pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout)
+    return options
+
+
+class Config:
+    SECRET_KEY = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "sqlite:///elibrary.db")
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI,
+                                               _env_int("DB_POOL_SIZE", 5),
+                                               _env_int("DB_MAX_OVERFLOW", 10))
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # SQLite journal mode; WAL lets readers work while a write is in progress
+    SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+    UPLOAD_FOLDER = "uploads"
+    MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50MB max request size
+    # Larger books are sent by the add-book page in resumable chunks
+    BOOK_UPLOAD_MAX_SIZE = _env_int("BOOK_UPLOAD_MAX_SIZE", 2 * 1024 * 1024 * 1024)
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+    # Book downloads: "x-accel-redirect" (nginx) or "x-sendfile" hands the transfer to the proxy
+    DOWNLOAD_OFFLOAD = os.environ.get("DOWNLOAD_OFFLOAD", "").lower() or None
+    DOWNLOAD_ACCEL_PREFIX = os.environ.get("DOWNLOAD_ACCEL_PREFIX", "/protected-uploads/")
+    # Download events are buffered and written in batches by a background thread
+    DOWNLOAD_EVENTS_ASYNC = os.environ.get("DOWNLOAD_EVENTS_ASYNC", "1") != "0"
+    DOWNLOAD_EVENTS_BATCH_SIZE = _env_int("DOWNLOAD_EVENTS_BATCH_SIZE", 500)
+    DOWNLOAD_EVENTS_FLUSH_INTERVAL = float(os.environ.get("DOWNLOAD_EVENTS_FLUSH_INTERVAL", 2.0))
+    # Download events older than this many days are folded into daily per-user
+    # totals by `flask compact-downloads` (0 keeps every event)
+    DOWNLOAD_RETENTION_DAYS = _env_int("DOWNLOAD_RETENTION_DAYS", 365)
+    # Folded totals older than this many days are merged into one row per user
+    # and book (0 keeps the daily rows)
+    DOWNLOAD_DAILY_HISTORY_DAYS = _env_int("DOWNLOAD_DAILY_HISTORY_DAYS", 730)
+    # Keep compacted events in archive tables/files instead of dropping them
+    DOWNLOAD_ARCHIVE = os.environ.get("DOWNLOAD_ARCHIVE", "0") != "0"
+    # Monthly partitions of the downloads table created ahead (PostgreSQL)
+    DOWNLOAD_PARTITIONS_AHEAD = _env_int("DOWNLOAD_PARTITIONS_AHEAD", 3)
+    # Book file storage: "local" (content-addressed under STORAGE_LOCAL_ROOT) or "s3"
+    STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local").lower()
+    STORAGE_LOCAL_ROOT = os.environ.get("STORAGE_LOCAL_ROOT", os.path.join("uploads", "objects"))
+    S3_BUCKET = os.environ.get("S3_BUCKET")
+    S3_PREFIX = os.environ.get("S3_PREFIX", "books")
+    S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+    S3_REGION = os.environ.get("S3_REGION")
+    # CPUs for background work (cover thumbnails, text extraction), split
+    # between the WEB_CONCURRENCY worker processes (set by server.py)
+    BACKGROUND_CPUS = _env_int("BACKGROUND_CPUS", os.cpu_count() or 1)
+    WEB_CONCURRENCY = _env_int("WEB_CONCURRENCY", 1)
+    # Password hashing: werkzeug method ("scrypt" or e.g. "pbkdf2:sha256:1000000");
+    # older hashes are upgraded at login. Threads doing the hashing, requests
+    # allowed to queue for them, and seconds a request waits before a 503
+    PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+    PASSWORD_HASH_WORKERS = _env_int("PASSWORD_HASH_WORKERS", 2)
+    PASSWORD_HASH_QUEUE = _env_int("PASSWORD_HASH_QUEUE", 16)
+    PASSWORD_HASH_WAIT = float(os.environ.get("PASSWORD_HASH_WAIT", 2.0))
+    # Failed logins allowed per client address, and per username from one
+    # address, within LOGIN_THROTTLE_WINDOW seconds (0 turns throttling off)
+    LOGIN_THROTTLE_WINDOW = _env_int("LOGIN_THROTTLE_WINDOW", 300)
+    LOGIN_MAX_FAILURES_PER_IP = _env_int("LOGIN_MAX_FAILURES_PER_IP", 20)
+    LOGIN_MAX_FAILURES_PER_USERNAME = _env_int("LOGIN_MAX_FAILURES_PER_USERNAME", 5)
+    # Books whose text is extracted at once for content search
+    TEXT_EXTRACT_WORKERS = _env_int("TEXT_EXTRACT_WORKERS", 2)
+    # Seconds an anonymous catalog page stays cached (0 disables the page cache)
+    PAGE_CACHE_TTL = _env_int("PAGE_CACHE_TTL", 60)
+    # Shared cache: in-process by default, Redis when CACHE_REDIS_URL is set
+    CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL")
+    # Seconds a signed-in user's identity is cached (0 loads it on every request)
+    USER_CACHE_TTL = _env_int("USER_CACHE_TTL", 300)
+    # Login times are written in batches this often (0 writes at login)
+    LAST_LOGIN_FLUSH_INTERVAL = float(os.environ.get("LAST_LOGIN_FLUSH_INTERVAL", 30))
+    # Per-route latency and query histograms at /metrics (admins, or a bearer METRICS_TOKEN)
+    METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+    # Requests over either limit are logged with their SQL
+    SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 1.0))
+    SLOW_REQUEST_QUERIES = _env_int("SLOW_REQUEST_QUERIES", 50)
+    # Share of requests profiled into instance/profiles (cprofile or pyinstrument)
+    PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+    PROFILER = os.environ.get("PROFILER", "cprofile").lower()
+
+
+class DevelopmentConfig(Config):
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG").upper()
+
+
+class ProductionConfig(Config):
+    # Each worker process has its own pool; size it for the worker's threads
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(Config.SQLALCHEMY_DATABASE_URI,
+                                               _env_int("DB_POOL_SIZE", 10),
+                                               _env_int("DB_MAX_OVERFLOW", 20))
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get("TEST_DATABASE_URL", "sqlite://")
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI, 5, 10)
+    WTF_CSRF_ENABLED = False
+    DOWNLOAD_EVENTS_ASYNC = False
+    LAST_LOGIN_FLUSH_INTERVAL = 0
+    LOGIN_THROTTLE_WINDOW = 0
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "WARNING").upper()
+
+
+CONFIGS = {
+    "development": DevelopmentConfig,
+    "production": ProductionConfig,
+    "testing": TestingConfig,
+}
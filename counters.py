@@ -0,0 +1,58 @@
+from collections import Counter
+from sqlalchemy import update, select, func, bindparam, delete
+from app import db
+from models import Book, User, Download, CompactedDownload
+
+# Denormalized download counters on books and users. They are adjusted in
+# the same transaction as the downloads they describe, and can always be
+# rebuilt from the downloads table, plus the events retention.compact() has
+# folded into compacted_downloads, with reconcile_download_counts().
+
+def record_downloads(downloads):
+    # One executemany per table for a batch of new downloads
+    for model, key in ((Book, 'book_id'), (User, 'user_id')):
+        table = model.__table__
+        amounts = Counter(download[key] for download in downloads)
+        if not amounts:
+            continue
+        db.session.connection().execute(
+            update(table).where(table.c.id == bindparam('target_id'))
+            .values(download_count=table.c.download_count + bindparam('amount')),
+            [{'target_id': target_id, 'amount': amount} for target_id, amount in amounts.items()]
+        )
+
+def forget_book_downloads(book_id):
+    # The book's downloads are removed with it, so take them off each user's total
+    per_user = Counter(dict(db.session.execute(
+        select(Download.user_id, func.count())
+        .where(Download.book_id == book_id)
+        .group_by(Download.user_id)
+    ).all()))
+    per_user.update(dict(db.session.execute(
+        select(CompactedDownload.user_id, func.sum(CompactedDownload.download_count))
+        .where(CompactedDownload.book_id == book_id)
+        .group_by(CompactedDownload.user_id)
+    ).all()))
+    for user_id, count in per_user.items():
+        db.session.execute(
+            update(User).where(User.id == user_id)
+            .values(download_count=User.download_count - count)
+        )
+    db.session.execute(delete(CompactedDownload).where(CompactedDownload.book_id == book_id))
+
+def _compacted(key, column):
+    return (select(func.coalesce(func.sum(CompactedDownload.download_count), 0))
+            .where(key == column).scalar_subquery())
+
+def reconcile_download_counts():
+    db.session.execute(
+        update(Book).values(download_count=select(func.count(Download.id))
+                            .where(Download.book_id == Book.id)
+                            .scalar_subquery() + _compacted(CompactedDownload.book_id, Book.id))
+    )
+    db.session.execute(
+        update(User).values(download_count=select(func.count(Download.id))
+                            .where(Download.user_id == User.id)
+                            .scalar_subquery() + _compacted(CompactedDownload.user_id, User.id))
+    )
+    db.session.commit()
@@ -0,0 +1,189 @@
+import os
+import re
+import hashlib
+import logging
+import tempfile
+from PIL import Image, ImageOps, features
+import background
+
+# Cover images. Uploads are stored once under their SHA-256 digest
+# (covers/ab/abcd...ef.png) and the background process pool renders
+# fixed-width thumbnails next to the original in WebP, AVIF (when Pillow
+# supports it) and JPEG. The /covers/<filename> route then serves the
+# smallest variant wide enough for the requested width in the best format the
+# browser accepts, falling back to the original while variants are still
+# being produced.
+#
+# The worker function only touches the filesystem, so this module must not
+# import the application: pool processes import it on start. A cover deleted
+# while its variants render is noticed by the worker, which checks after
+# every file it writes that the original is still there: remove_cover()
+# deletes the original first, so either it or the worker removes each variant.
+
+COVERS_DIR = 'covers'
+WIDTHS = (320, 640)
+FORMATS = {
+    'avif': ('AVIF', {'quality': 50}),
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+DIGEST_NAME_RE = re.compile(r'^([0-9a-f]{64})\.(\w+)$')
+
+
+def covers_dir():
+    return os.path.join(os.getcwd(), COVERS_DIR)
+
+
+def _shard_dir(digest):
+    return os.path.join(covers_dir(), digest[:2])
+
+
+def original_path(filename):
+    match = DIGEST_NAME_RE.match(filename)
+    if match:
+        return os.path.join(_shard_dir(match.group(1)), filename)
+    # Covers uploaded before content addressing live directly in covers/
+    return os.path.join(covers_dir(), filename)
+
+
+def variant_path(digest, width, extension):
+    return os.path.join(_shard_dir(digest), f'{digest}-{width}.{extension}')
+
+
+def available_formats():
+    return [ext for ext, (fmt, _) in FORMATS.items()
+            if fmt == 'JPEG' or features.check(fmt.lower())]
+
+
+def stage_cover(file_storage):
+    """Write an uploaded cover to a temporary file; returns (filename, temp_path)."""
+    extension = os.path.splitext(file_storage.filename)[1].lower().lstrip('.') or 'img'
+    os.makedirs(covers_dir(), exist_ok=True)
+    digest = hashlib.sha256()
+    handle, temp_path = tempfile.mkstemp(dir=covers_dir(), suffix='.upload')
+    try:
+        with os.fdopen(handle, 'wb') as out:
+            while True:
+                chunk = file_storage.stream.read(64 * 1024)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return f'{digest.hexdigest()}.{extension}', temp_path
+
+
+def place_cover(temp_path, filename):
+    """Move a staged cover under its digest, unless that content is stored already."""
+    path = original_path(filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, path)
+    return path
+
+
+def store_cover(file_storage):
+    """Save an uploaded cover under its content digest; returns (filename, path)."""
+    filename, temp_path = stage_cover(file_storage)
+    try:
+        return filename, place_cover(temp_path, filename)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _variant_paths(digest):
+    return [variant_path(digest, width, extension) for width in WIDTHS for extension in FORMATS]
+
+
+def _remove(paths):
+    # A worker and remove_cover() can both be removing the same files
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def render_variants(source, digest, widths=WIDTHS, extensions=None):
+    # Runs in a pool process
+    extensions = extensions or available_formats()
+    try:
+        with Image.open(source) as image:
+            image = ImageOps.exif_transpose(image)
+            image.load()
+    except FileNotFoundError:
+        # Removed before its turn came
+        return None
+    for width in widths:
+        thumbnail = image.copy()
+        thumbnail.thumbnail((width, width * 3), Image.LANCZOS)
+        for extension in extensions:
+            fmt, options = FORMATS[extension]
+            frame = thumbnail
+            if fmt == 'JPEG' and frame.mode not in ('RGB', 'L'):
+                frame = frame.convert('RGBA')
+                backdrop = Image.new('RGB', frame.size, (255, 255, 255))
+                backdrop.paste(frame, mask=frame.getchannel('A'))
+                frame = backdrop
+            elif frame.mode not in ('RGB', 'RGBA', 'L'):
+                frame = frame.convert('RGBA')
+            target = variant_path(digest, width, extension)
+            if os.path.exists(target):
+                continue
+            # Identical uploads can be processed twice at once
+            partial = f'{target}.{os.getpid()}.part'
+            frame.save(partial, fmt, **options)
+            os.replace(partial, target)
+            if not os.path.exists(source):
+                _remove(_variant_paths(digest))
+                return None
+    return digest
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logging.error(f"Cover processing failed: {future.exception()}")
+
+
+def process_cover(filename):
+    """Queue variant rendering for a stored cover; returns the future or None."""
+    match = DIGEST_NAME_RE.match(filename or '')
+    if not match:
+        return None
+    future = background.pool().submit(render_variants, original_path(filename), match.group(1))
+    future.add_done_callback(_log_failure)
+    return future
+
+
+def remove_cover(filename):
+    match = DIGEST_NAME_RE.match(filename)
+    # The original goes first; a render still running checks for it
+    paths = [original_path(filename)]
+    if match:
+        paths += _variant_paths(match.group(1))
+    _remove(paths)
+
+
+def _accepts(accept_mimetypes, mimetype):
+    # Only formats the client names explicitly; "*/*" is not a promise of AVIF support
+    return any(value == mimetype and quality > 0 for value, quality in accept_mimetypes)
+
+
+def pick_variant(filename, width, accept_mimetypes):
+    """Return (path, is_variant) for the best file to serve for this request."""
+    match = DIGEST_NAME_RE.match(filename)
+    if match and width:
+        size = next((w for w in WIDTHS if w >= width), WIDTHS[-1])
+        for extension, mimetype in (('avif', 'image/avif'), ('webp', 'image/webp'), ('jpg', None)):
+            if mimetype and not _accepts(accept_mimetypes, mimetype):
+                continue
+            path = variant_path(match.group(1), size, extension)
+            if os.path.exists(path):
+                return path, True
+    return original_path(filename), False
@@ -0,0 +1,220 @@
+import os
+import json
+import glob
+import atexit
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError, DataError
+from app import db
+
+# Buffered download logging. download_book() only appends the event to an
+# in-process buffer and a per-process journal file; a background thread
+# writes buffered events to the downloads table in one executemany batch when
+# DOWNLOAD_EVENTS_BATCH_SIZE events are waiting or every
+# DOWNLOAD_EVENTS_FLUSH_INTERVAL seconds.
+#
+# The journal makes the buffer durable: on each flush the current journal
+# segment is rotated out together with the events it holds and deleted once
+# they are committed. Segments left behind by a crashed process are replayed
+# at startup, so events are written at least once.
+#
+# Events for a book or user deleted while they were buffered, here or in
+# another worker, are left out of the batch and appended to
+# download-events/dead-letter.jsonl. A batch the database rejects is retried
+# one event at a time and events that still fail are dead-lettered with the
+# error, so one bad event cannot hold up the batches behind it. Other errors
+# (the database being unreachable) keep the batch queued for the next flush.
+
+REJECTED = (IntegrityError, DataError, ValueError, KeyError)
+DEAD_LETTER = 'dead-letter.jsonl'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class DownloadRecorder:
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = []
+        self._failed = []
+        self._journal = None
+        self._segment = 0
+        self._pid = None
+        self._thread = None
+        self._stopping = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('DOWNLOAD_EVENTS_ASYNC', True)
+        self.batch_size = app.config.get('DOWNLOAD_EVENTS_BATCH_SIZE', 500)
+        self.interval = app.config.get('DOWNLOAD_EVENTS_FLUSH_INTERVAL', 2.0)
+        self.fsync = app.config.get('DOWNLOAD_EVENTS_FSYNC', False)
+        self.journal_dir = os.path.join(app.instance_path, 'download-events')
+        os.makedirs(self.journal_dir, exist_ok=True)
+        atexit.register(self.close)
+
+    def record(self, user_id, book_id, ip_address):
+        event = {
+            'user_id': user_id,
+            'book_id': book_id,
+            'ip_address': ip_address,
+            'downloaded_at': datetime.utcnow().isoformat(),
+        }
+        if not self.enabled:
+            self._write([event])
+            return
+        line = json.dumps(event) + '\n'
+        with self._lock:
+            self._ensure_started()
+            self._journal.write(line)
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            self._pending.append(event)
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def _journal_path(self):
+        return os.path.join(self.journal_dir, f'{self._pid}.journal')
+
+    def _ensure_started(self):
+        # Called with self._lock held. A forked worker inherits neither the
+        # thread nor a journal of its own, so both are (re)created per pid
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending = []
+        self._failed = []
+        self._journal = open(self._journal_path(), 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name='download-events', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if self._pending and self._pid == os.getpid():
+                    # Rotate the journal so the segment holds exactly this batch
+                    self._journal.close()
+                    self._segment += 1
+                    segment = f'{self._journal_path()}.{self._segment}'
+                    os.replace(self._journal_path(), segment)
+                    self._journal = open(self._journal_path(), 'a', encoding='utf-8')
+                    self._failed.append((self._pending, segment))
+                    self._pending = []
+                batches, self._failed = self._failed, []
+
+            for index, (batch, segment) in enumerate(batches):
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    logging.error(f"Failed to write {len(batch)} download events: {e}")
+                    with self._lock:
+                        self._failed = batches[index:] + self._failed
+                    return
+                os.remove(segment)
+
+    def _write_batch(self, events):
+        try:
+            self._write(events)
+            return
+        except REJECTED as e:
+            logging.warning(f"Retrying {len(events)} download events one by one: {e}")
+        for position, event in enumerate(events):
+            try:
+                self._write([event])
+            except REJECTED as e:
+                self._dead_letter(event, e)
+            except Exception:
+                # Keep only the events not written yet for the next flush
+                del events[:position]
+                raise
+
+    def _dead_letter(self, event, error):
+        logging.error(f"Download event rejected, moved to {DEAD_LETTER}: {error}")
+        with open(os.path.join(self.journal_dir, DEAD_LETTER), 'a', encoding='utf-8') as dead_letter:
+            dead_letter.write(json.dumps(dict(event, error=str(error))) + '\n')
+
+    def _write(self, events):
+        import counters
+        import stats
+        from models import Book, User, Download
+        with self.app.app_context():
+            try:
+                books = set(db.session.execute(
+                    select(Book.id).where(Book.id.in_({event['book_id'] for event in events}))
+                ).scalars())
+                users = set(db.session.execute(
+                    select(User.id).where(User.id.in_({event['user_id'] for event in events}))
+                ).scalars())
+                rows, orphans = [], []
+                for event in events:
+                    if event['book_id'] in books and event['user_id'] in users:
+                        rows.append(dict(event, downloaded_at=datetime.fromisoformat(event['downloaded_at'])))
+                    else:
+                        orphans.append(event)
+                if rows:
+                    db.session.execute(insert(Download), rows)
+                    counters.record_downloads(rows)
+                    stats.record_rollups(rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            for event in orphans:
+                self._dead_letter(event, 'book or user no longer exists')
+            if rows:
+                stats.downloads_recorded(len(rows))
+
+    def replay(self):
+        # Write out journals left by processes that are no longer running
+        replayed = 0
+        for path in sorted(glob.glob(os.path.join(self.journal_dir, '*.journal*'))):
+            pid = int(os.path.basename(path).split('.')[0])
+            if pid == self._pid == os.getpid():
+                continue
+            if pid != os.getpid() and _pid_alive(pid):
+                continue
+            events = []
+            with open(path, encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        # A crash can cut the last line short
+                        logging.warning(f"Skipping damaged download event in {path}")
+            if events:
+                self._write_batch(events)
+            os.remove(path)
+            replayed += len(events)
+        if replayed:
+            logging.info(f"Replayed {replayed} journaled download events")
+        return replayed
+
+    def close(self):
+        self._stopping = True
+        self._wake.set()
+        if self._pid == os.getpid():
+            self.flush()
+
+
+download_recorder = DownloadRecorder()
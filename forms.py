@@ -2,7 +2,14 @@ from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired, FileAllowed
 from wtforms import StringField, PasswordField, SelectField, TextAreaField, BooleanField, SubmitField
 from wtforms.validators import DataRequired, Email, Length, EqualTo, ValidationError
-from models import User, Category
+from models import User
+import categories
+
+# Book rules, shared with the bulk catalog import
+BOOK_EXTENSIONS = ['pdf', 'epub', 'mobi', 'txt', 'doc', 'docx']
+COVER_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif']
+TITLE_MAX_LENGTH = 200
+AUTHOR_MAX_LENGTH = 200
 
 class LoginForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired()])
@@ -53,39 +60,54 @@ class CategoryForm(FlaskForm):
     submit = SubmitField('Save Category')
 
 class BookForm(FlaskForm):
-    title = StringField('Book Title', validators=[DataRequired(), Length(min=1, max=200)])
-    author = StringField('Author Name', validators=[DataRequired(), Length(min=1, max=200)])
+    title = StringField('Book Title', validators=[DataRequired(), Length(min=1, max=TITLE_MAX_LENGTH)])
+    author = StringField('Author Name', validators=[DataRequired(), Length(min=1, max=AUTHOR_MAX_LENGTH)])
     description = TextAreaField('Description')
     category_id = SelectField('Category', coerce=int, validators=[DataRequired()])
     cover = FileField('Book Cover Image', validators=[
-        FileAllowed(['jpg', 'jpeg', 'png', 'gif'], 
+        FileAllowed(COVER_EXTENSIONS, 
                    'Only JPG, JPEG, PNG, and GIF images are allowed!')
     ])
     file = FileField('Book File', validators=[
         FileRequired(),
-        FileAllowed(['pdf', 'epub', 'mobi', 'txt', 'doc', 'docx'], 
+        FileAllowed(BOOK_EXTENSIONS, 
                    'Only PDF, EPUB, MOBI, TXT, DOC, and DOCX files are allowed!')
     ])
     submit = SubmitField('Upload Book')
     
     def __init__(self, *args, **kwargs):
         super(BookForm, self).__init__(*args, **kwargs)
-        self.category_id.choices = [(c.id, c.name) for c in Category.query.order_by(Category.name).all()]
+        self.category_id.choices = categories.choices()
+
+class UploadedBookForm(FlaskForm):
+    # Book details sent once a chunked upload of the file has completed
+    title = StringField('Book Title', validators=[DataRequired(), Length(min=1, max=TITLE_MAX_LENGTH)])
+    author = StringField('Author Name', validators=[DataRequired(), Length(min=1, max=AUTHOR_MAX_LENGTH)])
+    description = TextAreaField('Description')
+    category_id = SelectField('Category', coerce=int, validators=[DataRequired()])
+    cover = FileField('Book Cover Image', validators=[
+        FileAllowed(COVER_EXTENSIONS, 
+                   'Only JPG, JPEG, PNG, and GIF images are allowed!')
+    ])
+    
+    def __init__(self, *args, **kwargs):
+        super(UploadedBookForm, self).__init__(*args, **kwargs)
+        self.category_id.choices = categories.choices()
 
 class EditBookForm(FlaskForm):
-    title = StringField('Book Title', validators=[DataRequired(), Length(min=1, max=200)])
-    author = StringField('Author Name', validators=[DataRequired(), Length(min=1, max=200)])
+    title = StringField('Book Title', validators=[DataRequired(), Length(min=1, max=TITLE_MAX_LENGTH)])
+    author = StringField('Author Name', validators=[DataRequired(), Length(min=1, max=AUTHOR_MAX_LENGTH)])
     description = TextAreaField('Description')
     category_id = SelectField('Category', coerce=int, validators=[DataRequired()])
     cover = FileField('New Cover Image', validators=[
-        FileAllowed(['jpg', 'jpeg', 'png', 'gif'], 
+        FileAllowed(COVER_EXTENSIONS, 
                    'Only JPG, JPEG, PNG, and GIF images are allowed!')
     ])
     submit = SubmitField('Update Book')
     
     def __init__(self, *args, **kwargs):
         super(EditBookForm, self).__init__(*args, **kwargs)
-        self.category_id.choices = [(c.id, c.name) for c in Category.query.order_by(Category.name).all()]
+        self.category_id.choices = categories.choices()
 
 class ResetPasswordForm(FlaskForm):
     password = PasswordField('New Password', validators=[DataRequired(), Length(min=6)])
@@ -100,4 +122,4 @@ class SearchForm(FlaskForm):
     
     def __init__(self, *args, **kwargs):
         super(SearchForm, self).__init__(*args, **kwargs)
-        self.category.choices = [(0, 'All Categories')] + [(c.id, c.name) for c in Category.query.order_by(Category.name).all()]
+        self.category.choices = [(0, 'All Categories')] + categories.choices()
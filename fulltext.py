@@ -0,0 +1,202 @@
+import os
+import re
+import zlib
+import shutil
+import logging
+import tempfile
+from collections import Counter
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from markupsafe import Markup, escape
+from sqlalchemy import select, delete, insert
+from app import db
+from models import BookText, BookPage, Book
+from storage import storage
+from search import TOKEN_RE
+import search
+import transfers
+import background
+import text_extract
+
+# Full text of uploaded books. After a book is added, a thread of this
+# process prepares the file (copying it out of a remote store if needed) and
+# hands it to text_extract in the background process pool, which streams the
+# pages into a temporary file. The pages are then stored zlib-compressed in
+# book_pages, a batch per transaction, and indexed for content search;
+# book_texts records the outcome. /books?content=1 searches the pages and
+# shows a highlighted snippet of each book's best page.
+
+STORE_BATCH = 200
+SNIPPET_CHARS = 240
+COPY_SIZE = 1024 * 1024
+
+_jobs = None
+_jobs_pid = None
+
+
+def _job_pool(workers):
+    global _jobs, _jobs_pid
+    if _jobs is None or _jobs_pid != os.getpid():
+        _jobs = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fulltext')
+        _jobs_pid = os.getpid()
+    return _jobs
+
+
+def _extension(filename):
+    return filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+
+
+def _set_status(book_id, status, pages=0, characters=0, error=None):
+    db.session.merge(BookText(book_id=book_id, status=status, page_count=pages,
+                              char_count=characters, error=error and error[:500]))
+    db.session.commit()
+
+
+def _source_path(book, work_dir):
+    """A local path to read the book from, copied out of a remote store if needed."""
+    path = transfers.book_file_path(book)
+    if path:
+        return path
+    path = os.path.join(work_dir, 'source')
+    with closing(storage.open(book.file_hash)) as source, open(path, 'wb') as out:
+        shutil.copyfileobj(source, out, COPY_SIZE)
+    return path
+
+
+def _remove_pages(book_id):
+    # The index needs each page's text to take it out again
+    while True:
+        rows = db.session.execute(
+            select(BookPage.id, BookPage.content).where(BookPage.book_id == book_id).limit(STORE_BATCH)
+        ).all()
+        if not rows:
+            return
+        search.unindex_pages((page_id, zlib.decompress(content).decode('utf-8'))
+                             for page_id, content in rows)
+        db.session.execute(delete(BookPage).where(BookPage.id.in_([page_id for page_id, _ in rows])))
+
+
+def _book_exists(book_id):
+    return db.session.execute(select(Book.id).where(Book.id == book_id)).first() is not None
+
+
+def _store_batch(book_id, pages):
+    # Checked per batch: the book can be deleted while a long extraction runs,
+    # and its later pages must not outlive it
+    if not _book_exists(book_id):
+        return False
+    page_ids = db.session.execute(
+        insert(BookPage).returning(BookPage.id, sort_by_parameter_order=True),
+        [{'book_id': book_id, 'page': page['page'],
+          'content': zlib.compress(page['text'].encode('utf-8'))} for page in pages]
+    ).scalars().all()
+    search.index_pages(zip(page_ids, (page['text'] for page in pages)))
+    db.session.commit()
+    return True
+
+
+def store_pages(book_id, pages_path):
+    """Store and index a book's extracted pages; False if the book was deleted meanwhile."""
+    _remove_pages(book_id)
+    db.session.commit()
+    batch = []
+    for page in text_extract.read_pages(pages_path):
+        batch.append(page)
+        if len(batch) >= STORE_BATCH:
+            if not _store_batch(book_id, batch):
+                return False
+            batch = []
+    return not batch or _store_batch(book_id, batch)
+
+
+def extract(book_id):
+    """Extract, store and index one book's text; returns its book_texts status."""
+    book = db.session.get(Book, book_id)
+    if book is None:
+        return None
+    work_dir = tempfile.mkdtemp(prefix='text-', dir=storage.incoming_dir())
+    try:
+        source = _source_path(book, work_dir)
+        pages_path = os.path.join(work_dir, 'pages.jsonl.gz')
+        pages, characters = background.pool().submit(
+            text_extract.extract_book, source, _extension(book.filename), pages_path).result()
+        if not store_pages(book_id, pages_path):
+            return None
+        _set_status(book_id, 'done', pages, characters)
+        return 'done'
+    except text_extract.UnsupportedFormat as e:
+        status, error = 'unsupported', str(e)
+    except Exception as e:
+        status, error = 'failed', str(e)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    db.session.rollback()
+    if not _book_exists(book_id):
+        # Deleted while its text was extracted; the foreign key stops a page
+        # batch that races the delete
+        return None
+    if status == 'failed':
+        logging.error(f"Text extraction failed for book {book_id}: {error}")
+    _set_status(book_id, status, error=error)
+    return status
+
+
+def _run(app, book_id):
+    with app.app_context():
+        return extract(book_id)
+
+
+def queue_extraction(book_id, workers=2):
+    """Extract a book's text in the background; returns the future."""
+    _set_status(book_id, 'pending')
+    app = current_app._get_current_object()
+    return _job_pool(workers).submit(_run, app, book_id)
+
+
+def extract_books(book_ids, workers=2):
+    """Extract several books, workers at a time; returns a Counter of statuses."""
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return Counter(pool.map(lambda book_id: _run(app, book_id), book_ids))
+
+
+def remove_book(book_id):
+    # Called inside the caller's transaction, before the book is deleted
+    _remove_pages(book_id)
+    db.session.execute(delete(BookText).where(BookText.book_id == book_id))
+
+
+def highlight(body, terms):
+    """An excerpt of body around the first matched term, with matches in <mark>."""
+    pattern = re.compile(r'\b(?:' + '|'.join(re.escape(term) for term in terms) + r')\w*', re.IGNORECASE)
+    first = pattern.search(body)
+    start = 0
+    if first and first.start() > SNIPPET_CHARS // 3:
+        start = body.find(' ', first.start() - SNIPPET_CHARS // 3) + 1
+    end = min(len(body), start + SNIPPET_CHARS)
+    if end < len(body):
+        end = max(body.rfind(' ', start, end), start + SNIPPET_CHARS // 2)
+    excerpt = body[start:end]
+    parts = ['…' if start else '']
+    position = 0
+    for match in pattern.finditer(excerpt):
+        parts.append(escape(excerpt[position:match.start()]))
+        parts.append(Markup('<mark>%s</mark>') % match.group(0))
+        position = match.end()
+    parts.append(escape(excerpt[position:]))
+    parts.append('…' if end < len(body) else '')
+    return Markup('').join(parts)
+
+
+def snippets(book_ids, query):
+    """{book_id: {'page': n, 'snippet': Markup}} for the best page of each book."""
+    pages = search.best_pages(book_ids, query)
+    if not pages:
+        return {}
+    rows = db.session.execute(
+        select(BookPage.book_id, BookPage.page, BookPage.content).where(BookPage.id.in_(pages.values()))
+    )
+    terms = [term.lower() for term in TOKEN_RE.findall(query)]
+    return {book_id: {'page': page, 'snippet': highlight(zlib.decompress(content).decode('utf-8'), terms)}
+            for book_id, page, content in rows}
@@ -0,0 +1,126 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import update, bindparam, or_
+from sqlalchemy.orm import make_transient_to_detached
+from app import db
+from cache import cache
+from models import User
+import versions
+
+# Signed-in user loading. Flask-Login asks for the user on every request;
+# the identity columns are kept in the shared cache for USER_CACHE_TTL
+# seconds under the 'users' version, and the user is attached to the session
+# without a SELECT. Columns left out of the cache (password hash, last
+# login, download count) load on first access. Profile edits, password
+# resets and deletes call invalidate(); like the catalog version, other
+# workers notice within CATEGORY_CACHE_CHECK_INTERVAL seconds.
+#
+# Logins do not write last_login themselves: LastLoginRecorder collects the
+# times and writes them in one executemany every LAST_LOGIN_FLUSH_INTERVAL
+# seconds (0 writes at once).
+
+VERSION_NAME = 'users'
+CACHED_COLUMNS = ('id', 'username', 'email', 'full_name', 'is_admin', 'created_at')
+
+_lock = threading.Lock()
+_state = {'version': None, 'checked_at': 0.0}
+
+def users_version():
+    interval = current_app.config.get('CATEGORY_CACHE_CHECK_INTERVAL', 5)
+    now = time.monotonic()
+    with _lock:
+        if _state['version'] is None or now - _state['checked_at'] >= interval:
+            _state['version'] = versions.get_version(VERSION_NAME)
+            _state['checked_at'] = now
+        return _state['version']
+
+def invalidate():
+    versions.bump_version(VERSION_NAME)
+    with _lock:
+        _state['version'] = None
+
+def load_user(user_id):
+    ttl = current_app.config.get('USER_CACHE_TTL', 300)
+    if not ttl:
+        return db.session.get(User, user_id)
+    key = f'user:{users_version()}:{user_id}'
+    columns = cache.get(key)
+    if columns is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            cache.set(key, {name: getattr(user, name) for name in CACHED_COLUMNS}, ttl)
+        return user
+    user = User(**columns)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+class LastLoginRecorder:
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = {}
+        self._pid = None
+        self._stopping = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('LAST_LOGIN_FLUSH_INTERVAL', 30)
+        atexit.register(self.close)
+
+    def record(self, user):
+        now = datetime.utcnow()
+        if not self.interval:
+            self._write({user.id: now})
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked workers start their own flush thread
+                self._pid = os.getpid()
+                self._pending = {}
+                threading.Thread(target=self._run, name='last-login', daemon=True).start()
+            self._pending[user.id] = now
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending or self._pid != os.getpid():
+            return
+        try:
+            self._write(pending)
+        except Exception as e:
+            logging.error(f"Failed to write {len(pending)} last-login times: {e}")
+
+    def _write(self, logins):
+        table = User.__table__
+        with self.app.app_context():
+            # Never move a last_login back in time
+            db.session.connection().execute(
+                update(table)
+                .where(table.c.id == bindparam('user_id'),
+                       or_(table.c.last_login.is_(None), table.c.last_login < bindparam('logged_in')))
+                .values(last_login=bindparam('logged_in')),
+                [{'user_id': user_id, 'logged_in': at} for user_id, at in logins.items()]
+            )
+            db.session.commit()
+
+    def close(self):
+        self._stopping = True
+        self._wake.set()
+        self.flush()
+
+
+last_logins = LastLoginRecorder()
@@ -0,0 +1,319 @@
+import os
+import json
+import time
+import fcntl
+import atexit
+import random
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Request instrumentation. SQLAlchemy cursor events count the statements of
+# each request and the time spent in them; every request is then observed in
+# per-route histograms (latency, statement count, SQL time), served in the
+# Prometheus text format at /metrics.
+#
+# Each worker process keeps its own histograms and writes a snapshot to
+# instance/metrics every few seconds; /metrics adds up the snapshots of all
+# workers, and folds those of exited workers into archive.json so totals
+# survive worker restarts.
+#
+# Requests slower than SLOW_REQUEST_SECONDS or issuing more than
+# SLOW_REQUEST_QUERIES statements (0 turns either check off) are logged with their slowest and most
+# repeated SQL. With PROFILE_SAMPLE_RATE above 0 that share of requests is
+# profiled (cProfile, or pyinstrument with PROFILER=pyinstrument) into
+# instance/profiles.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+HISTOGRAMS = {
+    'http_request_duration_seconds': ('Request latency by route.', LATENCY_BUCKETS),
+    'http_request_sql_queries': ('SQL statements issued per request by route.', QUERY_BUCKETS),
+    'http_request_sql_duration_seconds': ('Time spent in SQL per request by route.', LATENCY_BUCKETS),
+}
+LABELS = {
+    'http_request_duration_seconds': ('endpoint', 'method', 'status'),
+    'http_request_sql_queries': ('endpoint', 'method'),
+    'http_request_sql_duration_seconds': ('endpoint', 'method'),
+}
+
+# Statements remembered per request for the slow-request log
+MAX_STATEMENTS = 500
+SNAPSHOT_INTERVAL = 5.0
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.query_time = 0.0
+        self.statements = []
+        self.status = None
+        self.profiler = None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    stats = g.get('request_stats') if has_request_context() else None
+    if stats is not None:
+        stats.query_count += 1
+        stats.query_time += elapsed
+        if len(stats.statements) < MAX_STATEMENTS:
+            stats.statements.append((elapsed, statement))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merge(total, snapshot):
+    for name, series in snapshot.items():
+        merged = total.setdefault(name, {})
+        for labels, values in series.items():
+            if labels in merged:
+                merged[labels] = [a + b for a, b in zip(merged[labels], values)]
+            else:
+                merged[labels] = list(values)
+    return total
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}'
+
+
+class Instrumentation:
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._profile_lock = threading.Lock()
+        self._series = {}
+        self._pid = None
+        self._started = None
+        self._snapshot_at = 0.0
+        self.enabled = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        self.slow_seconds = app.config.get('SLOW_REQUEST_SECONDS', 1.0)
+        self.slow_queries = app.config.get('SLOW_REQUEST_QUERIES', 50)
+        self.profile_rate = app.config.get('PROFILE_SAMPLE_RATE', 0.0)
+        self.profiler_name = app.config.get('PROFILER', 'cprofile')
+        self.metrics_dir = os.path.join(app.instance_path, 'metrics')
+        self.profile_dir = os.path.join(app.instance_path, 'profiles')
+        if not self.enabled:
+            return
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        atexit.register(self.write_snapshot)
+
+    # Request hooks
+
+    def _before_request(self):
+        g.request_stats = stats = RequestStats()
+        if self.profile_rate and random.random() < self.profile_rate:
+            stats.profiler = self._start_profiler()
+
+    def _after_request(self, response):
+        stats = g.get('request_stats')
+        if stats is not None:
+            stats.status = response.status_code
+        return response
+
+    def _teardown_request(self, exc):
+        # Runs after a streamed response has been sent, so its queries count too
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return
+        elapsed = time.perf_counter() - stats.started
+        endpoint = request.endpoint or 'unmatched'
+        status = stats.status or 500
+        if stats.profiler is not None:
+            self._stop_profiler(stats.profiler, endpoint)
+        if endpoint == 'metrics':
+            return
+        method = request.method
+        self.observe('http_request_duration_seconds', (endpoint, method, str(status)), elapsed)
+        self.observe('http_request_sql_queries', (endpoint, method), stats.query_count)
+        self.observe('http_request_sql_duration_seconds', (endpoint, method), stats.query_time)
+        if ((self.slow_seconds and elapsed >= self.slow_seconds)
+                or (self.slow_queries and stats.query_count > self.slow_queries)):
+            self._log_slow_request(stats, elapsed, status)
+        if time.monotonic() - self._snapshot_at >= SNAPSHOT_INTERVAL:
+            self.write_snapshot()
+
+    def _log_slow_request(self, stats, elapsed, status):
+        lines = [f"Slow request: {request.method} {request.full_path.rstrip('?')} -> {status} "
+                 f"in {elapsed * 1000:.0f}ms, {stats.query_count} queries "
+                 f"({stats.query_time * 1000:.0f}ms in SQL)"]
+        for duration, statement in sorted(stats.statements, key=lambda s: s[0], reverse=True)[:5]:
+            lines.append(f"  {duration * 1000:.1f}ms: {' '.join(statement.split())[:500]}")
+        statement, repeats = (Counter(s for _, s in stats.statements).most_common(1) or [(None, 0)])[0]
+        if repeats > 1:
+            lines.append(f"  repeated {repeats}x: {' '.join(statement.split())[:500]}")
+        logging.warning('\n'.join(lines))
+
+    # Histograms
+
+    def observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][1]
+        with self._lock:
+            if self._pid != os.getpid():
+                # A forked worker starts with empty histograms of its own
+                self._pid = os.getpid()
+                self._started = int(time.time() * 1000)
+                self._series = {}
+            series = self._series.setdefault(name, {})
+            key = json.dumps(labels)
+            values = series.get(key)
+            if values is None:
+                # One count per bucket, then +Inf, then the sum
+                values = series[key] = [0] * (len(buckets) + 2)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    values[index] += 1
+                    break
+            else:
+                values[len(buckets)] += 1
+            values[-1] += value
+
+    def _snapshot_path(self, pid=None, started=None):
+        return os.path.join(self.metrics_dir, f'{pid or self._pid}-{started or self._started}.json')
+
+    def write_snapshot(self):
+        with self._lock:
+            if self._pid != os.getpid() or not self._series:
+                return
+            data = json.dumps(self._series)
+            path = self._snapshot_path()
+            self._snapshot_at = time.monotonic()
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as handle:
+            handle.write(data)
+        os.replace(temp_path, path)
+
+    def collect(self):
+        """Histograms of all workers, folding exited workers into the archive."""
+        self.write_snapshot()
+        archive_path = os.path.join(self.metrics_dir, 'archive.json')
+        with open(os.path.join(self.metrics_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive = {}
+            if os.path.exists(archive_path):
+                with open(archive_path, encoding='utf-8') as handle:
+                    archive = json.load(handle)
+            total = _merge({}, archive)
+            exited = []
+            for filename in os.listdir(self.metrics_dir):
+                if not filename.endswith('.json') or filename == 'archive.json':
+                    continue
+                path = os.path.join(self.metrics_dir, filename)
+                try:
+                    with open(path, encoding='utf-8') as handle:
+                        snapshot = json.load(handle)
+                except (OSError, ValueError):
+                    continue
+                _merge(total, snapshot)
+                if not _pid_alive(int(filename.split('-')[0])):
+                    _merge(archive, snapshot)
+                    exited.append(path)
+            if exited:
+                with open(f'{archive_path}.tmp', 'w', encoding='utf-8') as handle:
+                    json.dump(archive, handle)
+                os.replace(f'{archive_path}.tmp', archive_path)
+                for path in exited:
+                    os.remove(path)
+        return total
+
+    def render(self):
+        """All histograms in the Prometheus text exposition format."""
+        total = self.collect()
+        lines = []
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for key, values in sorted(total.get(name, {}).items()):
+                labels = json.loads(key)
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], values[:-1]):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f'{name}_bucket{_label_text(LABELS[name], labels, le)} {cumulative}')
+                lines.append(f'{name}_sum{_label_text(LABELS[name], labels)} {values[-1]}')
+                lines.append(f'{name}_count{_label_text(LABELS[name], labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    # Profiling
+
+    def _start_profiler(self):
+        # Python allows one profiler at a time, so concurrent samples are skipped
+        if not self._profile_lock.acquire(blocking=False):
+            return None
+        try:
+            if self.profiler_name == 'pyinstrument':
+                from pyinstrument import Profiler
+                profiler = Profiler()
+                profiler.start()
+            else:
+                import cProfile
+                profiler = cProfile.Profile()
+                profiler.enable()
+        except Exception as e:
+            self._profile_lock.release()
+            logging.error(f"Could not start the profiler: {e}")
+            return None
+        return profiler
+
+    def _stop_profiler(self, profiler, endpoint):
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            name = f"{datetime.utcnow():%Y%m%d-%H%M%S-%f}-{endpoint}"
+            if self.profiler_name == 'pyinstrument':
+                profiler.stop()
+                with open(os.path.join(self.profile_dir, f'{name}.html'), 'w', encoding='utf-8') as handle:
+                    handle.write(profiler.output_html())
+            else:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir, f'{name}.prof'))
+        except Exception as e:
+            logging.error(f"Could not save the profile: {e}")
+        finally:
+            self._profile_lock.release()
+
+
+instrumentation = Instrumentation()
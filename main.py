@@ -1,5 +1,10 @@
-from app import app
-import routes
+from app import create_app
+import bootstrap
+
+app = create_app()
 
 if __name__ == "__main__":
+    # The development server sets the database up itself; deployments run
+    # `flask --app main init-db` and `seed`, or use server.py
+    bootstrap.prepare(app)
     app.run(host="0.0.0.0", port=5000, debug=True)
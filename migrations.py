@@ -0,0 +1,85 @@
+import logging
+from datetime import datetime
+from sqlalchemy import inspect, text
+from app import db
+
+# Schema changes for databases created before a column or table existed.
+# db.create_all() only creates missing tables, so every change to an
+# existing table is listed here and applied once, in order, by upgrade().
+# Steps must be idempotent: on a fresh database create_all() has already
+# produced the final schema.
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('name', db.String(200), nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False),
+)
+
+def _add_column(table, column, ddl):
+    columns = [c['name'] for c in inspect(db.engine).get_columns(table)]
+    if column not in columns:
+        db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+def _download_counters():
+    import counters
+    _add_column('books', 'download_count', 'INTEGER DEFAULT 0 NOT NULL')
+    _add_column('users', 'download_count', 'INTEGER DEFAULT 0 NOT NULL')
+    db.session.commit()
+    counters.reconcile_download_counts()
+
+def _download_rollups():
+    import stats
+    stats.rebuild_rollups()
+
+def _create_indexes(*names):
+    # Create indexes declared on the models that an older database lacks
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in names:
+                index.create(db.engine, checkfirst=True)
+
+def _keyset_indexes():
+    _create_indexes('ix_books_uploaded_at_id', 'ix_books_category_uploaded_at_id',
+                    'ix_downloads_downloaded_at_id')
+
+def _filter_indexes():
+    _create_indexes('ix_users_is_admin_created_at', 'ix_books_uploaded_by',
+                    'ix_downloads_user_downloaded_at', 'ix_downloads_book_id')
+
+def _big_file_sizes():
+    # SQLite integers are already 64-bit
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('ALTER TABLE books ALTER COLUMN file_size TYPE BIGINT'))
+        db.session.commit()
+
+def _book_file_hashes():
+    _add_column('books', 'file_hash', 'VARCHAR(64)')
+    db.session.commit()
+    _create_indexes('ix_books_file_hash')
+
+def _partition_downloads():
+    import retention
+    retention.partition_downloads()
+
+MIGRATIONS = [
+    (1, 'download counters on books and users', _download_counters),
+    (2, 'daily download rollups', _download_rollups),
+    (3, 'keyset pagination indexes', _keyset_indexes),
+    (4, 'indexes for filtered and sorted columns', _filter_indexes),
+    (5, 'book file sizes above 2GB', _big_file_sizes),
+    (6, 'content hashes for stored book files', _book_file_hashes),
+    (7, 'monthly partitions of downloads on PostgreSQL', _partition_downloads),
+]
+
+def upgrade():
+    schema_migrations.create(db.engine, checkfirst=True)
+    applied = set(db.session.execute(db.select(schema_migrations.c.version)).scalars())
+    for version, name, step in MIGRATIONS:
+        if version in applied:
+            continue
+        step()
+        db.session.execute(schema_migrations.insert().values(
+            version=version, name=name, applied_at=datetime.utcnow()))
+        db.session.commit()
+        logging.info(f"Applied migration {version}: {name}")
@@ -1,8 +1,8 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 from app import db
+from passwords import hasher
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -15,16 +15,23 @@ class User(UserMixin, db.Model):
     is_admin = db.Column(db.Boolean, default=False, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime)
+    download_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    
+    # admin_users: non-admin users, newest first
+    __table_args__ = (
+        db.Index('ix_users_is_admin_created_at', 'is_admin', 'created_at'),
+    )
     
     # Relationships
     uploads = db.relationship('Book', backref='uploader_user', lazy=True, foreign_keys='Book.uploaded_by')
     downloads = db.relationship('Download', backref='user', lazy=True)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        # Hashed on the bounded hashing pool; raises passwords.HashingBusy when it is full
+        self.password_hash = hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return hasher.verify(self.password_hash, password)
     
     def __repr__(self):
         return f'<User {self.username}>'
@@ -52,21 +59,27 @@ class Book(db.Model):
     description = db.Column(db.Text)
     filename = db.Column(db.String(255), nullable=False)
     file_path = db.Column(db.String(500), nullable=False)
-    file_size = db.Column(db.Integer)  # in bytes
+    file_size = db.Column(db.BigInteger)  # in bytes
+    # SHA-256 of the file in the content-addressed store; file_path then holds
+    # the storage key. Books uploaded before the store have no hash.
+    file_hash = db.Column(db.String(64), index=True)
     cover_image = db.Column(db.String(255))  # cover image filename
     cover_path = db.Column(db.String(500))   # full path to cover image
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+    download_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     
     # Foreign keys
     category_id = db.Column(db.Integer, db.ForeignKey('categories.id'), nullable=False)
-    uploaded_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    uploaded_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     
     # Relationships
     downloads = db.relationship('Download', backref='book', lazy=True, cascade='all, delete-orphan')
     
-    @property
-    def download_count(self):
-        return len(self.downloads)
+    # Keyset pagination: newest first, overall and within a category
+    __table_args__ = (
+        db.Index('ix_books_uploaded_at_id', 'uploaded_at', 'id'),
+        db.Index('ix_books_category_uploaded_at_id', 'category_id', 'uploaded_at', 'id'),
+    )
     
     def __repr__(self):
         return f'<Book {self.title}>'
@@ -82,5 +95,137 @@ class Download(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     book_id = db.Column(db.Integer, db.ForeignKey('books.id'), nullable=False)
     
+    # Keyset pagination of the download log, newest first; a user's own
+    # history, newest first; per-book counts and deletes
+    __table_args__ = (
+        db.Index('ix_downloads_downloaded_at_id', 'downloaded_at', 'id'),
+        db.Index('ix_downloads_user_downloaded_at', 'user_id', 'downloaded_at'),
+        db.Index('ix_downloads_book_id', 'book_id'),
+    )
+    
     def __repr__(self):
         return f'<Download {self.user.username} - {self.book.title}>'
+
+class DownloadRollup(db.Model):
+    __tablename__ = 'download_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    # Plain ids rather than foreign keys: the history outlives deleted books
+    book_id = db.Column(db.Integer, nullable=False)
+    category_id = db.Column(db.Integer, nullable=False)
+    download_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('day', 'book_id', name='uq_download_rollups_day_book'),
+        db.Index('ix_download_rollups_category_day', 'category_id', 'day'),
+    )
+    
+    def __repr__(self):
+        return f'<DownloadRollup {self.day} book={self.book_id} {self.download_count}>'
+
+class CompactedDownload(db.Model):
+    __tablename__ = 'compacted_downloads'
+    
+    # Download events past DOWNLOAD_RETENTION_DAYS, folded into one row per
+    # day, user and book by `flask compact-downloads`
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    # Plain ids, like the rollups
+    user_id = db.Column(db.Integer, nullable=False)
+    book_id = db.Column(db.Integer, nullable=False)
+    download_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('day', 'user_id', 'book_id', name='uq_compacted_downloads_day_user_book'),
+        db.Index('ix_compacted_downloads_user_book', 'user_id', 'book_id'),
+        db.Index('ix_compacted_downloads_book_id', 'book_id'),
+    )
+    
+    def __repr__(self):
+        return f'<CompactedDownload {self.day} user={self.user_id} book={self.book_id} {self.download_count}>'
+
+class CacheVersion(db.Model):
+    __tablename__ = 'cache_versions'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<CacheVersion {self.name}={self.version}>'
+
+class BookUpload(db.Model):
+    __tablename__ = 'book_uploads'
+    
+    # Random token; also names the partial file
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    received = db.Column(db.BigInteger, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<BookUpload {self.id} {self.received}/{self.total_size}>'
+
+class StoredFile(db.Model):
+    __tablename__ = 'stored_files'
+    
+    digest = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    # Number of books using this file; it is deleted when this reaches zero
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<StoredFile {self.digest[:12]} refs={self.ref_count}>'
+
+class BookText(db.Model):
+    __tablename__ = 'book_texts'
+    
+    # Text extraction state per book: pending, done, failed or unsupported
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id'), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    page_count = db.Column(db.Integer, default=0, nullable=False)
+    char_count = db.Column(db.BigInteger, default=0, nullable=False)
+    error = db.Column(db.String(500))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<BookText {self.book_id} {self.status}>'
+
+class BookPage(db.Model):
+    __tablename__ = 'book_pages'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id'), nullable=False)
+    page = db.Column(db.Integer, nullable=False)
+    # zlib-compressed UTF-8 text of the page
+    content = db.Column(db.LargeBinary, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('book_id', 'page', name='uq_book_pages_book_page'),
+    )
+    
+    def __repr__(self):
+        return f'<BookPage {self.book_id}:{self.page}>'
+
+class BookRecommendation(db.Model):
+    __tablename__ = 'book_recommendations'
+    
+    # "Readers also downloaded": the top neighbours of each book by shared
+    # readers, rebuilt as a whole by `flask build-recommendations`
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    recommended_book_id = db.Column(db.Integer, db.ForeignKey('books.id'), nullable=False)
+    shared_readers = db.Column(db.Integer, nullable=False)
+    # Cosine similarity of the two books' reader sets
+    score = db.Column(db.Float, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_book_recommendations_recommended', 'recommended_book_id'),
+    )
+    
+    def __repr__(self):
+        return f'<BookRecommendation {self.book_id} #{self.rank} -> {self.recommended_book_id}>'
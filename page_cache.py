@@ -0,0 +1,71 @@
+import time
+import hashlib
+import threading
+from functools import wraps
+from urllib.parse import urlencode
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+from cache import cache
+import versions
+
+# Rendered-page cache for the public catalog. Anonymous GETs of the decorated
+# views are stored in the shared cache under the 'catalog' version and the
+# full query string; book and category writes call invalidate(), which bumps
+# the version so every worker renders afresh. Download counts on the pages
+# may lag by up to PAGE_CACHE_TTL seconds. Responses carry an ETag, so
+# browsers revalidate with If-None-Match and get a 304 when nothing changed.
+
+VERSION_NAME = 'catalog'
+
+_lock = threading.Lock()
+_state = {'version': None, 'checked_at': 0.0}
+
+def catalog_version():
+    interval = current_app.config.get('CATEGORY_CACHE_CHECK_INTERVAL', 5)
+    now = time.monotonic()
+    with _lock:
+        if _state['version'] is None or now - _state['checked_at'] >= interval:
+            _state['version'] = versions.get_version(VERSION_NAME)
+            _state['checked_at'] = now
+        return _state['version']
+
+def invalidate():
+    versions.bump_version(VERSION_NAME)
+    with _lock:
+        _state['version'] = None
+
+def _cacheable():
+    # Signed-in pages and pages showing a flash message are per-user
+    return (request.method == 'GET'
+            and current_app.config.get('PAGE_CACHE_TTL', 60) > 0
+            and not current_user.is_authenticated
+            and not session.get('_flashes'))
+
+def _cache_key():
+    args = urlencode(sorted(request.args.items(multi=True)))
+    return f'page:{catalog_version()}:{request.path}?{args}'
+
+def cached_page(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not _cacheable():
+            return view(*args, **kwargs)
+
+        key = _cache_key()
+        entry = cache.get(key)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            entry = (body, response.mimetype, hashlib.sha1(body).hexdigest())
+            cache.set(key, entry, current_app.config.get('PAGE_CACHE_TTL', 60))
+        else:
+            response = current_app.response_class(entry[0], mimetype=entry[1])
+
+        response.set_etag(entry[2])
+        # Browsers may keep the page but must check it is still current
+        response.headers['Cache-Control'] = 'no-cache'
+        response.vary.add('Cookie')
+        return response.make_conditional(request)
+    return wrapper
@@ -0,0 +1,75 @@
+import json
+import base64
+from datetime import datetime
+from sqlalchemy import and_, or_, select, func
+from app import db
+
+# Cursor (keyset) pagination for newest-first listings. Instead of OFFSET,
+# each page continues from the (timestamp, id) of the last row shown, so deep
+# pages cost the same as the first one when a matching composite index
+# exists. Totals are supplied by the caller (cached counters) or estimated
+# with a capped count.
+
+
+def encode_cursor(value, row_id):
+    raw = json.dumps([value.isoformat() if value else None, row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return (datetime.fromisoformat(value) if value else None), int(row_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def approximate_count(query, cap=1000):
+    # Count at most cap + 1 rows; anything above cap is shown as "cap+"
+    limited = query.enable_eagerloads(False).order_by(None).limit(cap + 1).subquery()
+    count = db.session.execute(select(func.count()).select_from(limited)).scalar()
+    return min(count, cap), count > cap
+
+
+class KeysetPagination:
+    cursor_based = True
+
+    def __init__(self, query, sort_column, id_column, per_page,
+                 after=None, before=None, total=None, total_is_estimate=False):
+        self.per_page = per_page
+        self.total = total
+        self.total_is_estimate = total_is_estimate
+
+        after = decode_cursor(after) if after else None
+        before = decode_cursor(before) if before and not after else None
+
+        if before:
+            value, row_id = before
+            rows = query.filter(or_(sort_column > value,
+                                    and_(sort_column == value, id_column > row_id))) \
+                .order_by(sort_column.asc(), id_column.asc()).limit(per_page + 1).all()
+            self.has_prev = len(rows) > per_page
+            self.has_next = True
+            self.items = list(reversed(rows[:per_page]))
+        else:
+            if after:
+                value, row_id = after
+                query = query.filter(or_(sort_column < value,
+                                         and_(sort_column == value, id_column < row_id)))
+            rows = query.order_by(sort_column.desc(), id_column.desc()).limit(per_page + 1).all()
+            self.has_next = len(rows) > per_page
+            self.has_prev = after is not None
+            self.items = rows[:per_page]
+
+        key = sort_column.key
+        id_key = id_column.key
+        self.next_cursor = encode_cursor(getattr(self.items[-1], key), getattr(self.items[-1], id_key)) \
+            if self.items and self.has_next else None
+        self.prev_cursor = encode_cursor(getattr(self.items[0], key), getattr(self.items[0], id_key)) \
+            if self.items and self.has_prev else None
+
+    @property
+    def pages(self):
+        # Lets templates keep their "{% if pagination.pages > 1 %}" checks
+        return 2 if self.has_next or self.has_prev else 1
@@ -0,0 +1,121 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+from cache import cache
+
+# Password hashing off the request threads. scrypt and PBKDF2 release the
+# GIL, so PASSWORD_HASH_WORKERS threads bound how many cores hashing can
+# take however many logins arrive at once. A request waits at most
+# PASSWORD_HASH_WAIT seconds for one of the worker or PASSWORD_HASH_QUEUE
+# slots and otherwise gets HashingBusy (a 503), so a burst of logins cannot
+# tie up every request thread while catalog pages wait behind it.
+#
+# Hashes made with other parameters than PASSWORD_HASH_METHOD are upgraded
+# on the next successful login (needs_rehash). LoginThrottle counts failed
+# logins per client address, and per username from that address, in the
+# shared cache and turns further attempts away before any hashing is done.
+# The username count is kept per address so that nobody can lock a known
+# account (an admin's, say) out by failing its password on purpose.
+#
+# Without CACHE_REDIS_URL the shared cache is per process, so each gunicorn
+# worker counts on its own and a client can make up to WEB_CONCURRENCY times
+# the configured attempts before every worker turns it away.
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        self.method = 'scrypt'
+        self.workers = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._prefix = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config.get('PASSWORD_HASH_METHOD', 'scrypt')
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', 2)
+        self.queue = app.config.get('PASSWORD_HASH_QUEUE', 16)
+        self.wait = app.config.get('PASSWORD_HASH_WAIT', 2.0)
+
+    def _executor(self):
+        # A forked worker process cannot use its parent's threads
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+                self._slots = threading.BoundedSemaphore(self.workers + self.queue)
+            return self._pool, self._slots
+
+    def _run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+        pool, slots = self._executor()
+        if not slots.acquire(timeout=self.wait):
+            raise HashingBusy('Too many password checks in progress')
+        try:
+            return pool.submit(function, *args).result()
+        finally:
+            slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        # Compare parameters with a hash made the current way, e.g.
+        # "scrypt:32768:8:1" for "scrypt"
+        if self._prefix is None or self._prefix[0] != self.method:
+            self._prefix = (self.method, self.hash('').split('$', 1)[0])
+        return password_hash.split('$', 1)[0] != self._prefix[1]
+
+
+class LoginThrottle:
+    def __init__(self, app=None):
+        self.window = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.window = app.config.get('LOGIN_THROTTLE_WINDOW', 300)
+        self.per_address = app.config.get('LOGIN_MAX_FAILURES_PER_IP', 20)
+        self.per_username = app.config.get('LOGIN_MAX_FAILURES_PER_USERNAME', 5)
+
+    def _user_key(self, address, username):
+        return f'login-failures:user:{address}:{username.casefold()}'
+
+    def _keys(self, address, username):
+        return ((f'login-failures:ip:{address}', self.per_address),
+                (self._user_key(address, username), self.per_username))
+
+    def retry_after(self, address, username):
+        """Seconds to wait before trying again, or 0 when the attempt may go ahead."""
+        if not self.window:
+            return 0
+        for key, limit in self._keys(address, username):
+            if limit and (cache.get(key) or 0) >= limit:
+                return self.window
+        return 0
+
+    def failed(self, address, username):
+        if not self.window:
+            return
+        # Counts expire one window after the first failure
+        for key, _ in self._keys(address, username):
+            if cache.incr(key) is None:
+                cache.set(key, 1, self.window)
+
+    def succeeded(self, address, username):
+        if self.window:
+            cache.delete(self._user_key(address, username))
+
+
+hasher = PasswordHasher()
+login_throttle = LoginThrottle()
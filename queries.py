@@ -0,0 +1,96 @@
+from flask import current_app
+from sqlalchemy import select, func
+from sqlalchemy.orm import joinedload, defaultload, raiseload, configure_mappers
+from app import db
+from models import Book, Download
+
+# The backrefs used below (Book.category, ...) exist once the mappers are configured
+configure_mappers()
+
+# Preconfigured loading per view. Each view lists the relationship paths its
+# templates touch; they are joined into the main query so a page renders in a
+# constant number of statements. With STRICT_LOADING on (the default under
+# debug and testing) any other relationship that would emit SQL raises, so a
+# new N+1 in a template fails loudly instead of silently adding queries.
+
+VIEWS = {
+    'book_list': [(Book.category,)],
+    'admin_book_list': [(Book.category,), (Book.uploader_user,)],
+    'download_list': [(Download.book, Book.category), (Download.user,)],
+}
+
+def _strict():
+    return current_app.config.get('STRICT_LOADING', current_app.debug or current_app.testing)
+
+def load_options(view):
+    paths = VIEWS[view]
+    options = []
+    for path in paths:
+        loader = joinedload(path[0])
+        for attr in path[1:]:
+            loader = loader.joinedload(attr)
+        options.append(loader)
+    if _strict():
+        options.append(raiseload('*', sql_only=True))
+        for path in paths:
+            for depth in range(1, len(path) + 1):
+                loader = defaultload(path[0])
+                for attr in path[1:depth]:
+                    loader = loader.defaultload(attr)
+                options.append(loader.raiseload('*', sql_only=True))
+    return options
+
+def books(view='book_list'):
+    return Book.query.options(*load_options(view))
+
+def downloads():
+    return Download.query.options(*load_options('download_list'))
+
+def recent_books(limit=6):
+    return books().order_by(Book.uploaded_at.desc()).limit(limit).all()
+
+def recent_downloads(limit=5):
+    return downloads().order_by(Download.downloaded_at.desc()).limit(limit).all()
+
+def user_downloads(user_id, limit=10):
+    return downloads().filter(Download.user_id == user_id).order_by(
+        Download.downloaded_at.desc()).limit(limit).all()
+
+def _top_per_group(query, model, group_column, order_by, group_ids, limit):
+    # First `limit` rows for each group id in one statement instead of
+    # loading every group's whole collection
+    if not group_ids:
+        return {}
+    position = func.row_number().over(partition_by=group_column, order_by=order_by).label('position')
+    ranked = select(model.id, position).where(group_column.in_(group_ids)).subquery()
+    rows = query.join(ranked, ranked.c.id == model.id).filter(
+        ranked.c.position <= limit).order_by(group_column, ranked.c.position).all()
+    result = {group_id: [] for group_id in group_ids}
+    for row in rows:
+        result[getattr(row, group_column.key)].append(row)
+    return result
+
+def recent_downloads_by_user(user_ids, limit=5):
+    return _top_per_group(downloads(), Download, Download.user_id,
+                          (Download.downloaded_at.desc(), Download.id.desc()), user_ids, limit)
+
+def books_by_category(category_ids, limit=10):
+    return _top_per_group(books(), Book, Book.category_id,
+                          (Book.uploaded_at.desc(), Book.id.desc()), category_ids, limit)
+
+def category_book_counts():
+    rows = db.session.execute(
+        select(Book.category_id, func.count(Book.id)).group_by(Book.category_id)
+    ).all()
+    return {category_id: count for category_id, count in rows}
+
+def category_has_books(category_id):
+    return db.session.execute(
+        select(Book.id).where(Book.category_id == category_id).limit(1)
+    ).first() is not None
+
+def cover_in_use(cover_image, excluding_book_id):
+    # Covers are stored by content, so identical uploads share one file
+    return db.session.execute(
+        select(Book.id).where(Book.cover_image == cover_image, Book.id != excluding_book_id).limit(1)
+    ).first() is not None
@@ -0,0 +1,108 @@
+import re
+from contextlib import contextmanager
+from sqlalchemy import event
+from app import db
+
+# Query-plan checker. Requests each page as an anonymous visitor, a regular
+# user and an admin, records the SELECT statements it issues and runs EXPLAIN
+# on each one. A full table scan of one of LARGE_TABLES is reported as a
+# violation; statements that scan on purpose (batch jobs, cache-miss totals)
+# opt out with .execution_options(allow_table_scan=True).
+
+LARGE_TABLES = {'books', 'downloads', 'users', 'download_rollups', 'compacted_downloads'}
+
+ROUTES = [
+    (None, '/'),
+    (None, '/books'),
+    (None, '/books?query=intro'),
+    (None, '/books?category=1'),
+    ('user', '/dashboard'),
+    ('user', '/profile'),
+    ('admin', '/admin'),
+    ('admin', '/admin/books'),
+    ('admin', '/admin/users'),
+    ('admin', '/admin/downloads'),
+    ('admin', '/admin/categories'),
+]
+
+SQLITE_SCAN_RE = re.compile(r'^SCAN (\w+)$')
+
+
+@contextmanager
+def capture_statements(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and not executemany:
+            if not (context and context.execution_options.get('allow_table_scan')):
+                statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def _table_name(name):
+    # SQLAlchemy aliases joined tables as books_1, downloads_2, ...
+    return re.sub(r'_\d+$', '', name)
+
+
+def table_scans(statement, parameters):
+    engine = db.engine
+    with engine.connect() as conn:
+        if engine.dialect.name == 'postgresql':
+            # Only choose a sequential scan when no index can be used, so
+            # small test tables still show whether an index exists
+            conn.exec_driver_sql('SET enable_seqscan = off')
+            plan = conn.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {statement}', parameters).scalar()
+            scans = []
+            nodes = [plan[0]['Plan']]
+            while nodes:
+                node = nodes.pop()
+                if node.get('Node Type') == 'Seq Scan':
+                    scans.append(node.get('Relation Name'))
+                nodes.extend(node.get('Plans', []))
+        else:
+            rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).all()
+            scans = []
+            for row in rows:
+                match = SQLITE_SCAN_RE.match(row[-1])
+                if match:
+                    scans.append(_table_name(match.group(1)))
+    return [table for table in scans if table in LARGE_TABLES]
+
+
+def _login(client, user):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+
+
+def check_routes(app, routes=ROUTES):
+    """Return a list of (route, table, statement) for every table scan found."""
+    from models import User
+    with app.app_context():
+        users = {
+            'user': User.query.filter_by(is_admin=False).first(),
+            'admin': User.query.filter_by(is_admin=True).first(),
+        }
+        engine = db.engine
+
+    violations = []
+    for role, url in routes:
+        if role and users[role] is None:
+            continue
+        client = app.test_client()
+        if role:
+            _login(client, users[role])
+        # A fresh app context per request: the CLI already runs inside one,
+        # and requests would otherwise share its g (and its logged-in user)
+        with app.app_context(), capture_statements(engine) as statements:
+            client.get(url)
+        with app.app_context():
+            for statement, parameters in statements:
+                for table in table_scans(statement, parameters):
+                    violations.append((url, table, statement))
+    return violations
@@ -0,0 +1,169 @@
+import math
+import logging
+from array import array
+from itertools import groupby
+from sqlalchemy import select, func, delete, insert, and_, or_, exists, union
+from app import db
+from models import Book, Download, BookRecommendation, CompactedDownload
+import page_cache
+import queries
+
+# "Readers also downloaded". build() turns the downloads table into a
+# book-by-book matrix of shared readers and keeps each book's TOP_K closest
+# neighbours (cosine similarity of the two reader sets) in
+# book_recommendations, so pages only read that table. With NumPy and SciPy
+# (the `recommendations` extra) the matrix is a sparse product computed in
+# this process; without them the database does the same counting with a
+# self-join, which is much slower on large catalogs.
+#
+# Readers with more than MAX_USER_BOOKS books (bulk downloaders) are left
+# out: they tie everything to everything and cost the square of their
+# downloads. The table is rebuilt as a whole; run `flask
+# build-recommendations` periodically (e.g. nightly from cron).
+
+TOP_K = 10
+MAX_USER_BOOKS = 500
+MIN_SHARED_READERS = 2
+LISTING_LIMIT = 3
+RECENT_DOWNLOADS = 20
+INSERT_BATCH = 5000
+SPARSE_BLOCK = 1000
+
+
+def _reader_pairs(max_user_books):
+    # Recent events and the compacted history of older ones
+    pairs = union(select(Download.user_id, Download.book_id),
+                  select(CompactedDownload.user_id, CompactedDownload.book_id)).cte('reader_pairs')
+    light = select(pairs.c.user_id).group_by(pairs.c.user_id).having(func.count() <= max_user_books)
+    return select(pairs.c.user_id, pairs.c.book_id).where(pairs.c.user_id.in_(light))
+
+
+def _neighbours_sparse(top_k, max_user_books, min_shared):
+    import numpy as np
+    from scipy import sparse
+    users, books = array('q'), array('q')
+    rows = db.session.execute(_reader_pairs(max_user_books)
+                              .execution_options(yield_per=50000, allow_table_scan=True))
+    for user_id, book_id in rows:
+        users.append(user_id)
+        books.append(book_id)
+    if not books:
+        return
+    book_ids, book_index = np.unique(np.frombuffer(books, dtype=np.int64), return_inverse=True)
+    _, user_index = np.unique(np.frombuffer(users, dtype=np.int64), return_inverse=True)
+    readers = sparse.csr_matrix((np.ones(len(book_index), dtype=np.int32), (user_index, book_index)),
+                                shape=(user_index.max() + 1, len(book_ids)))
+    reader_counts = np.asarray(readers.sum(axis=0)).ravel()
+    by_book = readers.T.tocsr()
+    # Book x book counts of shared readers, a block of rows at a time so
+    # memory stays bounded on large catalogs
+    for first in range(0, len(book_ids), SPARSE_BLOCK):
+        shared = (by_book[first:first + SPARSE_BLOCK] @ readers).tocsr()
+        shared.setdiag(0, k=first)
+        shared.eliminate_zeros()
+        for offset in range(shared.shape[0]):
+            row = first + offset
+            start, end = shared.indptr[offset], shared.indptr[offset + 1]
+            columns, counts = shared.indices[start:end], shared.data[start:end]
+            keep = counts >= min_shared
+            columns, counts = columns[keep], counts[keep]
+            if not len(columns):
+                continue
+            scores = counts / np.sqrt(float(reader_counts[row]) * reader_counts[columns])
+            best = np.lexsort((book_ids[columns], -scores))[:top_k]
+            yield int(book_ids[row]), [(int(book_ids[columns[i]]), int(counts[i]), float(scores[i]))
+                                       for i in best]
+
+
+def _neighbours_sql(top_k, max_user_books, min_shared):
+    pairs = _reader_pairs(max_user_books).cte('light_pairs')
+    readers = (select(pairs.c.book_id, func.count().label('readers'))
+               .group_by(pairs.c.book_id).cte('book_readers'))
+    a, b = pairs.alias('a'), pairs.alias('b')
+    shared = (select(a.c.book_id, b.c.book_id.label('other_id'), func.count().label('shared'))
+              .join_from(a, b, and_(a.c.user_id == b.c.user_id, a.c.book_id != b.c.book_id))
+              .group_by(a.c.book_id, b.c.book_id)
+              .having(func.count() >= min_shared).cte('shared_readers'))
+    mine, theirs = readers.alias('mine'), readers.alias('theirs')
+    # Same order as the cosine, without needing sqrt() in SQL
+    closeness = shared.c.shared * shared.c.shared * 1.0 / (mine.c.readers * theirs.c.readers)
+    ranked = (select(shared.c.book_id, shared.c.other_id, shared.c.shared,
+                     mine.c.readers, theirs.c.readers.label('other_readers'),
+                     func.row_number().over(partition_by=shared.c.book_id,
+                                            order_by=(closeness.desc(), shared.c.other_id)).label('position'))
+              .join(mine, mine.c.book_id == shared.c.book_id)
+              .join(theirs, theirs.c.book_id == shared.c.other_id).subquery())
+    rows = db.session.execute(
+        select(ranked).where(ranked.c.position <= top_k).order_by(ranked.c.book_id, ranked.c.position)
+        .execution_options(yield_per=50000, allow_table_scan=True)
+    )
+    for book_id, group in groupby(rows, key=lambda row: row.book_id):
+        yield book_id, [(row.other_id, row.shared, row.shared / math.sqrt(row.readers * row.other_readers))
+                        for row in group]
+
+
+def _neighbours(top_k, max_user_books, min_shared):
+    try:
+        import numpy  # noqa: F401
+        import scipy.sparse  # noqa: F401
+    except ImportError:
+        logging.warning("NumPy/SciPy not installed (the recommendations extra); "
+                        "counting shared readers in the database")
+        return _neighbours_sql(top_k, max_user_books, min_shared)
+    return _neighbours_sparse(top_k, max_user_books, min_shared)
+
+
+def build(top_k=TOP_K, max_user_books=MAX_USER_BOOKS, min_shared=MIN_SHARED_READERS):
+    """Recompute book_recommendations; returns the number of books with recommendations."""
+    rows = [{'book_id': book_id, 'rank': rank, 'recommended_book_id': other_id,
+             'shared_readers': shared, 'score': score}
+            for book_id, neighbours in _neighbours(top_k, max_user_books, min_shared)
+            for rank, (other_id, shared, score) in enumerate(neighbours, 1)]
+    # One transaction, so pages see either the old table or the new one
+    db.session.execute(delete(BookRecommendation))
+    for start in range(0, len(rows), INSERT_BATCH):
+        db.session.execute(insert(BookRecommendation), rows[start:start + INSERT_BATCH])
+    db.session.commit()
+    page_cache.invalidate()
+    books = len({row['book_id'] for row in rows})
+    logging.info(f"Recommendations rebuilt: {len(rows)} for {books} books")
+    return books
+
+
+def for_books(book_ids, limit=LISTING_LIMIT):
+    """{book_id: [(id, title), ...]}: the closest few books to each of book_ids."""
+    if not book_ids:
+        return {}
+    rows = db.session.execute(
+        select(BookRecommendation.book_id, Book.id, Book.title)
+        .join(Book, Book.id == BookRecommendation.recommended_book_id)
+        .where(BookRecommendation.book_id.in_(book_ids), BookRecommendation.rank <= limit)
+        .order_by(BookRecommendation.book_id, BookRecommendation.rank)
+    )
+    result = {}
+    for book_id, other_id, title in rows:
+        result.setdefault(book_id, []).append((other_id, title))
+    return result
+
+
+def for_user(user_id, limit=6):
+    """Books close to the user's recent downloads that they have not downloaded."""
+    recent = (select(Download.book_id).where(Download.user_id == user_id)
+              .order_by(Download.downloaded_at.desc()).limit(RECENT_DOWNLOADS).subquery())
+    already = or_(
+        exists().where(Download.user_id == user_id,
+                       Download.book_id == BookRecommendation.recommended_book_id),
+        exists().where(CompactedDownload.user_id == user_id,
+                       CompactedDownload.book_id == BookRecommendation.recommended_book_id))
+    picks = (select(BookRecommendation.recommended_book_id.label('book_id'),
+                    func.sum(BookRecommendation.score).label('score'))
+             .where(BookRecommendation.book_id.in_(select(recent.c.book_id)), ~already)
+             .group_by(BookRecommendation.recommended_book_id).subquery())
+    return (queries.books().join(picks, picks.c.book_id == Book.id)
+            .order_by(picks.c.score.desc(), Book.id).limit(limit).all())
+
+
+def remove_book(book_id):
+    # Called inside the caller's transaction, before the book is deleted
+    db.session.execute(delete(BookRecommendation).where(BookRecommendation.book_id == book_id))
+    db.session.execute(delete(BookRecommendation).where(BookRecommendation.recommended_book_id == book_id))
@@ -0,0 +1,284 @@
+import os
+import re
+import logging
+from datetime import date, datetime, time, timedelta
+from flask import current_app
+from sqlalchemy import select, func, delete, insert, text, bindparam
+from app import db
+from models import Download, CompactedDownload
+import stats
+
+# Lifecycle of the downloads table, which gains a row (with the IP address)
+# for every download. `flask compact-downloads` keeps the events of the last
+# DOWNLOAD_RETENTION_DAYS and folds whole months before that into
+# compacted_downloads, one row per day, user and book, in the transaction
+# that removes them. Book and user counters and the per-book rollups
+# already include those downloads and do not change. Daily rows older than
+# DOWNLOAD_DAILY_HISTORY_DAYS are merged into one row per user and book, so
+# the history is bounded by the pairs of readers and books.
+#
+# On PostgreSQL downloads is partitioned by month (migration 7): a compacted
+# month is dropped as a partition instead of deleted row by row, and
+# ensure_partitions() creates DOWNLOAD_PARTITIONS_AHEAD months ahead. With
+# DOWNLOAD_ARCHIVE the raw events are kept out of the live table rather than
+# dropped: as a detached downloads_archive_YYYYMM table on PostgreSQL, in
+# instance/download-archive/downloads-YYYY-MM.db on SQLite.
+
+FOLD_BATCH = 5000
+DEFAULT_PARTITION = 'downloads_default'
+BOUND_RE = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+def _month(day):
+    return day.replace(day=1)
+
+
+def _next_month(month):
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+def _partition_name(month):
+    return f'downloads_p{month:%Y%m}'
+
+
+def _archive_name(month):
+    return f'downloads_archive_{month:%Y%m}'
+
+
+def _in_month(start, end):
+    return (Download.downloaded_at >= datetime.combine(start, time()),
+            Download.downloaded_at < datetime.combine(end, time()))
+
+
+def _bound(value):
+    return None if value == 'MINVALUE' else date.fromisoformat(value.strip("'")[:10])
+
+
+def _partitioned(conn):
+    if conn.dialect.name != 'postgresql':
+        return False
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('downloads')"
+    )).first() is not None
+
+
+def _partitions(conn):
+    """{name: (start, end)} of the range partitions; start is None for MINVALUE."""
+    rows = conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'downloads'::regclass"
+    ))
+    partitions = {}
+    for name, bound in rows:
+        match = BOUND_RE.search(bound)
+        if match:
+            partitions[name] = (_bound(match.group(1)), _bound(match.group(2)))
+    return partitions
+
+
+def partition_downloads():
+    """Turn the PostgreSQL downloads table into one partitioned by month."""
+    conn = db.session.connection()
+    if conn.dialect.name != 'postgresql' or _partitioned(conn):
+        return
+    # The existing rows stay where they are, as the partition for everything
+    # before next month
+    boundary = _next_month(_month(date.today()))
+    index_names = [index.name for index in Download.__table__.indexes]
+    statements = [
+        "UPDATE downloads SET downloaded_at = now() WHERE downloaded_at IS NULL",
+        "ALTER TABLE downloads ALTER COLUMN downloaded_at SET NOT NULL",
+        "ALTER TABLE downloads RENAME TO downloads_legacy",
+        "ALTER INDEX IF EXISTS downloads_pkey RENAME TO downloads_legacy_pkey",
+        *(f"ALTER INDEX IF EXISTS {name} RENAME TO {name.replace('ix_downloads', 'ix_downloads_legacy')}"
+          for name in index_names),
+        "CREATE TABLE downloads (LIKE downloads_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (downloaded_at)",
+        "ALTER TABLE downloads ADD PRIMARY KEY (id, downloaded_at)",
+        "ALTER TABLE downloads ADD FOREIGN KEY (user_id) REFERENCES users (id)",
+        "ALTER TABLE downloads ADD FOREIGN KEY (book_id) REFERENCES books (id)",
+        # Dropping the old partition must not take the id sequence with it
+        "ALTER SEQUENCE downloads_id_seq OWNED BY downloads.id",
+        f"ALTER TABLE downloads ATTACH PARTITION downloads_legacy FOR VALUES FROM (MINVALUE) TO ('{boundary}')",
+    ]
+    for statement in statements:
+        conn.execute(text(statement))
+    # Created on the parent, these adopt the renamed indexes of the old table
+    for index in Download.__table__.indexes:
+        index.create(conn)
+    conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF downloads DEFAULT"))
+    db.session.commit()
+
+
+def _create_partition(conn, start, end):
+    name = _partition_name(start)
+    bounds = f"FOR VALUES FROM ('{start}') TO ('{end}')"
+    window = {'start': datetime.combine(start, time()), 'end': datetime.combine(end, time())}
+    stray = conn.execute(text(
+        f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE downloaded_at >= :start AND downloaded_at < :end LIMIT 1"
+    ), window).first()
+    if stray is None:
+        conn.execute(text(f"CREATE TABLE {name} PARTITION OF downloads {bounds}"))
+        return
+    # Events that landed in the default partition move into the new month
+    conn.execute(text(f"ALTER TABLE downloads DETACH PARTITION {DEFAULT_PARTITION}"))
+    conn.execute(text(f"CREATE TABLE {name} PARTITION OF downloads {bounds}"))
+    in_window = "WHERE downloaded_at >= :start AND downloaded_at < :end"
+    conn.execute(text(f"INSERT INTO downloads SELECT * FROM {DEFAULT_PARTITION} {in_window}"), window)
+    conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} {in_window}"), window)
+    conn.execute(text(f"ALTER TABLE downloads ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+
+
+def ensure_partitions(ahead=None):
+    """Create the monthly partitions up to `ahead` months from now; returns how many."""
+    conn = db.session.connection()
+    if not _partitioned(conn):
+        return 0
+    if ahead is None:
+        ahead = current_app.config.get('DOWNLOAD_PARTITIONS_AHEAD', 3)
+    month = _month(date.today())
+    last = month
+    for _ in range(ahead):
+        last = _next_month(last)
+    covered = max((end for _, end in _partitions(conn).values()), default=month)
+    month = max(month, covered)
+    created = 0
+    while month <= last:
+        _create_partition(conn, month, _next_month(month))
+        month = _next_month(month)
+        created += 1
+    db.session.commit()
+    if created:
+        logging.info(f"Created {created} monthly download partitions")
+    return created
+
+
+def _fold(conn, start, end):
+    # Add the month's events to the compacted history; returns how many
+    day = stats.day_of(Download.downloaded_at).label('day')
+    rows = conn.execute(
+        select(day, Download.user_id, Download.book_id, func.count(Download.id))
+        .where(*_in_month(start, end))
+        .group_by(day, Download.user_id, Download.book_id)
+    ).all()
+    table = CompactedDownload.__table__
+    stmt = stats.upsert(conn.dialect.name)(table)
+    # Events replayed after their month was compacted land here again
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['day', 'user_id', 'book_id'],
+        set_={'download_count': table.c.download_count + stmt.excluded.download_count},
+    )
+    values = [{'day': d if isinstance(d, date) else date.fromisoformat(d),
+               'user_id': user_id, 'book_id': book_id, 'download_count': count}
+              for d, user_id, book_id, count in rows]
+    for first in range(0, len(values), FOLD_BATCH):
+        conn.execute(stmt, values[first:first + FOLD_BATCH])
+    return sum(value['download_count'] for value in values)
+
+
+def _attach_archive(conn, month):
+    directory = os.path.join(current_app.instance_path, 'download-archive')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'downloads-{month:%Y-%m}.db')
+    conn.exec_driver_sql("ATTACH DATABASE ? AS archive", (path,))
+    conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS archive.downloads AS SELECT * FROM main.downloads WHERE 0")
+
+
+def _remove_events(conn, start, end, archive):
+    if _partitioned(conn) and _partitions(conn).get(_partition_name(start)) == (start, end):
+        name = _partition_name(start)
+        if archive:
+            conn.execute(text(f"ALTER TABLE downloads DETACH PARTITION {name}"))
+            conn.execute(text(f"ALTER TABLE {name} RENAME TO {_archive_name(start)}"))
+        else:
+            conn.execute(text(f"DROP TABLE {name}"))
+        return
+    if archive:
+        if conn.dialect.name == 'postgresql':
+            target = _archive_name(start)
+            conn.execute(text(f"CREATE TABLE IF NOT EXISTS {target} (LIKE downloads)"))
+        else:
+            target = 'archive.downloads'
+        conn.execute(text(f"INSERT INTO {target} SELECT * FROM downloads "
+                          "WHERE downloaded_at >= :start AND downloaded_at < :end"),
+                     {'start': datetime.combine(start, time()), 'end': datetime.combine(end, time())})
+    conn.execute(delete(Download).where(*_in_month(start, end)))
+
+
+def _compact_month(start, end, archive):
+    # Folding and removing happen in one transaction, so a month is either
+    # still raw or fully compacted
+    attached = archive and db.engine.dialect.name == 'sqlite'
+    with db.engine.connect() as conn:
+        if attached:
+            # SQLite cannot attach inside a transaction
+            _attach_archive(conn, start)
+            conn.commit()
+        try:
+            with conn.begin():
+                events = _fold(conn, start, end)
+                _remove_events(conn, start, end, archive)
+        finally:
+            if attached:
+                conn.exec_driver_sql("DETACH DATABASE archive")
+    return events
+
+
+def _drop_emptied_partitions(cutoff):
+    # The partition a table had before partitioning spans many months; it
+    # goes once every one of them has been compacted
+    conn = db.session.connection()
+    for name, (_, end) in _partitions(conn).items():
+        if end <= cutoff:
+            conn.execute(text(f"DROP TABLE {name}"))
+    db.session.commit()
+
+
+def merge_daily_history(before):
+    """Merge compacted rows dated before `before` into one row per user and book."""
+    table = CompactedDownload.__table__
+    old = table.c.day < before
+    merged = db.session.execute(
+        select(table.c.user_id, table.c.book_id, func.min(table.c.day),
+               func.sum(table.c.download_count), func.count())
+        .where(old).group_by(table.c.user_id, table.c.book_id)
+        .having(func.count() > 1)
+    ).all()
+    conn = db.session.connection()
+    for first in range(0, len(merged), FOLD_BATCH):
+        batch = merged[first:first + FOLD_BATCH]
+        conn.execute(delete(table).where(old, table.c.user_id == bindparam('merged_user'),
+                                         table.c.book_id == bindparam('merged_book')),
+                     [{'merged_user': user_id, 'merged_book': book_id} for user_id, book_id, *_ in batch])
+        conn.execute(insert(table), [
+            {'day': day, 'user_id': user_id, 'book_id': book_id, 'download_count': count}
+            for user_id, book_id, day, count, _ in batch])
+    db.session.commit()
+    return sum(rows for *_, rows in merged) - len(merged)
+
+
+def compact(retention_days=None, daily_history_days=None, archive=None, today=None):
+    """Compact download events past retention; returns a summary dict."""
+    config = current_app.config
+    retention_days = config['DOWNLOAD_RETENTION_DAYS'] if retention_days is None else retention_days
+    daily_history_days = (config['DOWNLOAD_DAILY_HISTORY_DAYS']
+                          if daily_history_days is None else daily_history_days)
+    archive = config['DOWNLOAD_ARCHIVE'] if archive is None else archive
+    today = today or date.today()
+    summary = {'months': 0, 'events': 0, 'merged': 0}
+    if retention_days:
+        cutoff = _month(today - timedelta(days=retention_days))
+        oldest = db.session.execute(select(func.min(Download.downloaded_at))).scalar()
+        db.session.commit()
+        month = _month(oldest.date()) if oldest else cutoff
+        while month < cutoff:
+            events = _compact_month(month, _next_month(month), archive)
+            logging.info(f"Compacted {events} download events of {month:%Y-%m}")
+            summary['months'] += 1
+            summary['events'] += events
+            month = _next_month(month)
+        if _partitioned(db.session.connection()):
+            _drop_emptied_partitions(cutoff)
+            ensure_partitions()
+    if daily_history_days:
+        summary['merged'] = merge_daily_history(today - timedelta(days=daily_history_days))
+    return summary
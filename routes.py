@@ -1,15 +1,69 @@
 import os
-from datetime import datetime
-from flask import render_template, redirect, url_for, flash, request, send_file, abort, current_app
+import hmac
+from datetime import date, timedelta
+from flask import (render_template, redirect, url_for, flash, request, send_file, abort, current_app,
+                   jsonify, stream_with_context)
+from flask_wtf.csrf import validate_csrf
+from wtforms.validators import ValidationError
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
-from sqlalchemy import or_
-from app import app, db
+from app import db
 from models import User, Book, Category, Download
 from forms import (LoginForm, UserForm, EditUserForm, ChangePasswordForm, 
-                  CategoryForm, BookForm, EditBookForm, SearchForm, ResetPasswordForm)
+                  CategoryForm, BookForm, EditBookForm, SearchForm, ResetPasswordForm,
+                  UploadedBookForm, BOOK_EXTENSIONS)
+import search
+import fulltext
+import recommendations
+import counters
+import queries
+import stats
+import categories
+import covers
+import page_cache
+import identity
+from passwords import hasher, login_throttle, HashingBusy
+from pagination import KeysetPagination, approximate_count
+import transfers
+import chunked_upload
+from storage import storage, object_key
+import catalog_io
+from events import download_recorder
+from instrumentation import instrumentation
+from suggest import suggester
 
-@app.route('/')
+class RouteCollector:
+    """Collects the views at import time; create_app() attaches them to the app.
+
+    Unlike a blueprint this keeps the plain endpoint names ('index',
+    'admin_books', ...) that url_for() calls throughout the templates use.
+    """
+    def __init__(self):
+        self.rules = []
+        self.error_handlers = []
+
+    def route(self, rule, **options):
+        def decorator(view):
+            self.rules.append((rule, view, options))
+            return view
+        return decorator
+
+    def errorhandler(self, exception):
+        def decorator(handler):
+            self.error_handlers.append((exception, handler))
+            return handler
+        return decorator
+
+views = RouteCollector()
+
+def init_app(app):
+    for rule, view, options in views.rules:
+        app.add_url_rule(rule, view_func=view, **options)
+    for exception, handler in views.error_handlers:
+        app.register_error_handler(exception, handler)
+
+@views.route('/')
+@page_cache.cached_page
 def index():
     if current_user.is_authenticated:
         if current_user.is_admin:
@@ -18,31 +72,46 @@ def index():
             return redirect(url_for('user_dashboard'))
     
     # Show recent books for non-authenticated users
-    recent_books = Book.query.order_by(Book.uploaded_at.desc()).limit(6).all()
-    categories = Category.query.all()
-    return render_template('index.html', recent_books=recent_books, categories=categories)
+    recent_books = queries.recent_books()
+    return render_template('index.html', recent_books=recent_books,
+                         categories=categories.all_categories(),
+                         book_counts=queries.category_book_counts())
 
-@app.route('/login', methods=['GET', 'POST'])
+@views.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
     
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=form.username.data).first()
-        if user and user.check_password(form.password.data):
-            user.last_login = datetime.utcnow()
-            db.session.commit()
+        address, username = request.remote_addr, form.username.data
+        retry_after = login_throttle.retry_after(address, username)
+        if retry_after:
+            flash('Too many failed sign-in attempts. Please try again later.', 'danger')
+            return render_template('login.html', form=form), 429, {'Retry-After': str(retry_after)}
+        user = User.query.filter_by(username=username).first()
+        try:
+            valid = user is not None and user.check_password(form.password.data)
+            if valid and hasher.needs_rehash(user.password_hash):
+                user.set_password(form.password.data)
+                db.session.commit()
+        except HashingBusy:
+            flash('The library is busy signing readers in. Please try again in a moment.', 'warning')
+            return render_template('login.html', form=form), 503, {'Retry-After': '5'}
+        if valid:
+            login_throttle.succeeded(address, username)
+            identity.last_logins.record(user)
             login_user(user, remember=form.remember_me.data)
             next_page = request.args.get('next')
             if not next_page or not next_page.startswith('/'):
                 next_page = url_for('index')
             flash(f'Welcome back, {user.full_name}!', 'success')
             return redirect(next_page)
+        login_throttle.failed(address, username)
         flash('Invalid username or password', 'danger')
     return render_template('login.html', form=form)
 
-@app.route('/logout')
+@views.route('/logout')
 @login_required
 def logout():
     logout_user()
@@ -50,37 +119,66 @@ def logout():
     return redirect(url_for('index'))
 
 # Admin Routes
-@app.route('/admin')
+@views.route('/admin')
 @login_required
 def admin_dashboard():
     if not current_user.is_admin:
         flash('Access denied. Admin privileges required.', 'danger')
         return redirect(url_for('index'))
     
-    total_books = Book.query.count()
-    total_users = User.query.filter_by(is_admin=False).count()
-    total_downloads = Download.query.count()
-    recent_downloads = Download.query.order_by(Download.downloaded_at.desc()).limit(5).all()
+    recent_downloads = queries.recent_downloads()
     
     return render_template('admin/dashboard.html', 
-                         total_books=total_books,
-                         total_users=total_users, 
-                         total_downloads=total_downloads,
-                         recent_downloads=recent_downloads)
+                         recent_downloads=recent_downloads,
+                         trends=stats.download_trends(),
+                         **stats.dashboard_totals())
 
-@app.route('/admin/books')
+@views.route('/admin/books')
 @login_required
 def admin_books():
     if not current_user.is_admin:
         flash('Access denied. Admin privileges required.', 'danger')
         return redirect(url_for('index'))
     
-    page = request.args.get('page', 1, type=int)
-    books = Book.query.order_by(Book.uploaded_at.desc()).paginate(
-        page=page, per_page=10, error_out=False)
+    books = KeysetPagination(queries.books('admin_book_list'), Book.uploaded_at, Book.id,
+                             per_page=10,
+                             after=request.args.get('after'),
+                             before=request.args.get('before'),
+                             total=stats.total_books())
     return render_template('admin/books.html', books=books)
 
-@app.route('/admin/books/add', methods=['GET', 'POST'])
+def _create_book(form, filename, file_hash, file_size):
+    # Handle cover image upload; thumbnails are rendered in the background
+    cover_image = None
+    cover_path = None
+    if form.cover.data:
+        cover_image, cover_path = covers.store_cover(form.cover.data)
+        covers.process_cover(cover_image)
+    
+    book = Book(
+        title=form.title.data,
+        author=form.author.data,
+        description=form.description.data,
+        category_id=form.category_id.data,
+        filename=filename,
+        file_path=object_key(file_hash),
+        file_size=file_size,
+        file_hash=file_hash,
+        cover_image=cover_image,
+        cover_path=cover_path,
+        uploaded_by=current_user.id
+    )
+    db.session.add(book)
+    db.session.flush()
+    search.index_book(book)
+    db.session.commit()
+    stats.books_changed()
+    page_cache.invalidate()
+    suggester.book_saved(book)
+    fulltext.queue_extraction(book.id, current_app.config['TEXT_EXTRACT_WORKERS'])
+    return book
+
+@views.route('/admin/books/add', methods=['GET', 'POST'])
 @login_required
 def admin_add_book():
     if not current_user.is_admin:
@@ -92,50 +190,93 @@ def admin_add_book():
         file = form.file.data
         filename = secure_filename(file.filename)
         
-        # Ensure uploads directory exists
-        upload_dir = os.path.join(os.getcwd(), 'uploads')
-        os.makedirs(upload_dir, exist_ok=True)
-        
-        # Create full file path
-        file_path = os.path.join(upload_dir, filename)
-        file.save(file_path)
-        
-        # Handle cover image upload
-        cover_image = None
-        cover_path = None
-        if form.cover.data:
-            cover_file = form.cover.data
-            cover_filename = secure_filename(cover_file.filename)
-            
-            # Ensure covers directory exists
-            covers_dir = os.path.join(os.getcwd(), 'covers')
-            os.makedirs(covers_dir, exist_ok=True)
-            
-            # Create full cover path
-            cover_path = os.path.join(covers_dir, cover_filename)
-            cover_file.save(cover_path)
-            cover_image = cover_filename
-        
-        book = Book(
-            title=form.title.data,
-            author=form.author.data,
-            description=form.description.data,
-            category_id=form.category_id.data,
-            filename=filename,
-            file_path=file_path,
-            file_size=os.path.getsize(file_path),
-            cover_image=cover_image,
-            cover_path=cover_path,
-            uploaded_by=current_user.id
-        )
-        db.session.add(book)
-        db.session.commit()
+        # Stored under its content hash; identical files are kept once
+        file_hash, file_size = storage.save_upload(file)
+        _create_book(form, filename, file_hash, file_size)
         flash('Book uploaded successfully!', 'success')
         return redirect(url_for('admin_books'))
     
-    return render_template('admin/add_book.html', form=form)
+    return render_template('admin/add_book.html', form=form,
+                         chunk_size=current_app.config['UPLOAD_CHUNK_SIZE'],
+                         max_upload_size=current_app.config['BOOK_UPLOAD_MAX_SIZE'])
+
+# Chunked, resumable book uploads used by the add-book page
+def _upload_api_error():
+    if not current_user.is_admin:
+        return jsonify(error='Admin privileges required.'), 403
+    if not current_app.config.get('WTF_CSRF_ENABLED', True):
+        return None
+    try:
+        validate_csrf(request.headers.get('X-CSRFToken'))
+    except ValidationError:
+        return jsonify(error='The CSRF token is missing or invalid.'), 400
+    return None
+
+@views.errorhandler(HashingBusy)
+def hashing_busy(error):
+    # Password changes and resets outside login when the hashing pool is full
+    flash('The server is busy. Please try again in a moment.', 'warning')
+    return redirect(request.referrer or url_for('index')), 303
+
+@views.errorhandler(chunked_upload.UploadError)
+def upload_error(error):
+    return jsonify(error=str(error)), error.status
+
+def _upload_headers(upload):
+    return {'Upload-Offset': str(upload.received), 'Upload-Length': str(upload.total_size),
+            'Cache-Control': 'no-store'}
+
+@views.route('/admin/uploads', methods=['POST'])
+@login_required
+def admin_create_upload():
+    error = _upload_api_error()
+    if error:
+        return error
+    
+    data = request.get_json(silent=True) or {}
+    size = data.get('size')
+    upload = chunked_upload.create_upload(
+        current_user.id, data.get('filename'), size if isinstance(size, int) else None,
+        BOOK_EXTENSIONS, current_app.config['BOOK_UPLOAD_MAX_SIZE'])
+    location = url_for('admin_upload', upload_id=upload.id)
+    return jsonify(id=upload.id, location=location), 201, \
+        dict(_upload_headers(upload), Location=location)
 
-@app.route('/admin/books/edit/<int:id>', methods=['GET', 'POST'])
+@views.route('/admin/uploads/<upload_id>', methods=['HEAD', 'PATCH', 'DELETE'])
+@login_required
+def admin_upload(upload_id):
+    error = _upload_api_error()
+    if error:
+        return error
+    
+    upload = chunked_upload.get_upload(upload_id, current_user.id)
+    if request.method == 'PATCH':
+        offset = request.headers.get('Upload-Offset', type=int)
+        if offset is None:
+            return jsonify(error='Upload-Offset header is required.'), 400
+        chunked_upload.append_chunk(upload, offset, request.stream, request.content_length)
+    elif request.method == 'DELETE':
+        chunked_upload.cancel_upload(upload)
+        return '', 204
+    return '', 204, _upload_headers(upload)
+
+@views.route('/admin/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def admin_complete_upload(upload_id):
+    if not current_user.is_admin:
+        return jsonify(error='Admin privileges required.'), 403
+    
+    form = UploadedBookForm()
+    if not form.validate_on_submit():
+        return jsonify(error='Please correct the book details.', fields=form.errors), 400
+    
+    upload = chunked_upload.get_upload(upload_id, current_user.id)
+    filename, _, file_size, file_hash = chunked_upload.complete_upload(upload)
+    _create_book(form, filename, file_hash, file_size)
+    flash('Book uploaded successfully!', 'success')
+    return jsonify(redirect=url_for('admin_books'))
+
+@views.route('/admin/books/edit/<int:id>', methods=['GET', 'POST'])
 @login_required
 def admin_edit_book(id):
     if not current_user.is_admin:
@@ -153,34 +294,28 @@ def admin_edit_book(id):
         
         # Handle cover image update
         if form.cover.data:
-            # Delete old cover if exists
-            if book.cover_path and os.path.exists(book.cover_path):
+            old_cover = book.cover_image
+            book.cover_image, book.cover_path = covers.store_cover(form.cover.data)
+            covers.process_cover(book.cover_image)
+            
+            # Delete old cover if no other book shares it
+            if old_cover and old_cover != book.cover_image and not queries.cover_in_use(old_cover, book.id):
                 try:
-                    os.remove(book.cover_path)
+                    covers.remove_cover(old_cover)
                 except Exception as e:
-                    current_app.logger.error(f"Error deleting old cover {book.cover_path}: {e}")
-            
-            cover_file = form.cover.data
-            cover_filename = secure_filename(cover_file.filename)
-            
-            # Ensure covers directory exists
-            covers_dir = os.path.join(os.getcwd(), 'covers')
-            os.makedirs(covers_dir, exist_ok=True)
-            
-            # Create full cover path
-            cover_path = os.path.join(covers_dir, cover_filename)
-            cover_file.save(cover_path)
-            
-            book.cover_image = cover_filename
-            book.cover_path = cover_path
+                    current_app.logger.error(f"Error deleting old cover {old_cover}: {e}")
         
+        db.session.flush()
+        search.index_book(book)
         db.session.commit()
+        page_cache.invalidate()
+        suggester.book_saved(book)
         flash('Book updated successfully!', 'success')
         return redirect(url_for('admin_books'))
     
     return render_template('admin/edit_book.html', form=form, book=book)
 
-@app.route('/admin/books/delete/<int:id>')
+@views.route('/admin/books/delete/<int:id>')
 @login_required
 def admin_delete_book(id):
     if not current_user.is_admin:
@@ -188,40 +323,60 @@ def admin_delete_book(id):
         return redirect(url_for('index'))
     
     book = Book.query.get_or_404(id)
+    # This worker's buffered downloads of the book must reach the table before
+    # forget_book_downloads() takes them off the counters. Flushed before this
+    # request writes anything, as the flush commits on its own connection.
+    # Events other workers still hold for the book are dead-lettered instead
+    download_recorder.flush()
     
-    # Delete file from filesystem
+    # Delete file from filesystem; stored files are released after the commit
     try:
-        # Ensure the file path is absolute
-        if not os.path.isabs(book.file_path):
-            file_path = os.path.join(os.getcwd(), book.file_path)
-        else:
-            file_path = book.file_path
-            
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            
-        # Delete cover image if exists
-        if book.cover_path and os.path.exists(book.cover_path):
-            os.remove(book.cover_path)
+        if not book.file_hash:
+            file_path = transfers.book_file_path(book)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        
+        # Delete cover image and its variants unless another book shares it
+        if book.cover_image and not queries.cover_in_use(book.cover_image, book.id):
+            covers.remove_cover(book.cover_image)
     except Exception as e:
         current_app.logger.error(f"Error deleting files: {e}")
     
+    file_hash = book.file_hash
+    search.remove_book(book.id)
+    fulltext.remove_book(book.id)
+    recommendations.remove_book(book.id)
+    counters.forget_book_downloads(book.id)
     db.session.delete(book)
     db.session.commit()
+    if file_hash:
+        try:
+            storage.release(file_hash)
+        except Exception as e:
+            current_app.logger.error(f"Error releasing stored file {file_hash}: {e}")
+    stats.books_changed()
+    page_cache.invalidate()
+    suggester.book_removed(id)
     flash('Book deleted successfully!', 'success')
     return redirect(url_for('admin_books'))
 
-@app.route('/admin/users')
+@views.route('/admin/users')
 @login_required
 def admin_users():
     if not current_user.is_admin:
         flash('Access denied. Admin privileges required.', 'danger')
         return redirect(url_for('index'))
     
-    users = User.query.filter_by(is_admin=False).order_by(User.created_at.desc()).all()
-    return render_template('admin/users.html', users=users)
+    users = KeysetPagination(User.query.filter_by(is_admin=False), User.created_at, User.id,
+                             per_page=20,
+                             after=request.args.get('after'),
+                             before=request.args.get('before'),
+                             total=stats.total_users())
+    # Only the users on this page, so the window covers their downloads alone
+    recent_downloads = queries.recent_downloads_by_user([user.id for user in users.items])
+    return render_template('admin/users.html', users=users, recent_downloads=recent_downloads)
 
-@app.route('/admin/users/add', methods=['GET', 'POST'])
+@views.route('/admin/users/add', methods=['GET', 'POST'])
 @login_required
 def admin_add_user():
     if not current_user.is_admin:
@@ -239,12 +394,13 @@ def admin_add_user():
         user.set_password(form.password.data)
         db.session.add(user)
         db.session.commit()
+        stats.users_changed()
         flash('User created successfully!', 'success')
         return redirect(url_for('admin_users'))
     
     return render_template('admin/add_user.html', form=form)
 
-@app.route('/admin/users/reset-password/<int:id>', methods=['GET', 'POST'])
+@views.route('/admin/users/reset-password/<int:id>', methods=['GET', 'POST'])
 @login_required
 def admin_reset_user_password(id):
     if not current_user.is_admin:
@@ -260,12 +416,13 @@ def admin_reset_user_password(id):
     if form.validate_on_submit():
         user.set_password(form.password.data)
         db.session.commit()
+        identity.invalidate()
         flash(f'Password reset successfully for user {user.username}!', 'success')
         return redirect(url_for('admin_users'))
     
     return render_template('admin/reset_password.html', form=form, user=user)
 
-@app.route('/admin/users/delete/<int:id>')
+@views.route('/admin/users/delete/<int:id>')
 @login_required
 def admin_delete_user(id):
     if not current_user.is_admin:
@@ -277,24 +434,64 @@ def admin_delete_user(id):
         flash('Cannot delete admin users.', 'danger')
         return redirect(url_for('admin_users'))
     
+    # Their unfinished uploads reference the user row
+    chunked_upload.cancel_user_uploads(user.id)
     db.session.delete(user)
     db.session.commit()
+    stats.users_changed()
+    identity.invalidate()
     flash('User deleted successfully!', 'success')
     return redirect(url_for('admin_users'))
 
-@app.route('/admin/downloads')
+@views.route('/admin/downloads')
 @login_required
 def admin_downloads():
     if not current_user.is_admin:
         flash('Access denied. Admin privileges required.', 'danger')
         return redirect(url_for('index'))
     
-    page = request.args.get('page', 1, type=int)
-    downloads = Download.query.order_by(Download.downloaded_at.desc()).paginate(
-        page=page, per_page=20, error_out=False)
-    return render_template('admin/downloads.html', downloads=downloads)
+    downloads = KeysetPagination(queries.downloads(), Download.downloaded_at, Download.id,
+                                 per_page=20,
+                                 after=request.args.get('after'),
+                                 before=request.args.get('before'),
+                                 total=stats.total_downloads())
+    return render_template('admin/downloads.html', downloads=downloads,
+                         categories=categories.all_categories(),
+                         parquet_available=catalog_io.parquet_available())
 
-@app.route('/admin/categories', methods=['GET', 'POST'])
+@views.route('/admin/downloads/export')
+@login_required
+def admin_export_downloads():
+    if not current_user.is_admin:
+        flash('Access denied. Admin privileges required.', 'danger')
+        return redirect(url_for('index'))
+    
+    fmt = request.args.get('format', 'csv')
+    start = request.args.get('start', type=date.fromisoformat)
+    end = request.args.get('end', type=date.fromisoformat)
+    # Rows are read with a streaming cursor and sent as they are encoded
+    rows = catalog_io.download_rows(start, end + timedelta(days=1) if end else None,
+                                    request.args.get('category', type=int))
+    if fmt == 'parquet':
+        if not catalog_io.parquet_available():
+            flash('Parquet export requires the pyarrow package.', 'danger')
+            return redirect(url_for('admin_downloads'))
+        body = catalog_io.iter_parquet(rows, catalog_io.DOWNLOAD_PARQUET_TYPES)
+        mimetype = 'application/vnd.apache.parquet'
+    else:
+        fmt = 'csv'
+        body = catalog_io.iter_csv(rows, catalog_io.DOWNLOAD_FIELDS)
+        mimetype = 'text/csv'
+    
+    filename = f'downloads-{date.today().isoformat()}.{fmt}'
+    return current_app.response_class(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={filename}',
+        'Cache-Control': 'no-store',
+        # Let nginx pass chunks on instead of buffering the whole export
+        'X-Accel-Buffering': 'no',
+    })
+
+@views.route('/admin/categories', methods=['GET', 'POST'])
 @login_required
 def admin_categories():
     if not current_user.is_admin:
@@ -309,13 +506,18 @@ def admin_categories():
         )
         db.session.add(category)
         db.session.commit()
+        categories.invalidate()
+        page_cache.invalidate()
+        suggester.categories_changed()
         flash('Category created successfully!', 'success')
         return redirect(url_for('admin_categories'))
     
-    categories = Category.query.order_by(Category.name).all()
-    return render_template('admin/categories.html', form=form, categories=categories)
+    category_list = categories.all_categories()
+    return render_template('admin/categories.html', form=form, categories=category_list,
+                         book_counts=queries.category_book_counts(),
+                         category_books=queries.books_by_category([c.id for c in category_list]))
 
-@app.route('/admin/categories/delete/<int:id>')
+@views.route('/admin/categories/delete/<int:id>')
 @login_required
 def admin_delete_category(id):
     if not current_user.is_admin:
@@ -325,83 +527,100 @@ def admin_delete_category(id):
     category = Category.query.get_or_404(id)
     
     # Check if category has books
-    if len(category.books) > 0:
+    if queries.category_has_books(category.id):
         flash('Cannot delete category that contains books. Please move or delete the books first.', 'danger')
         return redirect(url_for('admin_categories'))
     
     db.session.delete(category)
     db.session.commit()
+    categories.invalidate()
+    page_cache.invalidate()
+    suggester.categories_changed()
     flash('Category deleted successfully!', 'success')
     return redirect(url_for('admin_categories'))
 
 # User Routes
-@app.route('/dashboard')
+@views.route('/dashboard')
 @login_required
 def user_dashboard():
     if current_user.is_admin:
         return redirect(url_for('admin_dashboard'))
     
-    recent_books = Book.query.order_by(Book.uploaded_at.desc()).limit(6).all()
-    user_downloads = Download.query.filter_by(user_id=current_user.id).count()
+    recent_books = queries.recent_books()
+    recommended_books = recommendations.for_user(current_user.id)
+    user_downloads = current_user.download_count
     return render_template('user/dashboard.html', 
                          recent_books=recent_books, 
+                         recommended_books=recommended_books, 
                          user_downloads=user_downloads)
 
-@app.route('/books')
+@views.route('/books')
+@page_cache.cached_page
 def books():
     form = SearchForm()
     page = request.args.get('page', 1, type=int)
     query = request.args.get('query', '')
     category_id = request.args.get('category', 0, type=int)
+    in_content = request.args.get('content', 0, type=int) == 1
+    snippets = {}
     
-    books_query = Book.query
-    
-    if query:
-        books_query = books_query.filter(
-            or_(Book.title.contains(query), Book.author.contains(query))
-        )
+    books_query = queries.books()
     
     if category_id:
         books_query = books_query.filter_by(category_id=category_id)
     
-    books = books_query.order_by(Book.uploaded_at.desc()).paginate(
-        page=page, per_page=12, error_out=False)
-    
-    categories = Category.query.all()
+    if query:
+        # Ranked full-text match; relevance first, newest first on ties.
+        # Matches are few, so these keep numbered pages
+        if in_content:
+            books_query = search.search_content(books_query, query)
+        else:
+            books_query = search.search_books(books_query, query)
+        books = books_query.order_by(Book.uploaded_at.desc()).paginate(
+            page=page, per_page=12, error_out=False)
+        if in_content:
+            snippets = fulltext.snippets([book.id for book in books.items], query)
+    else:
+        if category_id:
+            total, estimated = approximate_count(books_query)
+        else:
+            total, estimated = stats.total_books(), False
+        books = KeysetPagination(books_query, Book.uploaded_at, Book.id,
+                                 per_page=12,
+                                 after=request.args.get('after'),
+                                 before=request.args.get('before'),
+                                 total=total, total_is_estimate=estimated)
+    
+    also_downloaded = recommendations.for_books([book.id for book in books.items])
     return render_template('user/books.html', 
                          books=books, 
                          form=form, 
-                         categories=categories,
+                         categories=categories.all_categories(),
                          query=query,
+                         in_content=in_content,
+                         snippets=snippets,
+                         also_downloaded=also_downloaded,
                          selected_category=category_id)
 
-@app.route('/download/<int:book_id>')
+@views.route('/download/<int:book_id>')
 @login_required
 def download_book(book_id):
     book = Book.query.get_or_404(book_id)
     
-    # Record download
-    download = Download(
-        user_id=current_user.id,
-        book_id=book.id,
-        ip_address=request.remote_addr
-    )
-    db.session.add(download)
-    db.session.commit()
-    
     try:
-        # Ensure the file path is absolute
-        if not os.path.isabs(book.file_path):
-            file_path = os.path.join(os.getcwd(), book.file_path)
-        else:
-            file_path = book.file_path
-            
-        return send_file(file_path, as_attachment=True, download_name=book.filename)
+        response = transfers.send_book(book)
     except FileNotFoundError:
         flash('File not found. Please contact administrator.', 'danger')
         return redirect(url_for('books'))
+    
+    # Record download (not for resumed ranges or cache revalidations);
+    # the row is written in the background by the download event recorder
+    if transfers.is_new_download(response):
+        download_recorder.record(current_user.id, book.id, request.remote_addr)
+    
+    return response
 
-@app.route('/profile', methods=['GET', 'POST'])
+@views.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
     if current_user.is_admin:
@@ -416,6 +635,7 @@ def profile():
         current_user.email = form.email.data
         current_user.full_name = form.full_name.data
         db.session.commit()
+        identity.invalidate()
         flash('Profile updated successfully!', 'success')
         return redirect(url_for('profile'))
     
@@ -423,23 +643,68 @@ def profile():
         if current_user.check_password(password_form.current_password.data):
             current_user.set_password(password_form.password.data)
             db.session.commit()
+            identity.invalidate()
             flash('Password changed successfully!', 'success')
             return redirect(url_for('profile'))
         else:
             flash('Current password is incorrect.', 'danger')
     
-    user_downloads = Download.query.filter_by(user_id=current_user.id).order_by(
-        Download.downloaded_at.desc()).limit(10).all()
+    user_downloads = queries.user_downloads(current_user.id)
     
     return render_template('user/profile.html', 
                          form=form, 
                          password_form=password_form,
                          user_downloads=user_downloads)
 
+@views.route('/api/suggest')
+def api_suggest():
+    query = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', 8, type=int), 1), 20)
+    suggestions = []
+    if len(query) >= 2:
+        for item in suggester.suggest(query[:100], limit):
+            if item['kind'] == 'category':
+                url = url_for('books', category=item['target'])
+            else:
+                url = url_for('books', query=item['target'])
+            suggestions.append({'kind': item['kind'], 'text': item['text'], 'detail': item['detail'], 'url': url})
+    response = jsonify(query=query, suggestions=suggestions)
+    # Same data for everyone; let the browser reuse it while the user types
+    response.cache_control.public = True
+    response.cache_control.max_age = 30
+    return response
+
+@views.route('/metrics')
+def metrics():
+    if not instrumentation.enabled:
+        abort(404)
+    # Scrapers send METRICS_TOKEN as a bearer token; admins can look in the browser
+    token = current_app.config.get('METRICS_TOKEN')
+    scraper = token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not scraper and not (current_user.is_authenticated and current_user.is_admin):
+        abort(403)
+    response = current_app.response_class(instrumentation.render(),
+                                          mimetype='text/plain; version=0.0.4')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 # Route to serve cover images
-@app.route('/covers/<filename>')
+@views.route('/covers/<filename>')
 def cover_image(filename):
-    covers_dir = os.path.join(os.getcwd(), 'covers')
-    return send_file(os.path.join(covers_dir, filename))
-
-# Initialize default categories (moved to app.py)
+    # ?w= picks the smallest thumbnail at least that wide, in the best format
+    # the browser accepts; without it (or before processing) the original
+    filename = secure_filename(filename)
+    width = request.args.get('w', type=int)
+    path, is_variant = covers.pick_variant(filename, width, request.accept_mimetypes)
+    try:
+        response = send_file(path, max_age=3600)
+    except FileNotFoundError:
+        abort(404)
+    response.vary.add('Accept')
+    # Digest-named covers never change; a thumbnail URL still being served
+    # the original keeps the short lifetime so the variant replaces it
+    if covers.DIGEST_NAME_RE.match(filename) and (is_variant or not width):
+        response.cache_control.max_age = 31536000
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
@@ -0,0 +1,243 @@
+import re
+from sqlalchemy import text, func, literal_column, false, select, table, column
+from app import db
+
+# Full-text index over title, author, description and category name.
+# SQLite uses an FTS5 virtual table keyed by the book id; PostgreSQL uses a
+# side table holding a weighted tsvector with a GIN index.
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _dialect():
+    return db.engine.dialect.name
+
+
+def _terms(query):
+    return [t.lower() for t in TOKEN_RE.findall(query or '')]
+
+
+def init_search_index():
+    """Create the search index if needed. Returns True when it was just created."""
+    if _dialect() == 'postgresql':
+        exists = db.session.execute(text("SELECT to_regclass('book_search')")).scalar()
+        if exists:
+            return False
+        db.session.execute(text(
+            "CREATE TABLE book_search ("
+            " book_id INTEGER PRIMARY KEY REFERENCES books(id) ON DELETE CASCADE,"
+            " document TSVECTOR NOT NULL)"
+        ))
+        db.session.execute(text(
+            "CREATE INDEX ix_book_search_document ON book_search USING GIN (document)"
+        ))
+    else:
+        exists = db.session.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'"
+        )).scalar()
+        if exists:
+            return False
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE books_fts USING fts5("
+            "title, author, description, category, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        ))
+    db.session.commit()
+    return True
+
+
+def _book_document(book):
+    from models import Category
+    # Look the category up by id so an edited category_id is never stale
+    category = db.session.get(Category, book.category_id)
+    return {
+        'book_id': book.id,
+        'title': book.title or '',
+        'author': book.author or '',
+        'description': book.description or '',
+        'category': category.name if category else '',
+    }
+
+
+def index_book(book):
+    # Called inside the caller's transaction, after the book has an id
+    params = _book_document(book)
+    if _dialect() == 'postgresql':
+        db.session.execute(text(
+            "INSERT INTO book_search (book_id, document) VALUES (:book_id,"
+            " setweight(to_tsvector('simple', :title), 'A') ||"
+            " setweight(to_tsvector('simple', :author), 'A') ||"
+            " setweight(to_tsvector('simple', :category), 'B') ||"
+            " setweight(to_tsvector('simple', :description), 'C'))"
+            " ON CONFLICT (book_id) DO UPDATE SET document = EXCLUDED.document"
+        ), params)
+    else:
+        db.session.execute(text("DELETE FROM books_fts WHERE rowid = :book_id"), params)
+        db.session.execute(text(
+            "INSERT INTO books_fts (rowid, title, author, description, category)"
+            " VALUES (:book_id, :title, :author, :description, :category)"
+        ), params)
+
+
+def remove_book(book_id):
+    if _dialect() == 'postgresql':
+        db.session.execute(text("DELETE FROM book_search WHERE book_id = :book_id"),
+                           {'book_id': book_id})
+    else:
+        db.session.execute(text("DELETE FROM books_fts WHERE rowid = :book_id"),
+                           {'book_id': book_id})
+
+
+def rebuild_index():
+    from models import Book
+    init_search_index()
+    if _dialect() == 'postgresql':
+        db.session.execute(text("DELETE FROM book_search"))
+    else:
+        db.session.execute(text("DELETE FROM books_fts"))
+    count = 0
+    for book in Book.query.order_by(Book.id).yield_per(500):
+        index_book(book)
+        count += 1
+    db.session.commit()
+    return count
+
+
+def search_books(books_query, query):
+    """Restrict a Book query to full-text matches, ordered by relevance.
+
+    Every term is matched as a prefix, so partial words typed into the search
+    box still find results.
+    """
+    from models import Book
+    terms = _terms(query)
+    if not terms:
+        return books_query.filter(false())
+
+    if _dialect() == 'postgresql':
+        book_search = table('book_search', column('book_id'), column('document'))
+        tsquery = func.to_tsquery('simple', ' & '.join(f"{term}:*" for term in terms))
+        matches = select(
+            book_search.c.book_id,
+            func.ts_rank(book_search.c.document, tsquery).label('rank'),
+        ).where(book_search.c.document.op('@@')(tsquery)).subquery()
+        rank = matches.c.rank.desc()
+    else:
+        books_fts = table('books_fts', column('rowid'))
+        match = ' '.join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+        # bm25() is lower-is-better; weight title/author above category and description
+        matches = select(
+            books_fts.c.rowid.label('book_id'),
+            func.bm25(literal_column('books_fts'), 10.0, 10.0, 1.0, 3.0).label('rank'),
+        ).where(text('books_fts MATCH :match').bindparams(match=match)).subquery()
+        rank = matches.c.rank.asc()
+
+    return books_query.join(matches, matches.c.book_id == Book.id).order_by(rank)
+
+
+# Book content. Extracted pages (fulltext.py) are indexed one row per page:
+# SQLite uses a contentless FTS5 table keyed by the book_pages id, since the
+# text itself is kept compressed in book_pages; PostgreSQL a side table of
+# tsvectors with a GIN index.
+
+def init_content_index():
+    """Create the page index if needed. Returns True when it was just created."""
+    if _dialect() == 'postgresql':
+        if db.session.execute(text("SELECT to_regclass('book_page_search')")).scalar():
+            return False
+        db.session.execute(text(
+            "CREATE TABLE book_page_search ("
+            " page_id INTEGER PRIMARY KEY REFERENCES book_pages(id) ON DELETE CASCADE,"
+            " document TSVECTOR NOT NULL)"
+        ))
+        db.session.execute(text(
+            "CREATE INDEX ix_book_page_search_document ON book_page_search USING GIN (document)"
+        ))
+    else:
+        exists = db.session.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'book_pages_fts'"
+        )).scalar()
+        if exists:
+            return False
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE book_pages_fts USING fts5("
+            "body, content = '', tokenize = 'unicode61 remove_diacritics 2')"
+        ))
+    db.session.commit()
+    return True
+
+
+def index_pages(pages):
+    """Index (page_id, text) pairs inside the caller's transaction."""
+    rows = [{'page_id': page_id, 'body': body} for page_id, body in pages]
+    if not rows:
+        return
+    if _dialect() == 'postgresql':
+        db.session.execute(text(
+            "INSERT INTO book_page_search (page_id, document)"
+            " VALUES (:page_id, to_tsvector('simple', :body))"
+        ), rows)
+    else:
+        db.session.execute(text(
+            "INSERT INTO book_pages_fts (rowid, body) VALUES (:page_id, :body)"
+        ), rows)
+
+
+def unindex_pages(pages):
+    """Remove (page_id, text) pairs; call before deleting the book_pages rows."""
+    rows = [{'page_id': page_id, 'body': body} for page_id, body in pages]
+    if not rows or _dialect() == 'postgresql':
+        # PostgreSQL drops the rows with their pages (ON DELETE CASCADE)
+        return
+    # A contentless table needs the original text to take a row out
+    db.session.execute(text(
+        "INSERT INTO book_pages_fts (book_pages_fts, rowid, body)"
+        " VALUES ('delete', :page_id, :body)"
+    ), rows)
+
+
+def _page_matches(query):
+    from models import BookPage
+    terms = _terms(query)
+    pages = BookPage.__table__
+    if _dialect() == 'postgresql':
+        book_page_search = table('book_page_search', column('page_id'), column('document'))
+        tsquery = func.to_tsquery('simple', ' & '.join(f"{term}:*" for term in terms))
+        return (select(pages.c.id, pages.c.book_id,
+                       (-func.ts_rank(book_page_search.c.document, tsquery)).label('rank'))
+                .join(book_page_search, book_page_search.c.page_id == pages.c.id)
+                .where(book_page_search.c.document.op('@@')(tsquery)))
+    # The rank column is bm25(); calling bm25() directly fails once SQLite
+    # flattens this into the grouped and windowed queries below
+    book_pages_fts = table('book_pages_fts', column('rowid'), column('rank'))
+    match = ' '.join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+    return (select(pages.c.id, pages.c.book_id, book_pages_fts.c.rank.label('rank'))
+            .select_from(book_pages_fts)
+            .join(pages, pages.c.id == book_pages_fts.c.rowid)
+            .where(text('book_pages_fts MATCH :content_match').bindparams(content_match=match)))
+
+
+def search_content(books_query, query):
+    """Restrict a Book query to books whose text matches, best page first."""
+    from models import Book
+    if not _terms(query):
+        return books_query.filter(false())
+    # Lower rank is better for both dialects here
+    pages = _page_matches(query).subquery()
+    matches = (select(pages.c.book_id, func.min(pages.c.rank).label('rank'))
+               .group_by(pages.c.book_id).subquery())
+    return books_query.join(matches, matches.c.book_id == Book.id).order_by(matches.c.rank)
+
+
+def best_pages(book_ids, query):
+    """The best matching page id of each book, as {book_id: page_id}."""
+    if not book_ids or not _terms(query):
+        return {}
+    from models import BookPage
+    pages = _page_matches(query).where(BookPage.__table__.c.book_id.in_(book_ids)).subquery()
+    ranked = select(
+        pages.c.id, pages.c.book_id,
+        func.row_number().over(partition_by=pages.c.book_id, order_by=pages.c.rank).label('position'),
+    ).subquery()
+    rows = db.session.execute(select(ranked.c.book_id, ranked.c.id).where(ranked.c.position == 1))
+    return dict(rows.all())
@@ -0,0 +1,90 @@
+import os
+import sys
+import multiprocessing
+
+# Production launcher: `python server.py` (`python server.py --dev` for the
+# threaded Werkzeug server instead).
+#
+# Runs the app under gunicorn with WEB_CONCURRENCY worker processes (default
+# 2 x cores + 1), each serving GUNICORN_THREADS requests at a time. The app
+# is loaded and the database prepared (bootstrap.prepare) once in the
+# master, and workers share its memory; every worker then opens its own
+# database connections. On SIGTERM gunicorn stops accepting requests, lets
+# running ones finish within GUNICORN_GRACEFUL_TIMEOUT, and each worker
+# flushes its buffered download events before exiting. gunicorn is a
+# dependency of the project; when it is missing the launcher stops rather
+# than quietly serving from a single process.
+
+def worker_count():
+    return int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+
+def post_fork(server, worker):
+    # Connections opened while loading the app belong to the master
+    from app import db
+    from main import app
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+def worker_exit(server, worker):
+    from events import download_recorder
+    from instrumentation import instrumentation
+    from identity import last_logins
+    download_recorder.close()
+    last_logins.close()
+    instrumentation.write_snapshot()
+
+def gunicorn_options():
+    return {
+        "bind": f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '5000')}",
+        "workers": worker_count(),
+        "worker_class": "gthread",
+        "threads": int(os.environ.get("GUNICORN_THREADS", 4)),
+        # Long enough for a chunk of a resumable upload on a slow link
+        "timeout": int(os.environ.get("GUNICORN_TIMEOUT", 120)),
+        "graceful_timeout": int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30)),
+        "keepalive": 5,
+        # Recycle workers now and then so slow leaks cannot build up
+        "max_requests": int(os.environ.get("GUNICORN_MAX_REQUESTS", 2000)),
+        "max_requests_jitter": 200,
+        "preload_app": True,
+        "accesslog": "-",
+        "loglevel": os.environ.get("LOG_LEVEL", "INFO").lower(),
+        "post_fork": post_fork,
+        "worker_exit": worker_exit,
+    }
+
+def run_werkzeug():
+    from main import app
+    import bootstrap
+    bootstrap.prepare(app)
+    app.run(host=os.environ.get("HOST", "0.0.0.0"), port=int(os.environ.get("PORT", 5000)),
+            threaded=True, debug=False)
+
+def run(dev=False):
+    os.environ.setdefault("APP_ENV", "production")
+    if dev:
+        run_werkzeug()
+        return
+    # The app splits its background CPUs between the workers
+    os.environ["WEB_CONCURRENCY"] = str(worker_count())
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit("gunicorn is not installed (uv sync installs it); "
+                 "use `python server.py --dev` for the single-process Werkzeug server")
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in gunicorn_options().items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from main import app
+            import bootstrap
+            bootstrap.prepare(app)
+            return app
+
+    Server().run()
+
+if __name__ == "__main__":
+    run(dev="--dev" in sys.argv[1:])
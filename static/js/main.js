@@ -73,6 +73,119 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
+    // Chunked, resumable book uploads. The file is sent in slices; an
+    // interrupted upload of the same file resumes from the server's offset
+    const uploadForm = document.querySelector('form[data-chunked-upload]');
+    if (uploadForm && window.fetch && window.File && File.prototype.slice) {
+        uploadForm.addEventListener('submit', function(e) {
+            const fileInput = uploadForm.querySelector('input[name="file"]');
+            const file = fileInput && fileInput.files[0];
+            if (!file) {
+                return;
+            }
+            e.preventDefault();
+            e.stopImmediatePropagation();
+            uploadBook(uploadForm, fileInput, file);
+        });
+    }
+
+    async function uploadBook(form, fileInput, file) {
+        const csrfToken = form.querySelector('input[name="csrf_token"]').value;
+        const chunkSize = parseInt(form.dataset.chunkSize, 10);
+        const progress = form.querySelector('[data-upload-progress]');
+        const bar = progress.querySelector('.progress-bar');
+        const errorBox = form.querySelector('[data-upload-error]');
+        const submitButton = form.querySelector('input[type="submit"], button[type="submit"]');
+        const resumeKey = 'upload:' + [file.name, file.size, file.lastModified].join(':');
+        const headers = {'X-CSRFToken': csrfToken};
+
+        function showProgress(offset) {
+            progress.classList.remove('d-none');
+            bar.style.width = Math.floor(offset * 100 / file.size) + '%';
+            bar.textContent = formatFileSize(offset) + ' / ' + formatFileSize(file.size);
+        }
+
+        async function failure(response) {
+            const data = await response.json().catch(function() { return {}; });
+            return new Error(data.error || 'Upload failed (' + response.status + ').');
+        }
+
+        submitButton.disabled = true;
+        errorBox.classList.add('d-none');
+        try {
+            let location = localStorage.getItem(resumeKey);
+            let offset = 0;
+            if (location) {
+                const head = await fetch(location, {method: 'HEAD', headers: headers});
+                if (head.ok) {
+                    offset = parseInt(head.headers.get('Upload-Offset'), 10);
+                } else {
+                    location = null;
+                }
+            }
+            if (!location) {
+                const created = await fetch(form.dataset.uploadUrl, {
+                    method: 'POST',
+                    headers: Object.assign({'Content-Type': 'application/json'}, headers),
+                    body: JSON.stringify({filename: file.name, size: file.size})
+                });
+                if (!created.ok) {
+                    throw await failure(created);
+                }
+                location = (await created.json()).location;
+                localStorage.setItem(resumeKey, location);
+            }
+
+            let retries = 0;
+            while (offset < file.size) {
+                showProgress(offset);
+                let response;
+                try {
+                    response = await fetch(location, {
+                        method: 'PATCH',
+                        headers: Object.assign({
+                            'Content-Type': 'application/offset+octet-stream',
+                            'Upload-Offset': String(offset)
+                        }, headers),
+                        body: file.slice(offset, offset + chunkSize)
+                    });
+                } catch (networkError) {
+                    response = null;
+                }
+                if (response && (response.ok || response.status === 409)) {
+                    const serverOffset = response.headers.get('Upload-Offset');
+                    if (serverOffset !== null) {
+                        offset = parseInt(serverOffset, 10);
+                    } else {
+                        const head = await fetch(location, {method: 'HEAD', headers: headers});
+                        offset = parseInt(head.headers.get('Upload-Offset'), 10);
+                    }
+                    retries = 0;
+                } else if (response && response.status < 500) {
+                    throw await failure(response);
+                } else if (++retries > 5) {
+                    throw new Error('Upload interrupted. Submit again to resume.');
+                } else {
+                    await new Promise(function(resolve) { setTimeout(resolve, 1000 * retries); });
+                }
+            }
+            showProgress(file.size);
+
+            const details = new FormData(form);
+            details.delete('file');
+            const completed = await fetch(location + '/complete', {method: 'POST', body: details});
+            if (!completed.ok) {
+                throw await failure(completed);
+            }
+            localStorage.removeItem(resumeKey);
+            window.location.href = (await completed.json()).redirect;
+        } catch (error) {
+            errorBox.textContent = error.message;
+            errorBox.classList.remove('d-none');
+            submitButton.disabled = false;
+        }
+    }
+
     // Confirmation dialogs
     const deleteLinks = document.querySelectorAll('a[onclick*="confirm"]');
     deleteLinks.forEach(function(link) {
@@ -131,11 +244,13 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
-    // Search suggestions (simple implementation)
+    // Search suggestions from /api/suggest
     const searchInputs = document.querySelectorAll('input[name="query"]');
     searchInputs.forEach(function(input) {
         let searchTimeout;
+        let pending;
         
+        input.setAttribute('autocomplete', 'off');
         input.addEventListener('input', function(e) {
             clearTimeout(searchTimeout);
             const query = e.target.value.trim();
@@ -146,10 +261,22 @@ document.addEventListener('DOMContentLoaded', function() {
             }
             
             searchTimeout = setTimeout(function() {
-                // In a real implementation, this would make an AJAX call
-                // For now, we'll just show a simple message
-                showSearchHint(input, query);
-            }, 300);
+                // Drop the answer to an older keystroke
+                if (pending) {
+                    pending.abort();
+                }
+                pending = new AbortController();
+                fetch('/api/suggest?q=' + encodeURIComponent(query), { signal: pending.signal })
+                    .then(function(response) { return response.json(); })
+                    .then(function(data) { showSuggestions(input, data.suggestions); })
+                    .catch(function() {});
+            }, 150);
+        });
+        
+        input.addEventListener('keydown', function(e) {
+            if (e.key === 'Escape') {
+                hideSuggestions(input);
+            }
         });
         
         // Hide suggestions when clicking outside
@@ -160,21 +287,37 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
-    function showSearchHint(input, query) {
+    const suggestionIcons = { title: 'fa-book', author: 'fa-user', category: 'fa-folder' };
+
+    function showSuggestions(input, suggestions) {
         hideSuggestions(input);
+        if (!suggestions.length) {
+            return;
+        }
         
-        const hint = document.createElement('div');
-        hint.className = 'search-hint position-absolute bg-dark border rounded p-2 mt-1';
-        hint.style.zIndex = '1000';
-        hint.style.fontSize = '0.875rem';
-        hint.innerHTML = `<small class="text-muted">Searching for "${query}"... Press Enter to search</small>`;
+        const list = document.createElement('div');
+        list.className = 'search-hint list-group position-absolute w-100 mt-1';
+        list.style.zIndex = '1000';
+        suggestions.forEach(function(suggestion) {
+            const item = document.createElement('a');
+            item.className = 'list-group-item list-group-item-action py-1';
+            item.href = suggestion.url;
+            const icon = document.createElement('i');
+            icon.className = 'fas ' + suggestionIcons[suggestion.kind] + ' me-2 text-muted';
+            item.appendChild(icon);
+            item.appendChild(document.createTextNode(suggestion.text));
+            if (suggestion.detail) {
+                // Author of a title suggestion, telling same-titled books apart
+                const detail = document.createElement('small');
+                detail.className = 'text-muted ms-2';
+                detail.textContent = suggestion.detail;
+                item.appendChild(detail);
+            }
+            list.appendChild(item);
+        });
         
         input.parentNode.style.position = 'relative';
-        input.parentNode.appendChild(hint);
-        
-        setTimeout(function() {
-            hideSuggestions(input);
-        }, 3000);
+        input.parentNode.appendChild(list);
     }
 
     function hideSuggestions(input) {
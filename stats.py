@@ -0,0 +1,178 @@
+import time
+import threading
+from collections import Counter
+from datetime import datetime, date, timedelta
+from flask import current_app
+from sqlalchemy import select, func, delete, insert, cast, Date
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from cache import cache
+from models import User, Book, Category, Download, DownloadRollup, CompactedDownload
+import versions
+
+# Dashboard statistics. Totals are cached and kept current by the write paths
+# (routes and the download event recorder) instead of being recounted per
+# page view; trends are read from per-day, per-book download rollups rather
+# than from raw download events.
+#
+# The totals are keyed by the 'stats' version: book and user writes bump it,
+# so every worker recounts within CATEGORY_CACHE_CHECK_INTERVAL seconds.
+# Downloads are added to the cached total of the worker that records them
+# only, so that total is kept for DOWNLOADS_TTL seconds rather than an hour
+# (with Redis all workers share one counter).
+
+VERSION_NAME = 'stats'
+TOTAL_BOOKS = 'stats:total_books:{version}'
+TOTAL_USERS = 'stats:total_users:{version}'
+TOTAL_DOWNLOADS = 'stats:total_downloads:{version}'
+TRENDS = 'stats:trends:{days}'
+
+TOTALS_TTL = 3600
+DOWNLOADS_TTL = 60
+TRENDS_TTL = 300
+
+_lock = threading.Lock()
+_state = {'version': None, 'checked_at': 0.0}
+
+def stats_version():
+    interval = current_app.config.get('CATEGORY_CACHE_CHECK_INTERVAL', 5)
+    now = time.monotonic()
+    with _lock:
+        if _state['version'] is None or now - _state['checked_at'] >= interval:
+            _state['version'] = versions.get_version(VERSION_NAME)
+            _state['checked_at'] = now
+        return _state['version']
+
+def _invalidate():
+    versions.bump_version(VERSION_NAME)
+    with _lock:
+        _state['version'] = None
+
+def _total_books():
+    return db.session.execute(select(func.count(Book.id))).scalar()
+
+def _total_users():
+    return db.session.execute(
+        select(func.count(User.id)).where(User.is_admin.is_(False))
+    ).scalar()
+
+def _total_downloads():
+    # Sum of the per-book counters, so the downloads table is never scanned
+    return db.session.execute(
+        select(func.coalesce(func.sum(Book.download_count), 0))
+        .execution_options(allow_table_scan=True)
+    ).scalar()
+
+def total_books():
+    return cache.get_or_set(TOTAL_BOOKS.format(version=stats_version()), _total_books, TOTALS_TTL)
+
+def total_users():
+    return cache.get_or_set(TOTAL_USERS.format(version=stats_version()), _total_users, TOTALS_TTL)
+
+def total_downloads():
+    return cache.get_or_set(TOTAL_DOWNLOADS.format(version=stats_version()), _total_downloads, DOWNLOADS_TTL)
+
+def dashboard_totals():
+    return {
+        'total_books': total_books(),
+        'total_users': total_users(),
+        'total_downloads': total_downloads(),
+    }
+
+def books_changed():
+    # Deleting a book also removes its downloads, so all totals are recounted
+    _invalidate()
+
+def users_changed():
+    _invalidate()
+
+def downloads_recorded(count):
+    cache.incr(TOTAL_DOWNLOADS.format(version=stats_version()), count)
+
+def upsert(dialect):
+    return postgresql.insert if dialect == 'postgresql' else sqlite.insert
+
+def record_rollups(downloads):
+    # Fold a batch of new downloads into the daily per-book rollups
+    per_day = Counter((download['downloaded_at'].date(), download['book_id'])
+                      for download in downloads)
+    if not per_day:
+        return
+    book_ids = {book_id for _, book_id in per_day}
+    categories = dict(db.session.execute(
+        select(Book.id, Book.category_id).where(Book.id.in_(book_ids))
+    ).all())
+    rows = [{'day': day, 'book_id': book_id, 'category_id': categories[book_id], 'download_count': count}
+            for (day, book_id), count in per_day.items() if book_id in categories]
+    if not rows:
+        return
+    stmt = upsert(db.engine.dialect.name)(DownloadRollup.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['day', 'book_id'],
+        set_={'download_count': DownloadRollup.__table__.c.download_count + stmt.excluded.download_count},
+    )
+    db.session.connection().execute(stmt, rows)
+
+def day_of(column):
+    if db.engine.dialect.name == 'sqlite':
+        return func.date(column)
+    return cast(column, Date)
+
+def rebuild_rollups():
+    # Downloads compacted by retention.compact() still count, on their compacted day
+    day = day_of(Download.downloaded_at).label('day')
+    per_day = Counter()
+    for d, book_id, count in db.session.execute(
+        select(day, Download.book_id, func.count(Download.id)).group_by(day, Download.book_id)
+    ):
+        per_day[(d if isinstance(d, date) else date.fromisoformat(d), book_id)] += count
+    for d, book_id, count in db.session.execute(
+        select(CompactedDownload.day, CompactedDownload.book_id, func.sum(CompactedDownload.download_count))
+        .group_by(CompactedDownload.day, CompactedDownload.book_id)
+    ):
+        per_day[(d, book_id)] += count
+    categories = dict(db.session.execute(select(Book.id, Book.category_id)).all())
+    rows = [{'day': d, 'book_id': book_id, 'category_id': categories[book_id], 'download_count': count}
+            for (d, book_id), count in per_day.items() if book_id in categories]
+    db.session.execute(delete(DownloadRollup))
+    if rows:
+        db.session.execute(insert(DownloadRollup), rows)
+    db.session.commit()
+    cache.delete(TRENDS.format(days=14), TRENDS.format(days=30))
+    return len(rows)
+
+def _trends(days):
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    per_day = dict(db.session.execute(
+        select(DownloadRollup.day, func.sum(DownloadRollup.download_count))
+        .where(DownloadRollup.day >= since)
+        .group_by(DownloadRollup.day)
+    ).all())
+    daily = [(since + timedelta(days=offset), per_day.get(since + timedelta(days=offset), 0))
+             for offset in range(days)]
+    top_categories = db.session.execute(
+        select(Category.name, func.sum(DownloadRollup.download_count).label('total'))
+        .join(Category, Category.id == DownloadRollup.category_id)
+        .where(DownloadRollup.day >= since)
+        .group_by(Category.name)
+        .order_by(func.sum(DownloadRollup.download_count).desc())
+        .limit(5)
+    ).all()
+    top_books = db.session.execute(
+        select(Book.title, func.sum(DownloadRollup.download_count).label('total'))
+        .join(Book, Book.id == DownloadRollup.book_id)
+        .where(DownloadRollup.day >= since)
+        .group_by(Book.id, Book.title)
+        .order_by(func.sum(DownloadRollup.download_count).desc())
+        .limit(5)
+    ).all()
+    return {
+        'days': days,
+        'daily': daily,
+        'peak': max((count for _, count in daily), default=0),
+        'top_categories': [tuple(row) for row in top_categories],
+        'top_books': [tuple(row) for row in top_books],
+    }
+
+def download_trends(days=14):
+    return cache.get_or_set(TRENDS.format(days=days), lambda: _trends(days), TRENDS_TTL)
@@ -0,0 +1,274 @@
+import os
+import fcntl
+import hashlib
+import logging
+import tempfile
+from functools import partial
+from contextlib import contextmanager
+from urllib.parse import quote
+from sqlalchemy import event, update, insert, delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app import db
+from models import StoredFile
+
+# Book file storage. Files are stored once under the SHA-256 of their
+# content, in sharded directories (ab/cd/abcd...), and a stored_files row
+# counts the books referencing each file: identical uploads share one copy
+# and the last book to go removes it. The backend is the local disk
+# (uploads/objects by default) or, with STORAGE_BACKEND=s3, any S3-compatible
+# service such as MinIO (requires boto3, the "s3" extra; S3_ENDPOINT_URL
+# selects the server).
+#
+# add() counts the reference in the caller's transaction and puts the file in
+# place only once that transaction commits; on a rollback the source file is
+# discarded, so a failed write leaves neither an object nor a count without
+# one. Placing and releasing a digest take a per-digest lock file, so a
+# release that drops the last reference cannot delete an object another
+# worker has just stored again. after_commit() queues such deferred writes
+# for other files too (covers staged by a catalog import).
+
+READ_SIZE = 1024 * 1024
+PENDING = 'storage_pending'
+
+
+def object_key(digest):
+    return f'{digest[:2]}/{digest[2:4]}/{digest}'
+
+
+class LocalStorage:
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def incoming_dir(self):
+        # Next to the objects, so storing a finished upload is a rename
+        path = os.path.join(self.root, '.incoming')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, key, source_path):
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source_path, target)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def delete(self, key):
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def local_path(self, key):
+        return self.path(key)
+
+    def download_url(self, key, filename):
+        return None
+
+
+class S3Storage:
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, url_expiry=300):
+        import boto3
+        from botocore.exceptions import ClientError
+        self.client_error = ClientError
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.url_expiry = url_expiry
+
+    def incoming_dir(self):
+        # Kept on local disk until uploaded; resumable uploads live here too
+        path = os.path.join(os.getcwd(), 'uploads', '.incoming')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except self.client_error as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def put(self, key, source_path):
+        self.client.upload_file(source_path, self.bucket, self.prefix + key)
+        os.remove(source_path)
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body']
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def local_path(self, key):
+        return None
+
+    def download_url(self, key, filename):
+        # Short-lived signed URL; the object store serves the bytes and ranges
+        disposition = f"attachment; filename*=UTF-8''{quote(filename)}"
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': self.prefix + key,
+                    'ResponseContentDisposition': disposition},
+            ExpiresIn=self.url_expiry,
+        )
+
+
+class Storage:
+    def __init__(self, app=None):
+        self.backend = LocalStorage(os.path.join(os.getcwd(), 'uploads', 'objects'))
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get('STORAGE_BACKEND') == 's3':
+            self.backend = S3Storage(app.config['S3_BUCKET'], app.config.get('S3_PREFIX', ''),
+                                     app.config.get('S3_ENDPOINT_URL'), app.config.get('S3_REGION'))
+        else:
+            self.backend = LocalStorage(os.path.abspath(app.config['STORAGE_LOCAL_ROOT']))
+
+    def incoming_dir(self):
+        return self.backend.incoming_dir()
+
+    @contextmanager
+    def _locked(self, digest):
+        # 256 lock files, shared by the worker processes on this host
+        lock_dir = os.path.join(self.incoming_dir(), '.locks')
+        os.makedirs(lock_dir, exist_ok=True)
+        with open(os.path.join(lock_dir, f'{digest[:2]}.lock'), 'a') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _acquire(self, digest, size):
+        """Count one more reference; returns True if the file is new."""
+        result = db.session.execute(
+            update(StoredFile).where(StoredFile.digest == digest)
+            .values(ref_count=StoredFile.ref_count + 1)
+        )
+        if result.rowcount:
+            return False
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(StoredFile).values(digest=digest, size=size, ref_count=1))
+        except IntegrityError:
+            # Another worker stored the same content first
+            return self._acquire(digest, size)
+        return True
+
+    def add(self, source_path, digest, rollback_path=None):
+        """Store a file whose digest is known, consuming source_path.
+
+        The reference is counted in the current transaction, which the caller
+        commits together with the row that points at the file; the file is
+        put in place after that commit. On a rollback source_path is removed,
+        or moved back to rollback_path when one is given.
+        """
+        self._acquire(digest, os.path.getsize(source_path))
+        after_commit(partial(self._place, source_path, digest),
+                     partial(_discard, source_path, rollback_path),
+                     f'{digest} from {source_path}')
+        return object_key(digest)
+
+    def _place(self, source_path, digest):
+        key = object_key(digest)
+        with self._locked(digest):
+            if self.backend.exists(key):
+                os.remove(source_path)
+            else:
+                self.backend.put(key, source_path)
+
+    def save_upload(self, file_storage):
+        """Store an uploaded file; returns (digest, size)."""
+        digest = hashlib.sha256()
+        size = 0
+        handle, temp_path = tempfile.mkstemp(dir=self.incoming_dir(), suffix='.upload')
+        try:
+            with os.fdopen(handle, 'wb') as out:
+                while True:
+                    block = file_storage.stream.read(READ_SIZE)
+                    if not block:
+                        break
+                    digest.update(block)
+                    out.write(block)
+                    size += len(block)
+            self.add(temp_path, digest.hexdigest())
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return digest.hexdigest(), size
+
+    def release(self, digest):
+        """Drop one reference and delete the file once nothing uses it."""
+        with self._locked(digest):
+            db.session.execute(
+                update(StoredFile).where(StoredFile.digest == digest)
+                .values(ref_count=StoredFile.ref_count - 1)
+            )
+            removed = db.session.execute(
+                delete(StoredFile).where(StoredFile.digest == digest, StoredFile.ref_count <= 0)
+            ).rowcount
+            db.session.commit()
+            if removed:
+                self.backend.delete(object_key(digest))
+        return bool(removed)
+
+    def open(self, digest):
+        return self.backend.open(object_key(digest))
+
+    def local_path(self, digest):
+        return self.backend.local_path(object_key(digest))
+
+    def download_url(self, digest, filename):
+        return self.backend.download_url(object_key(digest), filename)
+
+
+storage = Storage()
+
+
+def after_commit(place, discard, description):
+    """Call place() once the current transaction commits, or discard() if it rolls back."""
+    db.session().info.setdefault(PENDING, []).append((place, discard, description))
+
+
+def _discard(source_path, rollback_path=None):
+    if not os.path.exists(source_path):
+        return
+    if rollback_path:
+        os.replace(source_path, rollback_path)
+    else:
+        os.remove(source_path)
+
+
+@event.listens_for(Session, 'after_commit')
+def _place_pending(session):
+    # Also called when a savepoint is released; only the outer commit counts
+    if session.in_nested_transaction():
+        return
+    for place, _, description in session.info.pop(PENDING, []):
+        try:
+            place()
+        except Exception as e:
+            # The row is committed; keep the bytes where they can be recovered
+            logging.error(f"Could not store {description}: {e}")
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_pending(session, transaction):
+    # Whatever is still pending when the outermost transaction ends was rolled back
+    if transaction.parent is not None:
+        return
+    for _, discard, description in session.info.pop(PENDING, []):
+        try:
+            discard()
+        except Exception as e:
+            logging.error(f"Could not discard {description}: {e}")
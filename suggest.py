@@ -0,0 +1,216 @@
+import time
+import heapq
+import bisect
+import logging
+import threading
+import unicodedata
+from flask import current_app
+from sqlalchemy import select
+from app import db
+from models import Book
+import categories
+import page_cache
+from search import TOKEN_RE
+
+# Typeahead suggestions for the search box. Each worker keeps a sorted list
+# of keys over book titles, authors and category names, one key per word
+# position ("secret garden" and "garden" for "The Secret Garden"), so the
+# keys for a prefix are one contiguous range found with two bisects.
+# Suggestions are ranked by download count as of the last build over the
+# whole range; results for ranges of CACHED_RANGE keys or more (short
+# prefixes) are kept until a book write touches one of their keys.
+#
+# Book writes in this worker update the index in place (book_saved,
+# book_removed). Writes elsewhere bump the catalog version, and a worker
+# that sees a new version rebuilds its index in a background thread while
+# answering from the old one.
+
+MAX_KEY_WORDS = 6
+CACHED_RANGE = 2000
+
+
+def normalize(value):
+    # Lower case without accents, to match how the search index tokenizes
+    decomposed = unicodedata.normalize('NFKD', value.casefold())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _keys(phrase):
+    words = TOKEN_RE.findall(normalize(phrase))
+    return {' '.join(words[i:i + MAX_KEY_WORDS]) for i in range(len(words))}
+
+
+class PrefixIndex:
+    def __init__(self):
+        self.keys = []
+        # Parallel to keys: (kind, text, target, book_id)
+        self.entries = []
+        self.books = {}
+        self.weights = {}
+        # Results for large ranges, by (prefix, limit)
+        self.cached = {}
+
+    def _forget(self, key):
+        # Cached results for prefixes of the key no longer hold
+        for cached in [cached for cached in self.cached if key.startswith(cached[0])]:
+            del self.cached[cached]
+
+    def _insert(self, key, entry):
+        position = bisect.bisect_left(self.keys, key)
+        self.keys.insert(position, key)
+        self.entries.insert(position, entry)
+        self._forget(key)
+
+    def _remove(self, key, entry):
+        position = bisect.bisect_left(self.keys, key)
+        while position < len(self.keys) and self.keys[position] == key:
+            if self.entries[position] == entry:
+                del self.keys[position]
+                del self.entries[position]
+                self._forget(key)
+                return
+            position += 1
+
+    def _book_entries(self, book_id, title, author):
+        for key in _keys(title):
+            yield key, ('title', title, title, book_id)
+        for key in _keys(author):
+            yield key, ('author', author, author, book_id)
+
+    def add_book(self, book_id, title, author, weight=0):
+        self.remove_book(book_id)
+        self.books[book_id] = (title, author)
+        self.weights[book_id] = weight
+        for key, entry in self._book_entries(book_id, title, author):
+            self._insert(key, entry)
+
+    def remove_book(self, book_id):
+        if book_id not in self.books:
+            return
+        title, author = self.books.pop(book_id)
+        self.weights.pop(book_id, None)
+        for key, entry in self._book_entries(book_id, title, author):
+            self._remove(key, entry)
+
+    def bulk_load(self, books, category_list):
+        """Build from scratch: one sort instead of an insert per key."""
+        pairs = []
+        for book_id, title, author, weight in books:
+            self.books[book_id] = (title, author)
+            self.weights[book_id] = weight
+            pairs.extend(self._book_entries(book_id, title, author))
+        for category in category_list:
+            pairs.extend((key, ('category', category.name, category.id, None))
+                         for key in _keys(category.name))
+        pairs.sort(key=lambda pair: pair[0])
+        self.keys = [key for key, _ in pairs]
+        self.entries = [entry for _, entry in pairs]
+        self.cached.clear()
+
+    def lookup(self, prefix, limit):
+        prefix = ' '.join(TOKEN_RE.findall(normalize(prefix)))
+        if not prefix:
+            return []
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + '\uffff')
+        if end - start < CACHED_RANGE:
+            return self._rank(start, end, limit)
+        if (prefix, limit) not in self.cached:
+            self.cached[(prefix, limit)] = self._rank(start, end, limit)
+        return self.cached[(prefix, limit)]
+
+    def _rank(self, start, end, limit):
+        # A title is one book, so books sharing a title stay apart; authors
+        # add up over their books
+        weights = self.weights
+        candidates, seen, named = [], set(), {}
+        for kind, text, target, book_id in self.entries[start:end]:
+            if kind == 'title':
+                if book_id not in seen:
+                    seen.add(book_id)
+                    candidates.append((-weights.get(book_id, 0), text, book_id, kind, target))
+                continue
+            weight, _, books = named.setdefault((kind, text), [0, target, set()])
+            if book_id not in books:
+                books.add(book_id)
+                named[(kind, text)][0] = weight - weights.get(book_id, 0)
+        candidates.extend((weight, text, 0, kind, target)
+                          for (kind, text), (weight, target, _) in named.items())
+        return [{'kind': kind, 'text': text, 'target': target,
+                 'detail': self.books[book_id][1] if kind == 'title' else None}
+                for _, text, book_id, kind, target in heapq.nsmallest(limit, candidates)]
+
+
+class Suggester:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._version = None
+        self._building = False
+
+    def _load(self):
+        rows = db.session.execute(
+            select(Book.id, Book.title, Book.author, Book.download_count)
+            .execution_options(allow_table_scan=True)
+        ).all()
+        index = PrefixIndex()
+        index.bulk_load(rows, categories.all_categories())
+        return index
+
+    def _rebuild(self, app, version):
+        try:
+            with app.app_context():
+                started = time.perf_counter()
+                index = self._load()
+                with self._lock:
+                    self._index = index
+                    self._version = version
+                logging.debug(f"Suggestion index rebuilt in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            logging.error(f"Failed to rebuild the suggestion index: {e}")
+        finally:
+            self._building = False
+
+    def _current(self):
+        version = page_cache.catalog_version()
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self._load()
+                    self._version = version
+        elif version != self._version:
+            with self._lock:
+                start, self._building = not self._building, True
+            if start:
+                threading.Thread(target=self._rebuild, name='suggest-index', daemon=True,
+                                 args=(current_app._get_current_object(), version)).start()
+        return self._index
+
+    def suggest(self, prefix, limit=8):
+        index = self._current()
+        with self._lock:
+            return index.lookup(prefix, limit)
+
+    def _applied(self, change):
+        # Apply a write made by this worker and take the version it bumped
+        if self._index is None:
+            return
+        with self._lock:
+            change(self._index)
+            if not self._building:
+                self._version = page_cache.catalog_version()
+
+    def book_saved(self, book):
+        self._applied(lambda index: index.add_book(book.id, book.title, book.author,
+                                                  book.download_count or 0))
+
+    def book_removed(self, book_id):
+        self._applied(lambda index: index.remove_book(book_id))
+
+    def categories_changed(self):
+        # Rare; rebuild on the next lookup
+        with self._lock:
+            self._version = None
+
+
+suggester = Suggester()
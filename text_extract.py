@@ -0,0 +1,162 @@
+import os
+import re
+import gzip
+import json
+import zipfile
+import posixpath
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+
+# Text extraction for book files, run in a worker process by fulltext.py.
+# Each format is read as a stream of pages so a large book never has to fit
+# in memory: PDF pages as they are (needs pypdf), EPUB chapters in spine
+# order, and TXT and DOCX cut into PAGE_CHARS pieces at paragraph or word
+# boundaries. Pages are written to a gzipped JSON-lines file that the
+# application process loads into the database.
+#
+# Like covers.py, this module must not import the application.
+
+PAGE_CHARS = 4000
+READ_CHARS = 64 * 1024
+WHITESPACE_RE = re.compile(r'\s+')
+
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+CONTAINER_NS = '{urn:oasis:names:tc:opendocument:xmlns:container}'
+OPF_NS = '{http://www.idpf.org/2007/opf}'
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+def _clean(text):
+    return WHITESPACE_RE.sub(' ', text).strip()
+
+
+def _paginate(pieces):
+    # Join text pieces into pages of about PAGE_CHARS, cutting at a space
+    buffer = ''
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= PAGE_CHARS:
+            cut = buffer.rfind(' ', PAGE_CHARS // 2, PAGE_CHARS)
+            cut = cut if cut > 0 else PAGE_CHARS
+            yield buffer[:cut]
+            buffer = buffer[cut:]
+    if buffer.strip():
+        yield buffer
+
+
+def _txt_pages(path):
+    def pieces():
+        with open(path, encoding='utf-8', errors='replace') as handle:
+            for block in iter(lambda: handle.read(READ_CHARS), ''):
+                yield block
+    return _paginate(pieces())
+
+
+def _pdf_pages(path):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise UnsupportedFormat('PDF extraction needs pypdf')
+    reader = PdfReader(path)
+    for page in reader.pages:
+        yield page.extract_text() or ''
+
+
+class _HTMLText(HTMLParser):
+    SKIP = {'script', 'style', 'head'}
+    BREAKS = {'p', 'div', 'br', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'tr', 'section'}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skipping += 1
+        elif tag in self.BREAKS:
+            self.parts.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+
+def _epub_chapters(archive):
+    container = ElementTree.fromstring(archive.read('META-INF/container.xml'))
+    opf_path = container.find(f'.//{CONTAINER_NS}rootfile').get('full-path')
+    opf = ElementTree.fromstring(archive.read(opf_path))
+    base = posixpath.dirname(opf_path)
+    manifest = {item.get('id'): item.get('href') for item in opf.iter(f'{OPF_NS}item')}
+    for itemref in opf.iter(f'{OPF_NS}itemref'):
+        href = manifest.get(itemref.get('idref'))
+        if href:
+            yield posixpath.normpath(posixpath.join(base, href.split('#')[0]))
+
+
+def _epub_pages(path):
+    with zipfile.ZipFile(path) as archive:
+        for name in _epub_chapters(archive):
+            try:
+                markup = archive.read(name).decode('utf-8', errors='replace')
+            except KeyError:
+                continue
+            parser = _HTMLText()
+            parser.feed(markup)
+            parser.close()
+            # One chapter at a time; long chapters become several pages
+            yield from _paginate([''.join(parser.parts)])
+
+
+def _docx_pages(path):
+    def paragraphs():
+        with zipfile.ZipFile(path) as archive, archive.open('word/document.xml') as document:
+            parts = []
+            for event, element in ElementTree.iterparse(document, events=('end',)):
+                if element.tag == f'{WORD_NS}t':
+                    parts.append(element.text or '')
+                elif element.tag == f'{WORD_NS}p':
+                    yield ''.join(parts) + ' '
+                    parts = []
+                    element.clear()
+    return _paginate(paragraphs())
+
+
+EXTRACTORS = {
+    'txt': _txt_pages,
+    'pdf': _pdf_pages,
+    'epub': _epub_pages,
+    'docx': _docx_pages,
+}
+
+
+def extract_book(source_path, extension, out_path):
+    """Write the non-empty pages of a book to out_path; returns (pages, characters)."""
+    extractor = EXTRACTORS.get(extension.lower())
+    if extractor is None:
+        raise UnsupportedFormat(f'No text extraction for .{extension} files')
+    pages = characters = 0
+    partial = f'{out_path}.{os.getpid()}.part'
+    with gzip.open(partial, 'wt', encoding='utf-8') as out:
+        for number, text in enumerate(extractor(source_path), 1):
+            text = _clean(text)
+            if not text:
+                continue
+            pages += 1
+            characters += len(text)
+            out.write(json.dumps({'page': number, 'text': text}) + '\n')
+    os.replace(partial, out_path)
+    return pages, characters
+
+
+def read_pages(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as handle:
+        for line in handle:
+            yield json.loads(line)
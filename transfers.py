@@ -0,0 +1,79 @@
+import os
+from urllib.parse import quote
+from flask import current_app, request, redirect
+from werkzeug.utils import send_file
+from storage import storage
+
+# Book file delivery. Responses carry a validator built from the file's size
+# and modification time, so clients can resume with Range/If-Range and revalidate
+# with If-None-Match/If-Modified-Since. DOWNLOAD_OFFLOAD hands the transfer to
+# the front proxy instead of streaming it from the worker:
+#   "x-accel-redirect"  nginx; DOWNLOAD_ACCEL_PREFIX is an internal location
+#                       aliased to the uploads directory
+#   "x-sendfile"        Apache mod_xsendfile / lighttpd
+# Books kept in a remote object store are served from a signed URL instead.
+
+def book_file_path(book):
+    """Local path of the book file, or None when it lives in a remote store."""
+    if book.file_hash:
+        return storage.local_path(book.file_hash)
+    # Ensure the file path is absolute
+    if not os.path.isabs(book.file_path):
+        return os.path.join(os.getcwd(), book.file_path)
+    return book.file_path
+
+def file_etag(stat):
+    return f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+def _accel_uri(path):
+    uploads_dir = os.path.join(os.getcwd(), current_app.config['UPLOAD_FOLDER'])
+    relative = os.path.relpath(path, uploads_dir)
+    if relative.startswith(os.pardir):
+        return None
+    prefix = current_app.config['DOWNLOAD_ACCEL_PREFIX'].rstrip('/')
+    return f"{prefix}/{quote(relative.replace(os.sep, '/'))}"
+
+def send_book(book):
+    """Build the download response; raises FileNotFoundError if the file is gone."""
+    path = book_file_path(book)
+    if path is None:
+        return redirect(storage.download_url(book.file_hash, book.filename))
+    stat = os.stat(path)
+    offload = current_app.config.get('DOWNLOAD_OFFLOAD')
+    accel_uri = _accel_uri(path) if offload == 'x-accel-redirect' else None
+
+    offloaded = offload == 'x-sendfile' or accel_uri is not None
+    environ = request.environ
+    if offloaded:
+        # The proxy answers Range requests itself from the original headers
+        environ = {key: value for key, value in environ.items()
+                   if key not in ('HTTP_RANGE', 'HTTP_IF_RANGE')}
+
+    response = send_file(
+        path,
+        environ,
+        as_attachment=True,
+        download_name=book.filename,
+        conditional=True,
+        etag=file_etag(stat),
+        use_x_sendfile=offloaded,
+        response_class=current_app.response_class,
+    )
+    if accel_uri is not None and 'X-Sendfile' in response.headers:
+        del response.headers['X-Sendfile']
+        response.headers['X-Accel-Redirect'] = accel_uri
+    response.cache_control.private = True
+    return response
+
+def is_new_download(response):
+    # Resumed transfers and revalidations belong to a download already
+    # recorded; only a full response or a range starting at byte 0 counts
+    if response.status_code == 302:
+        # Sent on to the object store, which handles the range itself
+        return request.range is None or request.range.ranges[0][0] == 0
+    if response.status_code not in (200, 206):
+        return False
+    offloaded = 'X-Sendfile' in response.headers or 'X-Accel-Redirect' in response.headers
+    if request.range is None or (response.status_code == 200 and not offloaded):
+        return True
+    return request.range.ranges[0][0] == 0
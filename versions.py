@@ -0,0 +1,31 @@
+from sqlalchemy import select, update, insert
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import CacheVersion
+
+# Version stamps for data cached inside each worker. A write bumps the
+# stamp in the database; every worker compares its cached copy's stamp with
+# the stored one and reloads when they differ. The reads are tagged with the
+# version_check execution option, so per-request statement budgets can leave
+# out the check that lands on whichever request crosses its interval.
+
+def get_version(name):
+    version = db.session.execute(
+        select(CacheVersion.version).where(CacheVersion.name == name)
+        .execution_options(version_check=True)
+    ).scalar()
+    return version or 0
+
+def bump_version(name):
+    result = db.session.execute(
+        update(CacheVersion).where(CacheVersion.name == name)
+        .values(version=CacheVersion.version + 1)
+    )
+    if result.rowcount == 0:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(CacheVersion).values(name=name, version=1))
+        except IntegrityError:
+            # Another worker created the row first
+            return bump_version(name)
+    db.session.commit()